@@ -1,9 +1,35 @@
 from flask import Flask
-from flasgger import Swagger
 
-# Create Flask application
-app = Flask(__name__)
-app.config.from_object('config')
-swag = Swagger(app)
 
-import payments
+def create_app(config='config'):
+    """
+    Builds the application: settings, database, API docs, routes and commands.
+
+    Nothing here touches the database.  Connections are opened by the first request
+    that needs one, and the schema is created or migrated by `flask init-db` (or
+    `flask db upgrade`) rather than by every process on start-up.
+
+    :param config: <str|object> the settings module or object to load
+    """
+    application = Flask(__name__)
+    application.config.from_object(config)
+
+    from app.db import app_db, migrate
+    app_db.init_app(application)
+    migrate.init_app(application, app_db)
+
+    from app import apidocs, compression, encoding, idempotency, metrics, payments, error_handlers, commands
+    metrics.init_app(application)
+    compression.init_app(application)
+    apidocs.init_app(application)
+    encoding.init_app(application)
+    idempotency.init_app(application)
+    payments.payment_service.init_app(application)
+    application.register_blueprint(payments.api)
+    error_handlers.init_app(application)
+    commands.init_app(application)
+    return application
+
+
+# the application run.py, FLASK_APP=run.py and the tests use
+app = create_app()
@@ -0,0 +1,64 @@
+import hashlib, os
+from flask import Response, request
+from flask_api import status
+
+
+def swag_from(filepath):
+    """
+    Marks a view as documented by a YAML file, relative to the module of the view.
+
+    Records the file where flasgger looks for it, as flasgger's own swag_from does, but
+    without importing flasgger (or yaml, mistune and jsonschema with it) and without
+    wrapping the view, so workers that serve no API docs do not pay for them.
+
+    :param filepath: <str> the YAML file, e.g. 'documentation/list_payments.yaml'
+    """
+    def decorator(function):
+        root = os.path.dirname(function.__globals__['__file__'])
+        function.swag_path = os.path.join(root, filepath)
+        function.swag_type = filepath.split('.')[-1]
+        return function
+    return decorator
+
+
+def init_app(app):
+    """
+    Serves the API docs (/apidocs) and the spec (/v1/spec) when SWAGGER_ENABLED is set.
+
+    flasgger assembles the spec by reading and parsing the YAML file of every route on
+    each request.  The spec only changes with the code, so it is assembled on its first
+    request and then served as the same encoded bytes with an ETag.
+    """
+    if not app.config['SWAGGER_ENABLED']:
+        return
+    from flasgger import Swagger
+
+    swagger = Swagger(app)
+    for endpoint in swagger.endpoints:
+        endpoint = '%s.%s' % (swagger.config.get('endpoint', 'swagger'), endpoint)
+        app.view_functions[endpoint] = cached_spec(app.view_functions[endpoint])
+
+
+def cached_spec(view):
+    """
+    Wraps a flasgger spec view so that the spec is built once, by the first request.
+
+    :param view: <function> the view that builds the spec
+    """
+    spec = {}
+
+    def get_spec():
+        if 'body' not in spec:
+            body = view().get_data()
+            spec['etag'] = hashlib.md5(body).hexdigest()
+            spec['body'] = body
+
+        if request.if_none_match.contains_weak(spec['etag']):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = Response(spec['body'], mimetype='application/json')
+        response.set_etag(spec['etag'])
+        return response
+
+    get_spec.__name__ = view.__name__
+    return get_spec
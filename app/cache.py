@@ -0,0 +1,108 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache(object):
+    """
+    A bounded, thread-safe least-recently-used cache whose entries expire.
+
+    Holds at most max_size entries; adding one more evicts the entry that was
+    used longest ago.  Entries older than ttl seconds are treated as missing.
+    A max_size of 0 turns the cache off: nothing is stored and every get misses.
+
+    Writers call invalidate() for the keys they change.  Readers that load a
+    value after a miss should take a token() first and hand it to set(), so a
+    value read before a concurrent invalidation is not stored after it.
+    """
+    def __init__(self, max_size=1024, ttl=60, clock=time.time):
+        """
+        :param max_size: <int> the most entries the cache holds
+        :param ttl: <float> seconds an entry stays valid after it is stored
+        :param clock: <callable> returns the current time in seconds
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self._invalidations = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """ Returns the value stored under key, or None if it is missing or expired """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[1] <= self.clock():
+                self.misses += 1
+                return None
+            # re-inserting moves the entry to the most recently used end
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def token(self):
+        """ Returns a token to pass to set() for a value about to be loaded """
+        with self._lock:
+            return self._invalidations
+
+    def set(self, key, value, token=None):
+        """
+        Stores value under key.
+
+        :param token: <int> the token() taken before the value was loaded; if anything
+                      was invalidated since, the value may be stale and is not stored
+        :return: <bool> True if the value was stored
+        """
+        with self._lock:
+            if self.max_size <= 0 or (token is not None and token != self._invalidations):
+                return False
+            self._store(key, value)
+            return True
+
+    def add(self, key, value):
+        """
+        Stores value under key unless a live entry holds the key already, in one step,
+        so that of several threads adding the same key exactly one succeeds.
+
+        :return: <bool> True if the value was stored
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if self.max_size <= 0 or (entry is not None and entry[1] > self.clock()):
+                return False
+            self._store(key, value)
+            return True
+
+    def _store(self, key, value):
+        # callers hold the lock
+        self._entries.pop(key, None)
+        self._entries[key] = (value, self.clock() + self.ttl)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, *keys):
+        """ Drops the entries stored under keys """
+        with self._lock:
+            self._invalidations += 1
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        """ Drops every entry and resets the counters """
+        with self._lock:
+            self._invalidations += 1
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """ Returns the size, limits and hit/miss/eviction counters of the cache """
+        with self._lock:
+            return {'size': len(self._entries), 'max_size': self.max_size, 'ttl': self.ttl,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
@@ -0,0 +1,40 @@
+import click
+import flask_migrate
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import inspect
+from app.db import app_db
+
+
+######################################################################
+# INIT DB (FLASK_APP=run.py flask init-db)
+######################################################################
+@click.command('init-db')
+@with_appcontext
+def init_db():
+    """ Creates the schema of an empty database, or migrates an existing one to the latest version """
+    if 'payment' in inspect(app_db.engine).get_table_names():
+        flask_migrate.upgrade()
+        click.echo('Migrated the database to the latest version')
+    else:
+        # one pass of CREATE statements, then record that no migration is needed
+        app_db.create_all()
+        flask_migrate.stamp()
+        click.echo('Created the database schema')
+
+######################################################################
+# COMPACT CHARGES (run periodically: FLASK_APP=run.py flask compact-charges)
+######################################################################
+@click.command('compact-charges')
+@with_appcontext
+def compact_charges():
+    """ Folds charges older than CHARGE_COMPACTION_GRACE seconds into the payments' totals """
+    from app.payments import payment_service
+    compacted = payment_service.compact_charges(current_app.config['CHARGE_COMPACTION_GRACE'])
+    click.echo('Compacted the charges of %d payments' % compacted)
+
+
+def init_app(app):
+    """ Registers the commands with the application's flask command line """
+    app.cli.add_command(init_db)
+    app.cli.add_command(compact_charges)
@@ -0,0 +1,92 @@
+import zlib
+from flask import request
+
+# the content codings we write; when a client accepts both equally, gzip is used
+CODINGS = ['gzip', 'deflate']
+# zlib's wbits for each coding: a gzip header and trailer, or the zlib format HTTP calls deflate
+WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+# the bodies worth compressing; error pages, docs assets and files are left alone
+MIMETYPES = frozenset(['application/json', 'application/x-ndjson', 'text/plain'])
+# bytes of a streamed body read between flushes, so the client gets each part as it is made
+# rather than when zlib's buffer happens to fill
+STREAM_FLUSH_SIZE = 64 * 1024
+
+
+class Compression(object):
+    """
+    Compresses responses with gzip or deflate, whichever the client's Accept-Encoding
+    prefers.
+
+    Bodies smaller than COMPRESSION_MIN_SIZE are sent as they are, since for them zlib
+    costs more time than it saves on the wire (a single payment is a few hundred bytes).
+    Streamed bodies are compressed whatever their size, as it is not known up front.
+    The ETag of a compressed response is made weak: the bytes differ from the identity
+    response's, the payments in them do not.
+    """
+    def __init__(self, app):
+        self.min_size = app.config['COMPRESSION_MIN_SIZE']
+        self.level = app.config['COMPRESSION_LEVEL']
+
+    def coding(self):
+        """ Returns the coding the client prefers, or None for an uncompressed body """
+        return request.accept_encodings.best_match(CODINGS)
+
+    def compressor(self, coding):
+        return zlib.compressobj(self.level, zlib.DEFLATED, WBITS[coding])
+
+    def after_request(self, response):
+        if (response.mimetype not in MIMETYPES or response.direct_passthrough
+                or 'Content-Encoding' in response.headers or response.status_code in (204, 304)):
+            return response
+        # whatever is decided below, caches must not give this body to clients that asked differently
+        response.vary.add('Accept-Encoding')
+
+        if response.is_streamed:
+            coding = self.coding()
+            if coding is None:
+                return response
+            response.response = self.stream(response.response, self.compressor(coding))
+        else:
+            data = response.get_data()
+            if len(data) < self.min_size:
+                return response
+            coding = self.coding()
+            if coding is None:
+                return response
+            compressor = self.compressor(coding)
+            response.set_data(compressor.compress(data) + compressor.flush())
+
+        response.headers['Content-Encoding'] = coding
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+    def stream(self, chunks, compressor):
+        """ Compresses the chunks of a streamed body as the body is read """
+        pending = 0
+        try:
+            for chunk in chunks:
+                if isinstance(chunk, unicode):
+                    chunk = chunk.encode('utf-8')
+                data = compressor.compress(chunk)
+                pending += len(chunk)
+                if pending >= STREAM_FLUSH_SIZE:
+                    data += compressor.flush(zlib.Z_SYNC_FLUSH)
+                    pending = 0
+                if data:
+                    yield data
+            yield compressor.flush()
+        finally:
+            # lets a body made by stream_with_context end its request
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
+
+def init_app(app):
+    """ Compresses the application's responses, unless COMPRESSION_ENABLED is off """
+    if not app.config['COMPRESSION_ENABLED']:
+        return
+    compression = Compression(app)
+    app.extensions['compression'] = compression
+    app.after_request(compression.after_request)
@@ -1,15 +1,44 @@
 from flask_sqlalchemy import SQLAlchemy
+from flask_migrate import Migrate
 
-from app import app
+from app.db.pool import InstrumentedQueuePool
 
 
-app_db = SQLAlchemy(app)
+class PaymentsSQLAlchemy(SQLAlchemy):
+    """
+    Flask-SQLAlchemy takes the pool size, overflow, timeout and recycle settings
+    from config.py itself; this adds the instrumented pool with its pre-ping and
+    the per-connection statement_timeout.
+    """
+    def apply_driver_hacks(self, app, info, options):
+        SQLAlchemy.apply_driver_hacks(self, app, info, options)
+        if 'poolclass' in options:  # sqlite gets a pool fit for it
+            return
+        options['poolclass'] = InstrumentedQueuePool
+        options['pre_ping'] = app.config['SQLALCHEMY_POOL_PRE_PING']
+        if info.drivername.startswith('postgresql') and app.config['SQLALCHEMY_STATEMENT_TIMEOUT']:
+            options.setdefault('connect_args', {})['options'] = \
+                '-c statement_timeout=%d' % app.config['SQLALCHEMY_STATEMENT_TIMEOUT']
+
+    def get_engine(self, app, bind=None):
+        if bind is None and not app.config.get('SQLALCHEMY_DATABASE_URI'):
+            raise RuntimeError('No database is configured: set LOCAL_DB or VCAP_SERVICES')
+        return SQLAlchemy.get_engine(self, app, bind)
+
+
+# bound to the application by create_app; the engine and its connections are only
+# made when the database is first used
+app_db = PaymentsSQLAlchemy()
 
 '''
-most import models AFTER db init
-but BEFORE table creation
+schema changes are shipped as alembic migrations in migrations/
+(run them with: FLASK_APP=run.py flask db upgrade); each migration
+runs in its own transaction so indexes can be built concurrently
 '''
-from app.db import models
+migrate = Migrate(db=app_db, transaction_per_migration=True)
 
-app_db.create_all()
-app_db.session.commit()
\ No newline at end of file
+'''
+import models AFTER db init so they register with its metadata;
+tables are created by `flask init-db`, not on import
+'''
+from app.db import models
@@ -1,12 +1,22 @@
 # -*- coding:utf-8 -*-
 
-import re
-from datetime import datetime, timedelta
-from sqlalchemy import exc
+from datetime import timedelta
+from sqlalchemy import exc, orm, func, select, literal, case, cast, and_, or_, BigInteger
+from sqlalchemy.dialects.postgresql import ARRAY
+from app.cache import LRUCache
 from app.db import app_db
-from app.db.models import Payment, Detail
+from app.encoding import dumps
+from app.db.models import Payment, Detail, Charge, MINOR_UNITS, MAX_AMOUNT_MINOR, PAYMENT_ROW_COLUMNS, revision, to_minor_units
+from app.validation import PAYMENT, PAYMENT_TYPES
 from app.error_handlers import DataValidationError
 
+# First key of the advisory locks set-default takes; the second is the user_id
+SET_DEFAULT_LOCK = 1
+# Times set-default is tried when the one-default-per-user index rejects it
+SET_DEFAULT_ATTEMPTS = 3
+# Times a removal is tried when another request changes the payment meanwhile
+REMOVE_ATTEMPTS = 3
+
 class PaymentService(object):
     """
     Serves as an interface which takes requests from the front-end
@@ -14,11 +24,21 @@ class PaymentService(object):
     """
     UPDATABLE_PAYMENT_FIELDS = [ 'nickname','payment_type','details']
     NONUPDATABLE_PAYMENT_FIELDS = [ 'is_default','is_removed','charge_history']
-    def __init__(self):
+    def __init__(self, cache=None):
         """
         Initialize connection to database here.
+
+        :param cache: <LRUCache> holds encoded single payment responses; by default one
+                      with the LRUCache defaults until init_app sizes it
         """
         self.db = app_db
+        if cache is None:
+            cache = LRUCache()
+        self.cache = cache
+
+    def init_app(self, app):
+        """ Sizes the cache by the PAYMENT_CACHE_SIZE and PAYMENT_CACHE_TTL settings of the app """
+        self.cache = LRUCache(app.config['PAYMENT_CACHE_SIZE'], app.config['PAYMENT_CACHE_TTL'])
 
     def add_payment(self, payment_data):
         """
@@ -38,6 +58,91 @@ class PaymentService(object):
         self.db.session.add(p)
         self.db.session.commit()
         return p.serialize()
+
+    def add_payments(self, payments_data, chunk_size=500):
+        """
+        Bulk version of add_payment: validates and creates many payments at once.
+
+        The payloads are consumed chunk_size at a time, so an iterator (e.g. lines
+        read from a request stream) is never held in memory as a whole.  Every payload
+        in a chunk is validated with the same rules as add_payment, then all the valid
+        ones are written with one multi-row INSERT per table and committed together.
+
+        :param payments_data: <iterable[dict]> the JSON payloads that describe the new Payment objects
+        :param chunk_size: <int> the number of payments written and committed per transaction
+        :return: <list> one entry per payload, in order: the created payment, or the
+                 DataValidationError/PaymentServiceQueryError that kept it from being created
+        """
+        return list(self.iter_add_payments(payments_data, chunk_size))
+
+    def iter_add_payments(self, payments_data, chunk_size=500):
+        """
+        Works like add_payments, but instead of a list returns an iterator that yields
+        the results of each chunk as soon as the chunk is committed, so neither the
+        payloads nor the results of a large batch are ever held in memory as a whole.
+        Nothing is read or written until iteration starts.
+        """
+        chunk = []
+        for payment_data in payments_data:
+            chunk.append(payment_data)
+            if len(chunk) == chunk_size:
+                for result in self._add_payments_chunk(chunk):
+                    yield result
+                chunk = []
+        if chunk:
+            for result in self._add_payments_chunk(chunk):
+                yield result
+
+    def _add_payments_chunk(self, payments_data):
+        """ Validates and creates one chunk of payments for add_payments in a single transaction """
+        results = []
+        payments = []
+        for payment_data in payments_data:
+            p = Payment()
+            try:
+                p.deserialize(payment_data)
+            except DataValidationError as e:
+                results.append(e)
+                continue
+            results.append(p)
+            payments.append(p)
+
+        if payments:
+            try:
+                self._insert_payments(payments)
+                self.db.session.commit()
+            except exc.SQLAlchemyError as e:
+                self.db.session.rollback()
+                error = PaymentServiceQueryError('Could not create payment due to query error: %s' % e)
+                return [error if isinstance(result, Payment) else result for result in results]
+
+        return [result.serialize() if isinstance(result, Payment) else result for result in results]
+
+    def _insert_payments(self, payments):
+        """
+        Inserts new payments and their details with one multi-row INSERT per table.
+
+        The ids are reserved from the tables' sequences up front, so each payment can
+        point at its detail without inserting the rows one at a time to get their ids.
+        """
+        detail_ids = self._next_ids(Detail, len(payments))
+        payment_ids = self._next_ids(Payment, len(payments))
+        detail_rows = []
+        payment_rows = []
+        for payment, detail_id, payment_id in zip(payments, detail_ids, payment_ids):
+            payment.details.id = payment.detail_id = detail_id
+            payment.id = payment_id
+            detail_rows.append(dict((c.name, getattr(payment.details, c.name)) for c in Detail.__table__.columns))
+            payment_rows.append(dict((c.name, getattr(payment, c.name)) for c in Payment.__table__.columns))
+        self.db.session.execute(Detail.__table__.insert().values(detail_rows))
+        self.db.session.execute(Payment.__table__.insert().values(payment_rows))
+
+    def _next_ids(self, model, count):
+        """ Reserves count ids from the id sequence of the model's table """
+        sequence = '%s_id_seq' % model.__tablename__
+        query = select([func.nextval(sequence)]).select_from(func.generate_series(1, count))
+        return [row[0] for row in self.db.session.execute(query)]
+
     def remove_payment(self, payment_id=None, payment_attributes=None):
         """
         Accepts an id or a variable number of keyword arguments (in payment_attributes)
@@ -49,23 +154,26 @@ class PaymentService(object):
 
         Currently only supports finding payment with the id specified
 
+        A removal is unconditional, so when another request changes the payment between
+        our read and our write it is read again and removed at its new version; a
+        PaymentVersionMismatchError is raised only if that keeps happening.
         """
-
-        payment = self.db.session.query(Payment).get(payment_id)
-        if payment:
-            """
-            payment_to_be_deleted = payment.serialize()
-            payment_to_be_deleted['is_removed'] = True
-            payment.deserialize_put(payment_to_be_deleted)
-            """
+        for attempt in range(REMOVE_ATTEMPTS):
+            payment = self.db.session.query(Payment).get(payment_id)
+            if not payment:
+                return
             #workaround for deserialize_put as it always has is_removed = False
             payment.is_removed = True
-            """
-            self.db.session.delete(payment)
-            """
-            self.db.session.commit()
-
-    def update_payment(self, payment_id, payment_replacement=None, payment_attributes=None):
+            try:
+                self.db.session.commit()
+            except orm.exc.StaleDataError:
+                self.db.session.rollback()
+                continue
+            self.cache.invalidate(payment_id)
+            return
+        raise PaymentVersionMismatchError('Invalid payment: Payment kept being changed by other requests')
+
+    def update_payment(self, payment_id, payment_replacement=None, payment_attributes=None, expected_version=None):
         """
         Uses the payment_id to find a specific payment item to update.
         If the update is via a PUT request, wherein the new object overwrites
@@ -76,12 +184,15 @@ class PaymentService(object):
         :param payment_id: <int> the unique identifier of a payment to be updated
         :param payment_replacement: <dict> a complete payload that describes a new payload which replaces the old one
         :param payment_attributes: <dict> a collection of new payment attribute values that will overwrite old ones
+        :param expected_version: <int> if given, the update only happens while the payment is still at this version
         """
         if not payment_replacement and not payment_attributes:
             raise DataValidationError('Invalid payment: body of request contained bad or no data')
         payment = self.db.session.query(Payment).get(payment_id)
         if payment == None or payment.is_removed == True :
             raise PaymentNotFoundError('Invalid payment: Payment ID not found')
+        if expected_version is not None and payment.revision != expected_version:
+            raise PaymentVersionMismatchError('Invalid payment: Payment has been changed since version ' + str(expected_version))
         if payment_replacement:
             # TODO 	: test cases for validity in next sprint
             if not self.is_valid(payment_replacement, payment.user_id):
@@ -95,11 +206,17 @@ class PaymentService(object):
                 else:
                     raise DataValidationError('Invalid payment: body of request contains invalid/un-updatable fields')
             payment.deserialize(existing_payment)
-        self.db.session.commit()
+        try:
+            self.db.session.commit()
+        except orm.exc.StaleDataError:
+            # another request changed the payment between our read and our write
+            self.db.session.rollback()
+            raise PaymentVersionMismatchError('Invalid payment: Payment was changed by another request')
+        self.cache.invalidate(payment_id)
         return_object = payment.serialize()
         return return_object
 
-    def get_payments(self, payment_ids=None, payment_attributes=None):
+    def get_payments(self, payment_ids=None, payment_attributes=None, limit=None, after=None, with_versions=False):
         """
         Retrieves one or more payment items depending on the parameters
         passed in:
@@ -111,59 +228,242 @@ class PaymentService(object):
 
         If neither parameter is supplied, then all payment items are returned.
 
+        Results are always ordered by payment id, so limit and after can be used
+        to walk through them one page at a time (keyset pagination).
+
         :param payment_ids: <list[int]> a list of one or more payments to be retrieved
         :param payment_attributes: <dict> a collection of payment attributes to be used in
                                    filtering for specific payments
+        :param limit: <int> the maximum number of payments to return
+        :param after: <int> only payments with an id greater than this one are returned
+        :param with_versions: <bool> also return the version of every payment, read by the
+                              same query, e.g. for the ETag of a page
+        :return: <list[dict]> the serialized payments; with_versions, a tuple of them and
+                 their (payment id, version) pairs
         """
-        if payment_ids != None:
-            payments = self.db.session.query(Payment).filter(Payment.id.in_(payment_ids)).all()
+        rows = self._filter_rows(self._payment_rows(), payment_ids, payment_attributes)
+        rows = self._read_rows(self._paginate_rows(rows, limit, after), payment_attributes)
+        if not rows:
+            raise PaymentNotFoundError
 
-        elif payment_attributes != None:
-            try:
-                payments = self._query_payments(payment_attributes)
-            except PaymentServiceQueryError as e:
-                raise DataValidationError(e.message)
+        payments = [Payment.serialize_row(row) for row in rows]
+        if with_versions:
+            return payments, [(row.payment_id, row.revision) for row in rows]
+        return payments
 
-        else:
-            payments = self.db.session.query(Payment).all()
+    def get_expiring_payments(self, before, limit=None, after=None):
+        """
+        Retrieves the live card payments whose card expires before a date, for example
+        to ask their owners for a new card.  The cards are found through the index on
+        Detail.expires_at, so only the expiring ones are read.
+
+        :param before: <date> only cards whose last day of use is earlier than this are returned
+        :param limit: <int> the maximum number of payments to return
+        :param after: <int> only payments with an id greater than this one are returned
+        :return: <list[dict]> the serialized payments, ordered by payment id
+        """
+        rows = self._payment_rows().where(Detail.__table__.c.expires_at < before)
+        return [Payment.serialize_row(row) for row in self.db.session.execute(self._paginate_rows(rows, limit, after))]
 
-        payments = self._remove_soft_deletes(payments)
-        
-        if not payments:
-            raise PaymentNotFoundError
+    def get_user_summary(self, user_id):
+        """
+        Summarizes the live payments of one user, see get_user_summaries.
 
-        return [payment.serialize() for payment in payments]
+        :param user_id: <int> the user to summarize
+        :return: <dict> the summary
+        """
+        payment = Payment.__table__
+        row = self.db.session.execute(self._user_summaries().where(payment.c.user_id == user_id)).first()
+        if row is None:
+            raise PaymentNotFoundError('Payments not found for the user_id: ' + str(user_id))
+        return self._user_summary(row)
 
-    def _query_payments(self, payment_attributes):
+    def get_user_summaries(self, limit=None, after=None):
         """
-        Returns all payment items that fulfill the attributes used to
-        filter from all payment items.
+        Summarizes the live payments of every user, one page at a time: how many
+        payments of each type the user has, which one is the default and how much has
+        been charged to them in total.
 
+        Each page is one GROUP BY user_id over ix_payment_live_user_id, so users come
+        back in order and a page only reads the payments of the users on it.  Rows are
+        turned into dicts directly; no Payment objects are loaded.
 
-        Note: this method assumes that the attributes are safe and have been validated.
-        Also, the attributes passed in *must* be part of the Payment schema, since the
-        query below is for the Payment model.  Later on we should have a parameter that
-        indicates which model to use.
+        :param limit: <int> the maximum number of users to return
+        :param after: <int> only users with an id greater than this one are returned
+        :return: <list[dict]> the summaries, ordered by user id
+        """
+        payment = Payment.__table__
+        query = self._user_summaries().order_by(payment.c.user_id)
+        if after is not None:
+            query = query.where(payment.c.user_id > after)
+        if limit is not None:
+            query = query.limit(limit)
+        return [self._user_summary(row) for row in self.db.session.execute(query)]
+
+    def _user_summaries(self):
+        """ Returns the select that aggregates live payments per user for the summaries """
+        payment = Payment.__table__
+        # CASE inside the aggregates rather than FILTER (WHERE ...), which needs PostgreSQL 9.4
+        by_type = [func.sum(case([(payment.c.payment_type == payment_type, 1)], else_=0)).label(payment_type)
+                   for payment_type in PAYMENT_TYPES]
+        return select([payment.c.user_id,
+                       func.count(payment.c.id).label('payments'),
+                       func.max(case([(payment.c.is_default == True, payment.c.id)])).label('default_payment_id'),
+                       cast(func.sum(Payment.charge_history_minor), BigInteger).label('charged_minor')] + by_type) \
+            .where(payment.c.is_removed == False) \
+            .group_by(payment.c.user_id)
+
+    def _user_summary(self, row):
+        """ Turns a row of _user_summaries into the summary of one user """
+        return {'user_id': row.user_id,
+                'payments': row.payments,
+                'payments_by_type': dict((payment_type, row[payment_type]) for payment_type in PAYMENT_TYPES),
+                'default_payment_id': row.default_payment_id,
+                'total_charged': (row.charged_minor or 0) / float(MINOR_UNITS)}
+
+    def get_payment_response(self, payment_id):
+        """
+        Returns the JSON encoded response body of GET /payments/<payment_id>, a list
+        holding the one payment, and the payment's version, from the cache when possible.
 
-        :param parameter_attributes: <dict> a collection of Payment attributes to filter by
-        :return: <list[Payment]> a list of the Payment items returned by the query
+        Every write made through this service invalidates the payments it changes.
+        The cache belongs to one process, so a write served by another process is only
+        seen here once the entry expires after PAYMENT_CACHE_TTL seconds.
+
+        :param payment_id: <int> the unique identifier of the payment
+        :return: <tuple(str, int)> the encoded payment and its version
         """
-        try:
+        response = self.cache.get(payment_id)
+        if response is None:
+            token = self.cache.token()
+            payment = self._live_payments().filter(Payment.id == payment_id).first()
+            if payment is None:
+                raise PaymentNotFoundError
+            response = (dumps([payment.serialize()]), payment.revision)
+            self.cache.set(payment_id, response, token)
+        return response
+
+    def get_payment_version(self, payment_id):
+        """
+        Returns the version of a live payment (its revision, which also counts its
+        charges), or None if there is no such payment.
 
-            payment_query = self.db.session.query(Payment).filter_by(**payment_attributes)
-            payments = payment_query.all()
-            payments = self._remove_soft_deletes(payments)
-            return payments
+        Answers from the cache when the payment is in it, and otherwise reads just the
+        revision, so conditional requests are decided without serializing anything.
+        """
+        response = self.cache.get(payment_id)
+        if response is not None:
+            return response[1]
+        return self.db.session.query(Payment.revision) \
+            .filter(Payment.is_removed == False) \
+            .filter(Payment.id == payment_id) \
+            .scalar()
+
+    def get_payment_versions(self, payment_ids=None, payment_attributes=None, limit=None, after=None):
+        """
+        Takes the same arguments as get_payments, but only reads the id and the version
+        (revision) of the matching payments; enough to tell whether a page has changed.
+
+        :return: <list[tuple(int, int)]> (payment id, version) pairs ordered by payment id
+        """
+        payment = Payment.__table__
+        rows = select([payment.c.id, revision]).where(payment.c.is_removed == False)
+        rows = self._filter_rows(rows, payment_ids, payment_attributes)
+        rows = self._read_rows(self._paginate_rows(rows, limit, after), payment_attributes)
+        return [(row[0], row[1]) for row in rows]
+
+    def stream_payments(self, payment_ids=None, payment_attributes=None, after=None, batch_size=500):
+        """
+        Works like get_payments, but instead of a list returns an iterator that
+        serializes the payments one at a time as they are read from the database.
+
+        The rows are fetched from a server-side cursor in batches of up to batch_size, so
+        memory use stays flat no matter how many payments match.  The query itself is
+        built right away, so invalid attributes are reported before iteration starts.
+
+        :param payment_ids: <list[int]> a list of one or more payments to be retrieved
+        :param payment_attributes: <dict> a collection of payment attributes to be used in
+                                   filtering for specific payments
+        :param after: <int> only payments with an id greater than this one are returned
+        :param batch_size: <int> the most rows fetched from the cursor at a time
+        :return: <iterator[dict]> the serialized payments, ordered by payment id
+        """
+        rows = self._filter_rows(self._payment_rows(), payment_ids, payment_attributes)
+        rows = self._paginate_rows(rows, after=after) \
+            .execution_options(stream_results=True, max_row_buffer=batch_size)
+        return (Payment.serialize_row(row) for row in self.db.session.execute(rows))
+
+    def _payment_rows(self):
+        """
+        Returns the select behind the payment lists: every live payment joined to its
+        details, with just the columns Payment.serialize_row reads.
+
+        Lists are only read, so they are built from plain rows rather than from Payments
+        loaded into the session; that skips the identity map and attribute bookkeeping
+        that made up most of the time spent on every row.
+        """
+        payment = Payment.__table__
+        detail = Detail.__table__
+        return select(PAYMENT_ROW_COLUMNS) \
+            .select_from(payment.outerjoin(detail, detail.c.id == payment.c.detail_id)) \
+            .where(payment.c.is_removed == False)
 
+    def _filter_rows(self, rows, payment_ids=None, payment_attributes=None):
+        """
+        Restricts a select over the payment table to the given ids, or else to the given
+        attributes, which must be columns of the table.
+        """
+        payment = Payment.__table__
+        if payment_ids != None:
+            rows = rows.where(payment.c.id.in_(payment_ids))
+        elif payment_attributes != None:
+            for key, value in payment_attributes.items():
+                if key not in payment.c:
+                    raise DataValidationError('Could not retrieve payment items due to query error with given attributes')
+                rows = rows.where(payment.c[key] == value)
+        return rows
+
+    def _read_rows(self, rows, payment_attributes=None):
+        """ Runs a select made with _filter_rows and returns all its rows """
+        try:
+            return self.db.session.execute(rows).fetchall()
         except exc.SQLAlchemyError:
-            raise PaymentServiceQueryError('Could not retrieve payment items due to query error with given attributes')
+            if payment_attributes is None:
+                raise
+            # e.g. an attribute compared with a value of the wrong type
+            raise DataValidationError('Could not retrieve payment items due to query error with given attributes')
+
+    def _paginate_rows(self, rows, limit=None, after=None):
+        """
+        Orders a select of _payment_rows by id and restricts it to a single page.
+
+        Pages are addressed by the last id of the previous page (keyset pagination)
+        rather than by an offset, so every page is an index range scan on the
+        primary key no matter how deep into the results it is.
+        """
+        payment = Payment.__table__
+        if after is not None:
+            rows = rows.where(payment.c.id > after)
+        rows = rows.order_by(payment.c.id)
+        if limit is not None:
+            rows = rows.limit(limit)
+        return rows
 
 #######################
 ## UTILITY FUNCTIONS ##
 #######################
 
     def is_valid(self, new_payment, user_id=None):
-        valid = False
+        """
+        Checks a complete replacement of a payment against the strict payment schema:
+        formats of every detail, a known payment type and a card that has not expired.
+
+        :param new_payment: <dict> the replacement payload
+        :param user_id: <int> the owner of the payment being replaced, which must not change
+        :return: <bool> True if the payload is valid
+        """
+        if not isinstance(new_payment, dict):
+            return False
 
         if user_id and int(new_payment['user_id']) != user_id:
             raise DataValidationError('Error: You cannot modify the field: user_id')
@@ -172,46 +472,18 @@ class PaymentService(object):
             if key in new_payment:
                raise DataValidationError('Error: You cannot modify the field: %s' % key)
 
-        payment_type = new_payment['payment_type']
-        user_name = new_payment['details']['user_name']
-
-        if bool(re.match("^[A-Za-z\-' ]{0,50}$", user_name)):
-            
-            if payment_type == 'credit' or payment_type == 'debit':
-                card_number = new_payment['details']['card_number']
-                card_type = new_payment['details']['card_type']
-                expires = new_payment['details']['expires']
-                
-                if bool(re.match('^[0-9]{16}$', card_number)):
-                    
-                    if bool(re.match("^[A-Za-z ]{0,10}$", card_type)):
-                        
-                        if bool(re.match('^[0-9]{2}/[0-9]{4}$', expires)):
-                            month = int(expires[:2])
-                            year = int(expires[3:])
-                            
-                            if year > datetime.now().year:
-                                valid = True
-                            elif year == datetime.now().year and month >= datetime.now().month:
-                                valid = True
-
-            elif payment_type == 'paypal':
-                user_email = new_payment['details']['user_email']
-                
-                if bool(re.match('^[\W\w]+@[\W\w]+\.[A-Za-z]{2,3}$', user_email)):
-                    valid = True
-
-        return valid
-
-    def _remove_soft_deletes(self, payments):
-        """
-        Takes a list of payments and removes those payments that have been 'soft deleted,'
-        meaning the 'is_removed' field has been set to True
-
-        Maybe there's a probably a better way to do this by including requirement in db query,
-        but this will do for now
-        """
-        return [payment for payment in payments if not payment.is_removed]
+        return not PAYMENT.errors(new_payment, strict=True)
+
+    def _live_payments(self):
+        """
+        Returns a query over all payments that have not been 'soft deleted,'
+        meaning the 'is_removed' field is still False.
+
+        Every read path starts from this query so that soft deletes are filtered
+        out by the database (using the partial indexes declared in models.py)
+        instead of being loaded and thrown away in Python.
+        """
+        return self.db.session.query(Payment).filter(Payment.is_removed == False)
 
     def perform_payment_action(self, user_id, payment_attributes=None):
         """
@@ -225,72 +497,315 @@ class PaymentService(object):
 
         if payment_attributes has amount, then it is performing "charge" action.
         This would update the charge history
+
+        A PaymentServiceQueryError (the database failed, not the request) is passed on,
+        so that the client gets a 500 rather than a 400 for a request that may be retried.
         """
-        try:
-            payments = self._query_payments(payment_attributes={"user_id":user_id})
-            if 'payment_id' in payment_attributes: #for set-default action
-                payment_id_to_be_updated = payment_attributes['payment_id']
-                payment_to_be_updated = None
-                for payment in payments:
-                    if payment.id == payment_id_to_be_updated: #no need to check if is_removed = False because the query filters it
-                        payment_to_be_updated = payment
-                if payment_to_be_updated != None:
-                    payment_to_be_updated.is_default = True
-                    #making sure other payments have default as false
-                    other_payments = [payment for payment in payments if payment != payment_to_be_updated]
-                    for other_payment in other_payments:
-                        other_payment.is_default = False
-                    #Committing all changes
-                    self.db.session.commit()
-                    return True
-                else:
+        if 'payment_id' in payment_attributes: #for set-default action
+            payment_id = payment_attributes['payment_id']
+            # checked here, as the database would only fail on it with a 500
+            if not isinstance(payment_id, (int, long)) or isinstance(payment_id, bool):
+                raise DataValidationError('Invalid request: payment_id must be an integer')
+            return self._set_default_payment(user_id, payment_id)
+        elif 'amount' in payment_attributes: #for charge action
+            if self._charge_default_payment(user_id, payment_attributes['amount']):
+                return True
+            raise DataValidationError(self._charge_error(user_id))
+        else:
+            raise DataValidationError('Invalid request: The request body contains bad or missing data.')
+
+    def _set_default_payment(self, user_id, payment_id):
+        """
+        Makes payment_id the default payment of the user with two set-based UPDATEs in
+        one transaction: one clears the current default and one marks the new one.  Both
+        touch at most one row through an index, so the cost does not grow with the number
+        of payments a user has.
+
+        The unique partial index ux_payment_user_default guarantees at most one default
+        per user.  It is checked row by row, which is why the old default is cleared
+        before the new one is set rather than flipping every row in a single statement.
+        Concurrent set-defaults for the same user would trip over each other's half-done
+        change, so each transaction first takes an advisory lock on the user (released
+        when it ends) and they run one after the other.  Only a default set some other
+        way can still make the index reject ours; that is retried a few times.
+
+        :return: <bool> True if the payment is now the default, False if the user has no live payment with that id
+        """
+        payment = Payment.__table__
+        users_live_payments = and_(payment.c.user_id == user_id, payment.c.is_removed == False)
+        lock_user = select([func.pg_advisory_xact_lock(SET_DEFAULT_LOCK, user_id)])
+        clear_default = payment.update() \
+            .where(users_live_payments) \
+            .where(payment.c.is_default == True) \
+            .where(payment.c.id != payment_id) \
+            .values(is_default=False, version=payment.c.version + 1) \
+            .returning(payment.c.id)
+        set_default = payment.update() \
+            .where(users_live_payments) \
+            .where(payment.c.id == payment_id) \
+            .values(is_default=True, version=payment.c.version + 1) \
+            .returning(payment.c.id)
+
+        for attempt in range(SET_DEFAULT_ATTEMPTS):
+            try:
+                self.db.session.execute(lock_user)
+                cleared = self.db.session.execute(clear_default).fetchall()
+                if not self.db.session.execute(set_default).fetchall():
+                    self.db.session.rollback()
                     return False
-            elif 'amount' in payment_attributes: #for charge action
-                default_payment = None
-                for payment in payments:
-                    if payment.is_default == True:
-                        default_payment = payment
-                if default_payment != None:
-                    update_payment_flag = True
-
-                    if default_payment.payment_type == 'paypal' and not default_payment.details.is_linked:
-                        error_msg = 'Invalid request: Default Payment for this user_id: '+ str(user_id)+' (Paypal) is not linked.'
-                        raise DataValidationError(error_msg)
-                    elif default_payment.payment_type != 'paypal' and self.is_expired(default_payment.details.expires):
-                        error_msg = 'Invalid request: Default Payment for this user_id: '+ str(user_id)+' ('+default_payment.payment_type+') is expired'
-                        raise DataValidationError(error_msg)
-
-                    default_payment.charge_history = default_payment.charge_history + payment_attributes['amount']
-                    self.db.session.commit()
-                    return True
-                else:
-                    error_msg = 'Invalid request: Default Payment for this user_id: '+ str(user_id)+' not found. Please update the default_payment first.'
-                    raise DataValidationError(error_msg) #PaymentNotFoundError
+                self.db.session.commit()
+                self.cache.invalidate(payment_id, *[row[0] for row in cleared])
+                return True
+            except exc.IntegrityError:
+                self.db.session.rollback()
+            except exc.SQLAlchemyError:
+                self.db.session.rollback()
+                break
+        raise PaymentServiceQueryError('Could not set the default payment due to query error')
+
+    def _charge_default_payment(self, user_id, amount):
+        """
+        Records a charge of amount against the user's default payment.
+
+        This is a single INSERT ... SELECT ... RETURNING into the append-only charge
+        ledger: the payment row itself is not updated, so concurrent charges for the same
+        user neither overwrite nor wait for each other, and the payment is only charged
+        if it is still live and is either a linked paypal account or a card that has not
+        expired.
+
+        :return: <bool> True if the default payment was charged, False if nothing was inserted
+        """
+        amount_minor = self._charge_amount(amount)
+        charge = Charge.__table__
+        record = charge.insert() \
+            .from_select(['payment_id', 'amount_minor'],
+                         self._chargeable_default_payments([Payment.__table__.c.id, literal(amount_minor, BigInteger)])
+                         .where(Payment.__table__.c.user_id == user_id)) \
+            .returning(charge.c.payment_id)
+        try:
+            charged = self.db.session.execute(record).fetchall()
+            self.db.session.commit()
+        except exc.SQLAlchemyError:
+            self.db.session.rollback()
+            raise PaymentServiceQueryError('Could not charge the default payment due to query error')
+        self.cache.invalidate(*[row[0] for row in charged])
+        return len(charged) > 0
+
+    def _chargeable_default_payments(self, columns):
+        """ Returns a select of columns over the live default payments that can be charged """
+        payment = Payment.__table__
+        detail = Detail.__table__
+        return select(columns) \
+            .where(payment.c.is_default == True) \
+            .where(payment.c.is_removed == False) \
+            .where(payment.c.detail_id == detail.c.id) \
+            .where(self._chargeable(payment, detail))
+
+    def _chargeable(self, payment, detail):
+        """
+        Returns the SQL condition for a payment that can be charged: a linked
+        paypal account, or a card whose expires_at date has not passed yet (cards
+        with an invalid expiry have no expires_at and are never charged).
+        """
+        return or_(and_(payment.c.payment_type == 'paypal', detail.c.is_linked == True),
+                   and_(payment.c.payment_type != 'paypal', detail.c.expires_at >= func.current_date()))
+
+    def _charge_error(self, user_id):
+        """
+        Explains why the default payment of a user could not be charged.
+        Only runs after a failed charge, so successful charges never pay for it.
+        """
+        return self._charge_errors([user_id])[user_id]
+
+    def _charge_errors(self, user_ids):
+        """ Explains with one query why the default payments of several users could not be charged """
+        default_payments = self._live_payments() \
+            .filter(Payment.user_id.in_(user_ids)) \
+            .filter(Payment.is_default == True) \
+            .all()
+        default_payments = dict((payment.user_id, payment) for payment in default_payments)
+        errors = {}
+        for user_id in user_ids:
+            default_payment = default_payments.get(user_id)
+            if default_payment is None:
+                errors[user_id] = 'Invalid request: Default Payment for this user_id: '+ str(user_id)+' not found. Please update the default_payment first.'
+            elif default_payment.payment_type == 'paypal':
+                errors[user_id] = 'Invalid request: Default Payment for this user_id: '+ str(user_id)+' (Paypal) is not linked.'
             else:
-                raise DataValidationError('Invalid request: The request body contains bad or missing data.')
-        except PaymentServiceQueryError as e:
-            error_msg = 'Payments not found for the user_id: '+ str(user_id)
-            raise DataValidationError(error_msg) #PaymentNotFoundError
-
-    def is_expired(self, exp_date):
-        month = int(exp_date[:2]) + 1
-        exp_date = '%s%s' % (month, exp_date[2:])
-        exp_date = datetime.strptime(exp_date, '%m/%Y')
-        exp_date = exp_date - timedelta(1)
-        exp_date = datetime.date(exp_date)
-
-        now = datetime.now()
-        now = datetime.date(now)
-
-        if(now > exp_date):
-            return True
-        else:
-            return False
+                errors[user_id] = 'Invalid request: Default Payment for this user_id: '+ str(user_id)+' ('+default_payment.payment_type+') is expired'
+        return errors
+
+    def charge_payments(self, charges, chunk_size=500):
+        """
+        Bulk version of the charge action: charges the default payments of many users.
+
+        The charges are consumed chunk_size at a time.  Each chunk is applied with one
+        INSERT ... SELECT that finds every user's default payment through the (user_id,
+        is_removed, is_default) index, checks it can be charged like the single charge
+        does and writes the charges into the ledger, committed once.  Every
+        charge gets its own ledger entry, also when a user is charged more than once.
+
+        :param charges: <iterable[dict]> {'user_id': <int>, 'amount': <number>} per charge
+        :param chunk_size: <int> the number of charges applied and committed per transaction
+        :return: <list> one entry per charge, in order: True if it was charged, or the
+                 DataValidationError/PaymentServiceQueryError that kept it from being charged
+        """
+        results = []
+        chunk = []
+        for charge in charges:
+            chunk.append(charge)
+            if len(chunk) == chunk_size:
+                results.extend(self._charge_payments_chunk(chunk))
+                chunk = []
+        if chunk:
+            results.extend(self._charge_payments_chunk(chunk))
+        return results
+
+    def _charge_payments_chunk(self, charges):
+        """ Validates and applies one chunk of charges for charge_payments in a single transaction """
+        results = []
+        amounts = []
+        for charge in charges:
+            try:
+                user_id, amount_minor = self._charge_args(charge)
+            except DataValidationError as e:
+                results.append(e)
+                continue
+            results.append(user_id)
+            amounts.append((user_id, amount_minor))
+        if not amounts:
+            return results
+
+        try:
+            charged = self._charge_default_payments(amounts)
+            self.db.session.commit()
+            self.cache.invalidate(*charged.values())
+            uncharged = list(set(user_id for user_id, _ in amounts if user_id not in charged))
+            errors = self._charge_errors(uncharged) if uncharged else {}
+        except exc.SQLAlchemyError as e:
+            self.db.session.rollback()
+            error = PaymentServiceQueryError('Could not charge the default payment due to query error: %s' % e)
+            return [result if isinstance(result, Exception) else error for result in results]
+
+        return [result if isinstance(result, Exception)
+                else True if result in charged
+                else DataValidationError(errors[result])
+                for result in results]
+
+    def _charge_args(self, charge):
+        """ Reads the user_id and the amount, in minor units, of one bulk charge """
+        try:
+            user_id = charge['user_id']
+            amount = charge['amount']
+        except KeyError as e:
+            raise DataValidationError('Invalid request: charge does not have the ' + e.args[0])
+        except TypeError:
+            raise DataValidationError('Invalid request: charge contained bad or no data')
+        if not isinstance(user_id, (int, long)) or isinstance(user_id, bool):
+            raise DataValidationError('Invalid request: user_id must be an integer')
+        return user_id, self._charge_amount(amount)
+
+    def _charge_amount(self, amount):
+        """
+        Converts a charge amount to minor units.  Only positive numbers are accepted, from
+        half a cent up to MAX_AMOUNT_MINOR; anything else (a string, NaN, infinity) is refused.
+        """
+        if not isinstance(amount, (int, long, float)) or isinstance(amount, bool) \
+                or amount != amount or amount in (float('inf'), float('-inf')):
+            raise DataValidationError('Invalid request: Order amount must be a number.')
+        if amount < 0:
+            raise DataValidationError('Invalid request: Order amount is negative.')
+        if amount == 0:
+            raise DataValidationError('Invalid request: Order amount is zero.')
+        amount_minor = to_minor_units(amount)
+        if amount_minor <= 0:
+            raise DataValidationError('Invalid request: Order amount is less than one cent.')
+        if amount_minor > MAX_AMOUNT_MINOR:
+            raise DataValidationError('Invalid request: Order amount is too large.')
+        return amount_minor
+
+    def _charge_default_payments(self, amounts):
+        """
+        Records charges against the users' default payments with a single statement: like
+        the single charge, an INSERT ... SELECT into the ledger, here joining the requested
+        (user_id, amount) pairs to the chargeable default payments, so a payment that stops
+        being the default or chargeable meanwhile is not charged.
+
+        :param amounts: <list[tuple(int, int)]> (user_id, amount in minor units) per charge
+        :return: <dict> user_id -> id of the default payment that was charged
+        """
+        payment = Payment.__table__
+        charge = Charge.__table__
+        # the pairs are sent as two arrays, unnested side by side into rows
+        requested = select([
+            func.unnest(literal([user_id for user_id, _ in amounts], ARRAY(payment.c.user_id.type))).label('user_id'),
+            func.unnest(literal([amount_minor for _, amount_minor in amounts], ARRAY(BigInteger))).label('amount_minor'),
+        ]).alias('requested')
+        record = charge.insert() \
+            .from_select(['payment_id', 'amount_minor'],
+                         self._chargeable_default_payments([payment.c.id, requested.c.amount_minor])
+                         .where(payment.c.user_id == requested.c.user_id)) \
+            .returning(charge.c.payment_id) \
+            .cte('charged')
+        charged = select([payment.c.user_id, payment.c.id]).distinct() \
+            .where(payment.c.id.in_(select([record.c.payment_id])))
+        return dict((row[0], row[1]) for row in self.db.session.execute(charged))
+
+    def compact_charges(self, grace=60):
+        """
+        Folds the charges of every payment made more than grace seconds ago into the
+        payment's rollup (charge_total_minor and charge_count), so reading a payment's
+        total only has to add up the few charges made since.
+
+        Charges are stamped with the time their transaction started, so a charge still
+        being committed can carry a time before the cutoff; grace must be longer than any
+        charge transaction takes.  Only the charges since the newest compaction are read,
+        through the BRIN index on created_at.  Each payment is only updated if its rollup
+        has not been compacted by someone else in the meantime, so concurrent runs do not
+        count a charge twice.  The totals and revisions of payments do not change, so
+        cached responses stay valid.
+
+        :param grace: <float> seconds a charge is left in the ledger before it is compacted
+        :return: <int> the number of payments whose rollup was brought up to date
+        """
+        payment = Payment.__table__
+        charge = Charge.__table__
+        try:
+            cutoff, since = self.db.session.execute(
+                select([func.now() - timedelta(seconds=grace), func.max(payment.c.charges_compacted_at)])).first()
+            compacted = payment.alias('compacted')
+            pending = select([charge.c.payment_id,
+                              compacted.c.charges_compacted_at.label('compacted_from'),
+                              func.sum(charge.c.amount_minor).label('amount_minor'),
+                              func.count(charge.c.id).label('charges')]) \
+                .select_from(charge.join(compacted, compacted.c.id == charge.c.payment_id)) \
+                .where(charge.c.created_at > compacted.c.charges_compacted_at) \
+                .where(charge.c.created_at <= cutoff) \
+                .group_by(charge.c.payment_id, compacted.c.charges_compacted_at)
+            if since is not None:
+                # every charge up to the newest compaction has been folded in already
+                pending = pending.where(charge.c.created_at > since)
+            pending = pending.alias('pending')
+            compact = payment.update() \
+                .where(payment.c.id == pending.c.payment_id) \
+                .where(payment.c.charges_compacted_at == pending.c.compacted_from) \
+                .values(charge_total_minor=payment.c.charge_total_minor + pending.c.amount_minor,
+                        charge_count=payment.c.charge_count + pending.c.charges,
+                        charges_compacted_at=cutoff)
+            result = self.db.session.execute(compact)
+            self.db.session.commit()
+        except exc.SQLAlchemyError:
+            self.db.session.rollback()
+            raise PaymentServiceQueryError('Could not compact the charges due to query error')
+        return result.rowcount
 
 
 class PaymentNotFoundError(Exception):
     """ Exception when payment is not found """
 
+class PaymentVersionMismatchError(Exception):
+    """ Exception when a payment is no longer at the version an update expected """
+
 class PaymentServiceException(Exception):
     """ Generic exception class for PaymentService. """
 
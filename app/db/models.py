@@ -1,7 +1,14 @@
 
+from datetime import datetime
+from decimal import Decimal, ROUND_HALF_UP
 from flask import url_for
+from sqlalchemy import and_, cast, func, select, text, BigInteger
+from sqlalchemy.orm import column_property
 from app.db import app_db
 from app.error_handlers import DataValidationError
+from app.metrics import count_rows
+from app.validation import (CARD_DETAILS, PAYPAL_DETAILS, CARD_TYPES, PaymentValidationError,
+                            card_expiry_date, payment_errors)
 
 
 ######################################################################
@@ -16,21 +23,46 @@ class Payment(app_db.Model):
     payment_type = app_db.Column(app_db.String(10))
     is_default = app_db.Column(app_db.Boolean)
     is_removed = app_db.Column(app_db.Boolean)
-    charge_history = app_db.Column(app_db.Float)
+    # rollup of the charge ledger: the total in minor units and the number of the charges
+    # made up to charges_compacted_at; later charges are added on read (see charge_history)
+    charge_total_minor = app_db.Column(app_db.BigInteger, nullable=False, server_default='0')
+    charge_count = app_db.Column(app_db.Integer, nullable=False, server_default='0')
+    charges_compacted_at = app_db.Column(app_db.DateTime(timezone=True), nullable=False,
+                                         server_default=text("'epoch'"))
+    # bumped by every write to the payment row; ETags use revision, which also counts charges
+    version = app_db.Column(app_db.Integer, nullable=False, server_default='1')
 
     detail_id = app_db.Column(app_db.Integer, app_db.ForeignKey('detail.id'))
-    details = app_db.relationship('Detail',
+    # every serialized payment includes its details, so they are joined into the query
+    # that loads the payment instead of being read one payment at a time
+    details = app_db.relationship('Detail', lazy='joined',
         backref=app_db.backref('payment', lazy='joined'))
 
+    # ORM updates bump version and only apply if it has not changed since the payment
+    # was loaded (StaleDataError otherwise); set-based Core updates bump it explicitly
+    __mapper_args__ = {'version_id_col': version}
+
     def __init__(self):
         self.is_default = False
         self.is_removed = False
-        self.charge_history = 0.0
+        self.charge_total_minor = 0
+        self.charge_count = 0
+        self.charges_compacted_at = EPOCH
+        self.version = 1
+
+    @property
+    def charge_history(self):
+        """ The total charged to the payment so far, in major units (e.g. dollars) """
+        total = self.charge_history_minor
+        if total is None:  # not loaded from the database yet
+            total = self.charge_total_minor or 0
+        return total / float(MINOR_UNITS)
 
     def self_url(self):
-        return url_for('get_payments', id=self.id, _external=True)
+        return url_for('api.get_payments', id=self.id, _external=True)
 
     def serialize(self):
+        count_rows()
         return {
                     'payment_id' : self.id,
                     'user_id' : self.user_id,
@@ -41,68 +73,213 @@ class Payment(app_db.Model):
                     'details' : self.details.serialize()
                 }
 
+    @staticmethod
+    def serialize_row(row):
+        """
+        Returns what serialize() would for a row of PAYMENT_ROW_COLUMNS (a payment joined
+        to its details), without loading a Payment and a Detail into the session first.
+        """
+        count_rows()
+        return {
+                    'payment_id' : row.payment_id,
+                    'user_id' : row.user_id,
+                    'nickname' : row.nickname,
+                    'payment_type' : row.payment_type,
+                    'is_default' : row.is_default,
+                    'charge_history' : row.charge_history_minor / float(MINOR_UNITS),
+                    'details' : Detail.serialize_row(row)
+                }
+
     def deserialize(self, data):
-        try:
-            self.user_id = data['user_id']
-            self.nickname = data['nickname']
-            self.payment_type = data['payment_type']
-            details = data['details']
-            
-            d = Detail()
-            if (self.payment_type == 'credit' or self.payment_type == 'debit'):
-                d.deserialize_card(details)
-            else:
-                d.deserialize_paypal(details)
-            self.details = d
-        except KeyError as e:
-            raise DataValidationError('Invalid payment: missing ' + e.args[0])
-        except TypeError as e:
-            raise DataValidationError('Invalid payment: body of request contained bad or no data')
+        # checks the details too, and reports everything that is missing at once
+        errors = payment_errors(data)
+        if errors:
+            raise PaymentValidationError(errors)
+        self.user_id = data['user_id']
+        self.nickname = data['nickname']
+        self.payment_type = data['payment_type']
+
+        d = Detail()
+        if self.payment_type in CARD_TYPES:
+            d._load_card(data['details'])
+        else:
+            d._load_paypal(data['details'])
+        self.details = d
 
 class Detail(app_db.Model):
     __tablename__ = 'detail'
     id = app_db.Column(app_db.Integer, primary_key=True)
     user_name = app_db.Column(app_db.String(50))
     expires = app_db.Column(app_db.String(7))
+    # last day the card can be charged, worked out from expires on write (NULL for paypal)
+    expires_at = app_db.Column(app_db.Date)
     card_type = app_db.Column(app_db.String(10))
     card_number = app_db.Column(app_db.String(16))
     user_email = app_db.Column(app_db.String(50))
     is_linked = app_db.Column(app_db.Boolean)
 
     def serialize(self):
-        if self.is_linked is None:  #is_linked is paypal attribute
+        return Detail.serialize_row(self)
+
+    @staticmethod
+    def serialize_row(row):
+        """ Serializes a Detail, or a row with the same columns (see Payment.serialize_row) """
+        if row.is_linked is None:  #is_linked is paypal attribute
             result = {
-                        'user_name' : self.user_name,
-                        'card_type' : self.card_type,
-                        'card_number' : self.card_number,
-                        'expires' : self.expires
+                        'user_name' : row.user_name,
+                        'card_type' : row.card_type,
+                        'card_number' : row.card_number,
+                        'expires' : row.expires
                      }
         else:
             result = {
-                        'user_name' : self.user_name,
-                        'user_email' : self.user_email,
-                        'is_linked' : self.is_linked
+                        'user_name' : row.user_name,
+                        'user_email' : row.user_email,
+                        'is_linked' : row.is_linked
                      }
         return result
 
 
     def deserialize_card(self, details):
-        try:
-            self.user_name = details['user_name']
-            self.card_type = details['card_type']
-            self.card_number = details['card_number']
-            self.expires = details['expires']
-        except KeyError as e:
-            raise DataValidationError('Invalid payment: missing ' + e.args[0])
-        except TypeError as e:
-            raise DataValidationError('Invalid payment: body of request contained bad or no data')
+        CARD_DETAILS.check(details)
+        self._load_card(details)
 
     def deserialize_paypal(self, details):
-        try:
-            self.user_name = details['user_name']
-            self.user_email = details['user_email']
-            self.is_linked = True
-        except KeyError as e:
-            raise DataValidationError('Invalid payment: missing ' + e.args[0])
-        except TypeError as e:
-            raise DataValidationError('Invalid payment: body of request contained bad or no data')
+        PAYPAL_DETAILS.check(details)
+        self._load_paypal(details)
+
+    def _load_card(self, details):
+        """ Copies card details that have already been validated """
+        self.user_name = details['user_name']
+        self.card_type = details['card_type']
+        self.card_number = details['card_number']
+        self.expires = details['expires']
+        self.expires_at = card_expiry_date(self.expires)
+
+    def _load_paypal(self, details):
+        """ Copies paypal details that have already been validated """
+        self.user_name = details['user_name']
+        self.user_email = details['user_email']
+        self.is_linked = True
+
+
+class Charge(app_db.Model):
+    """
+    One charge of a payment in the charge ledger.  The ledger is append-only: charges
+    are inserted and never updated, so concurrent charges of the same payment do not
+    wait on each other, and every charge that made up a total can be audited.
+    """
+    __tablename__ = 'charge'
+    id = app_db.Column(app_db.BigInteger, primary_key=True)
+    payment_id = app_db.Column(app_db.Integer, app_db.ForeignKey('payment.id'), nullable=False)
+    # whole minor units (cents), so totals add up without rounding errors
+    amount_minor = app_db.Column(app_db.BigInteger, nullable=False)
+    created_at = app_db.Column(app_db.DateTime(timezone=True), nullable=False, server_default=func.now())
+
+
+MINOR_UNITS = 100  # minor units (cents) per major unit (dollar)
+
+# charges_compacted_at of a payment none of whose charges have been compacted yet
+EPOCH = datetime(1970, 1, 1)
+
+# the largest charge accepted, in minor units; far below the BIGINT limit, so that the
+# totals of many charges still fit
+MAX_AMOUNT_MINOR = 10 ** 15
+
+def to_minor_units(amount):
+    """ Converts an amount in major units (an int, long or float) to a whole number of minor units, rounding half up """
+    if isinstance(amount, (int, long)):
+        minor = Decimal(amount) * MINOR_UNITS
+    else:
+        # repr gives the shortest decimal that reads back as the float, e.g. 0.3 for 0.1 + 0.2
+        minor = Decimal(repr(amount)) * MINOR_UNITS
+    return int(minor.to_integral_value(rounding=ROUND_HALF_UP))
+
+
+######################################################################
+# Charge totals
+######################################################################
+
+def _pending_charges(column):
+    """
+    The correlated subquery that aggregates the charges of a payment made after its
+    rollup was last compacted: a range scan of ix_charge_payment_created that only
+    covers the charges since the last compaction, however long the ledger gets.
+    """
+    charge = Charge.__table__
+    payment = Payment.__table__
+    return select([column]) \
+        .where(charge.c.payment_id == payment.c.id) \
+        .where(charge.c.created_at > payment.c.charges_compacted_at) \
+        .correlate_except(charge) \
+        .as_scalar()
+
+# the running total in minor units: the rollup plus the charges made since it was compacted
+charge_history_minor = cast(
+    Payment.__table__.c.charge_total_minor
+    + _pending_charges(func.coalesce(func.sum(Charge.__table__.c.amount_minor), 0)), BigInteger)
+Payment.charge_history_minor = column_property(charge_history_minor)
+
+# what ETags are made of: it goes up with every write to the payment row and with every
+# charge, and compacting the rollup (which moves charges into charge_count) leaves it as is
+revision = Payment.__table__.c.version + Payment.__table__.c.charge_count \
+    + _pending_charges(func.count(Charge.__table__.c.id))
+Payment.revision = column_property(revision)
+
+
+# the columns Payment.serialize_row reads: a payment's own, its charge total and its details;
+# plus its revision, so a list's ETag comes from the same query as the list
+PAYMENT_ROW_COLUMNS = [
+    Payment.__table__.c.id.label('payment_id'),
+    Payment.__table__.c.user_id,
+    Payment.__table__.c.nickname,
+    Payment.__table__.c.payment_type,
+    Payment.__table__.c.is_default,
+    charge_history_minor.label('charge_history_minor'),
+    revision.label('revision'),
+    Detail.__table__.c.user_name,
+    Detail.__table__.c.card_type,
+    Detail.__table__.c.card_number,
+    Detail.__table__.c.expires,
+    Detail.__table__.c.user_email,
+    Detail.__table__.c.is_linked,
+]
+
+
+######################################################################
+# Indexes
+######################################################################
+
+# Partial indexes that only cover live payments.  Every PaymentService read
+# filters on is_removed = false, so these stay proportional to the number of
+# live payments no matter how many have been soft deleted.
+app_db.Index('ix_payment_live_id', Payment.id,
+             postgresql_where=(Payment.is_removed == False))
+app_db.Index('ix_payment_live_user_id', Payment.user_id,
+             postgresql_where=(Payment.is_removed == False))
+
+# Access paths for the filters the service runs: user_id for the charge and
+# set-default actions, nickname and payment_type for attribute queries (with id
+# so pages come back in order straight from the index) and detail_id for joins.
+# Index changes are rolled out with the migrations in migrations/versions.
+app_db.Index('ix_payment_user_removed_default', Payment.user_id, Payment.is_removed, Payment.is_default)
+app_db.Index('ix_payment_live_nickname', Payment.nickname, Payment.id,
+             postgresql_where=(Payment.is_removed == False))
+app_db.Index('ix_payment_live_payment_type', Payment.payment_type, Payment.id,
+             postgresql_where=(Payment.is_removed == False))
+app_db.Index('ix_payment_detail_id', Payment.detail_id)
+
+# A payment's charges by time, for its pending charges and for audits.  The BRIN
+# index on created_at lets compaction read only the newest charges; it stays tiny
+# because the ledger is append-only and so already ordered by created_at.
+app_db.Index('ix_charge_payment_created', Charge.payment_id, Charge.created_at)
+app_db.Index('ix_charge_created_at', Charge.created_at, postgresql_using='brin')
+
+# Cards by expiry date, for charges and for listing cards about to expire.
+app_db.Index('ix_detail_expires_at', Detail.expires_at,
+             postgresql_where=Detail.expires_at.isnot(None))
+
+# A user has at most one live default payment.  Set-default relies on this to
+# stay correct when two requests for the same user race each other.
+app_db.Index('ux_payment_user_default', Payment.user_id, unique=True,
+             postgresql_where=and_(Payment.is_default == True, Payment.is_removed == False))
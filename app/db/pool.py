@@ -0,0 +1,108 @@
+import time
+from threading import Lock
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+
+
+class PoolStats(object):
+    """
+    Counters of an InstrumentedQueuePool, kept in one object so that they survive
+    the pool being recreated (which SQLAlchemy does after a disconnect).
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.disconnects = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def checkout(self, waited):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+    def timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def disconnect(self):
+        with self._lock:
+            self.disconnects += 1
+
+    def as_dict(self):
+        with self._lock:
+            return {'checkouts': self.checkouts, 'timeouts': self.timeouts,
+                    'disconnects': self.disconnects,
+                    'wait_seconds_total': round(self.wait_total, 6),
+                    'wait_seconds_max': round(self.wait_max, 6)}
+
+
+class InstrumentedQueuePool(QueuePool):
+    """
+    A QueuePool that counts checkouts and times how long each one waits for a
+    connection (opening a new one included), and that can test connections on
+    checkout.
+
+    create_engine hands the pool every keyword of this constructor it is given,
+    so pre_ping is set like the other pool options (see app.db.PaymentsSQLAlchemy).
+    """
+    def __init__(self, creator, pre_ping=False, **kw):
+        """
+        :param pre_ping: <bool> run SELECT 1 on every checkout; a connection that fails it
+                         is thrown away and replaced, so requests never get one that a
+                         database restart or failover has broken
+        """
+        QueuePool.__init__(self, creator, **kw)
+        self.stats = PoolStats()
+        if pre_ping:
+            event.listen(self, 'checkout', ping_connection)
+
+    def _do_get(self):
+        started = time.time()
+        try:
+            connection = QueuePool._do_get(self)
+        except exc.TimeoutError:
+            self.stats.timeout()
+            raise
+        self.stats.checkout(time.time() - started)
+        return connection
+
+    def recreate(self):
+        # the listeners are carried over by QueuePool.recreate; the counters are not
+        pool = QueuePool.recreate(self)
+        pool.stats = self.stats
+        return pool
+
+    def status_dict(self):
+        """ Returns the pool's current occupancy and its counters since the process started """
+        status = {'size': self.size(), 'checked_in': self.checkedin(),
+                  'checked_out': self.checkedout(), 'overflow': max(self.overflow(), 0)}
+        status.update(self.stats.as_dict())
+        return status
+
+
+def ping_connection(dbapi_connection, connection_record, connection_proxy):
+    """
+    Checkout listener that tests a connection before it is handed out.  Raising
+    DisconnectionError makes the pool drop the connection and try another one.
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('SELECT 1')
+    except Exception:
+        connection_proxy._pool.stats.disconnect()
+        raise exc.DisconnectionError()
+    finally:
+        try:
+            cursor.close()
+        except Exception:
+            pass
+
+
+def pool_stats(engine):
+    """ Returns the status of the engine's pool, or None if it is not instrumented """
+    if isinstance(engine.pool, InstrumentedQueuePool):
+        return engine.pool.status_dict()
+    return None
@@ -0,0 +1,160 @@
+from json.encoder import encode_basestring_ascii
+from flask import current_app, json
+from flask_api import status
+from werkzeug.utils import import_string
+
+class RawJSON(str):
+    """
+    JSON that is already encoded, e.g. a cached response body; encoders send it as it is
+    when it is the whole body or an item of a list, rather than decoding and encoding it again.
+    """
+
+######################################################################
+# Payments
+######################################################################
+
+PAYMENT_FIELDS = frozenset(['payment_id', 'user_id', 'nickname', 'payment_type', 'is_default',
+                            'charge_history', 'details'])
+CARD_FIELDS = frozenset(['user_name', 'card_type', 'card_number', 'expires'])
+PAYPAL_FIELDS = frozenset(['user_name', 'user_email', 'is_linked'])
+
+# what json.dumps(..., sort_keys=True, separators=(',', ':')) makes of a serialized payment
+PAYMENT_TEMPLATE = '{"charge_history":%s,"details":%s,"is_default":%s,"nickname":%s,"payment_id":%s,"payment_type":%s,"user_id":%s}'
+CARD_TEMPLATE = '{"card_number":%s,"card_type":%s,"expires":%s,"user_name":%s}'
+PAYPAL_TEMPLATE = '{"is_linked":%s,"user_email":%s,"user_name":%s}'
+
+def _float(value):
+    if value != value or value in (float('inf'), float('-inf')):
+        raise ValueError('%r is not valid JSON' % value)
+    return repr(value)
+
+# how json encodes the values a payment holds; any other type is not a payment
+SCALARS = {
+    str: encode_basestring_ascii,
+    unicode: encode_basestring_ascii,
+    int: str,
+    long: str,
+    float: _float,
+    bool: lambda value: 'true' if value else 'false',
+    type(None): lambda value: 'null',
+}
+
+def encode_payment(payment):
+    """
+    Encodes a serialized payment (see Payment.serialize) by filling in a template.
+
+    :raise KeyError: or ValueError when the payment does not have the usual fields and types
+    """
+    details = payment['details']
+    if type(details) is not dict:
+        raise KeyError('details')
+    if details.viewkeys() == CARD_FIELDS:
+        details = CARD_TEMPLATE % (SCALARS[type(details['card_number'])](details['card_number']),
+                                   SCALARS[type(details['card_type'])](details['card_type']),
+                                   SCALARS[type(details['expires'])](details['expires']),
+                                   SCALARS[type(details['user_name'])](details['user_name']))
+    elif details.viewkeys() == PAYPAL_FIELDS:
+        details = PAYPAL_TEMPLATE % (SCALARS[type(details['is_linked'])](details['is_linked']),
+                                     SCALARS[type(details['user_email'])](details['user_email']),
+                                     SCALARS[type(details['user_name'])](details['user_name']))
+    else:
+        raise KeyError('details')
+    return PAYMENT_TEMPLATE % (SCALARS[type(payment['charge_history'])](payment['charge_history']),
+                               details,
+                               SCALARS[type(payment['is_default'])](payment['is_default']),
+                               SCALARS[type(payment['nickname'])](payment['nickname']),
+                               SCALARS[type(payment['payment_id'])](payment['payment_id']),
+                               SCALARS[type(payment['payment_type'])](payment['payment_type']),
+                               SCALARS[type(payment['user_id'])](payment['user_id']))
+
+def is_payment(obj):
+    return type(obj) is dict and obj.viewkeys() == PAYMENT_FIELDS
+
+######################################################################
+# Encoders
+######################################################################
+
+def flask_dumps(obj):
+    """
+    Encodes with Flask's json module and the app's settings (sorted keys, dates and so
+    on).  Compact output is written by the C encoder of the json module, or of simplejson,
+    which Flask uses instead when it is installed.
+    """
+    return json.dumps(obj, separators=(',', ':'))
+
+class Encoder(object):
+    """
+    Encodes response bodies as compact JSON with sorted keys.  A RawJSON body is sent
+    as it is.
+
+    Any object with dumps() can be used instead (see RESPONSE_ENCODER).
+    """
+    def __init__(self, dumps):
+        """
+        :param dumps: <function> encodes an object as JSON
+        """
+        self._dumps = dumps
+
+    def dumps(self, obj):
+        if isinstance(obj, RawJSON):
+            return obj
+        return self._dumps(obj)
+
+class PaymentEncoder(Encoder):
+    """
+    An Encoder with a fast path for payments and lists of payments, which make up most
+    response bodies: each payment fills in a template (see encode_payment) instead of
+    going through a general purpose encoder.  Lists may hold RawJSON payments too.
+    """
+    def dumps(self, obj):
+        if is_payment(obj):
+            return self._payment(obj)
+        if type(obj) is list and obj and all(is_payment(item) or isinstance(item, RawJSON) for item in obj):
+            return '[' + ','.join([item if isinstance(item, RawJSON) else self._payment(item) for item in obj]) + ']'
+        return super(PaymentEncoder, self).dumps(obj)
+
+    def _payment(self, payment):
+        try:
+            return encode_payment(payment)
+        except (KeyError, ValueError):
+            return self._dumps(payment)
+
+def payment_encoder(app):
+    """ Builds the PaymentEncoder, which falls back on Flask's json module """
+    return PaymentEncoder(flask_dumps)
+
+def ujson_encoder(app):
+    """
+    Builds a PaymentEncoder that falls back on ujson, a C encoder faster than the json
+    module but less strict: objects it does not know are written as {} and dates as
+    timestamps instead of failing or being written as Flask's HTTP dates, and floats
+    get at most 15 significant digits.  Only use it while response bodies are made of
+    plain JSON types.
+    """
+    import ujson
+
+    def dumps(obj):
+        return ujson.dumps(obj, ensure_ascii=True, sort_keys=True, escape_forward_slashes=False,
+                           double_precision=15)
+    return PaymentEncoder(dumps)
+
+def flask_encoder(app):
+    """ Builds an Encoder that only uses Flask's json module """
+    return Encoder(flask_dumps)
+
+######################################################################
+# Responses
+######################################################################
+
+def dumps(obj):
+    """ Encodes obj with the application's encoder """
+    return current_app.extensions['encoding'].dumps(obj)
+
+def json_response(data, code=status.HTTP_200_OK):
+    """ Returns a response with data encoded as JSON by the application's encoder """
+    return current_app.response_class(dumps(data), status=code, mimetype='application/json')
+
+
+def init_app(app):
+    """ Gives the application the encoder named by RESPONSE_ENCODER """
+    app.extensions['encoding'] = import_string(app.config['RESPONSE_ENCODER'])(app)
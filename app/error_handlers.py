@@ -1,6 +1,5 @@
-from flask import jsonify, make_response
 from flask_api import status    # HTTP Status Codes
-from app import app
+from app.encoding import json_response
 
 ######################################################################
 # Custom Exceptions
@@ -12,22 +11,25 @@ class DataValidationError(ValueError):
 # ERROR Handling
 ######################################################################
 
-@app.errorhandler(DataValidationError)
 def request_validation_error(e):
-    return make_response(jsonify(status=400, error='Bad Request', message=e.message), status.HTTP_400_BAD_REQUEST)
+    return json_response(dict(status=400, error='Bad Request', message=e.message), status.HTTP_400_BAD_REQUEST)
 
-@app.errorhandler(404)
 def not_found(e):
-    return make_response(jsonify(status=404, error='Not Found', message=e.description), status.HTTP_404_NOT_FOUND)
+    return json_response(dict(status=404, error='Not Found', message=e.description), status.HTTP_404_NOT_FOUND)
 
-@app.errorhandler(400)
 def bad_request(e):
-    return make_response(jsonify(status=400, error='Bad Request', message=e.message), status.HTTP_400_BAD_REQUEST)
+    return json_response(dict(status=400, error='Bad Request', message=e.message), status.HTTP_400_BAD_REQUEST)
 
-@app.errorhandler(405)
 def method_not_allowed(e):
-    return make_response(jsonify(status=405, error='Method not Allowed', message='Your request method is not supported. Check your HTTP method and try again.'), status.HTTP_405_METHOD_NOT_ALLOWED)
+    return json_response(dict(status=405, error='Method not Allowed', message='Your request method is not supported. Check your HTTP method and try again.'), status.HTTP_405_METHOD_NOT_ALLOWED)
 
-@app.errorhandler(500)
 def internal_error(e):
-	return make_response(jsonify(status=500, error='Internal Server Error', message='Well, this is embarrassing...'), status.HTTP_500_INTERNAL_SERVER_ERROR)
\ No newline at end of file
+    return json_response(dict(status=500, error='Internal Server Error', message='Well, this is embarrassing...'), status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+def init_app(app):
+    """ Registers the error handlers with the application """
+    app.register_error_handler(DataValidationError, request_validation_error)
+    app.register_error_handler(404, not_found)
+    app.register_error_handler(400, bad_request)
+    app.register_error_handler(405, method_not_allowed)
+    app.register_error_handler(500, internal_error)
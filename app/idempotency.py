@@ -0,0 +1,156 @@
+import hashlib
+from functools import wraps
+from threading import Lock
+from flask import Response, current_app, make_response, request
+from flask_api import status
+from werkzeug.utils import import_string
+
+from app.cache import LRUCache
+from app.encoding import json_response
+from app.error_handlers import DataValidationError
+
+# Request header naming a client's attempt at a request; retries of the attempt send the same key
+HEADER = 'Idempotency-Key'
+# Response header set on responses replayed from the store
+REPLAYED_HEADER = 'Idempotent-Replayed'
+MAX_KEY_LENGTH = 255
+
+######################################################################
+# Stores
+######################################################################
+
+class MemoryStore(object):
+    """
+    Keeps the responses of keyed requests in an LRUCache of this process.
+
+    Any object with the same four methods and stats() can be used instead, e.g. one
+    shared by every worker and instance through a key-value service, so that a retry
+    which reaches another process is answered too (see IDEMPOTENCY_STORE).
+    """
+    def __init__(self, max_size, ttl):
+        """
+        :param max_size: <int> the most keys kept; the least recently used go first
+        :param ttl: <float> seconds a key, and the response stored under it, is kept
+        """
+        self.cache = LRUCache(max_size, ttl)
+
+    def get(self, key):
+        """ Returns the value stored under key, or None """
+        return self.cache.get(key)
+
+    def add(self, key, value):
+        """ Stores value under key if nothing is stored there yet; returns True if it did """
+        return self.cache.add(key, value)
+
+    def set(self, key, value):
+        """ Stores value under key, replacing what is there """
+        self.cache.set(key, value)
+
+    def delete(self, key):
+        """ Drops what is stored under key """
+        self.cache.invalidate(key)
+
+    def stats(self):
+        """ Returns the size, limits and counters of the cache """
+        return self.cache.stats()
+
+def memory_store(app):
+    """ Builds the MemoryStore sized by IDEMPOTENCY_MAX_KEYS and IDEMPOTENCY_TTL """
+    return MemoryStore(app.config['IDEMPOTENCY_MAX_KEYS'], app.config['IDEMPOTENCY_TTL'])
+
+######################################################################
+# Replaying responses
+######################################################################
+
+class Idempotency(object):
+    """
+    Answers retries of a request made with an Idempotency-Key with the response of its
+    first attempt, without running the view (and so without touching any payment) again.
+
+    Under each key the store holds (fingerprint of the request body, response), where
+    the response is None while the first attempt is still being served.
+    """
+    def __init__(self, store):
+        self.store = store
+        self._lock = Lock()
+        self.requests = 0
+        self.replays = 0
+        self.conflicts = 0
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def dispatch(self, view, key, args, kwargs):
+        """ Runs the view for the first attempt under key and replays its response afterwards """
+        self._count('requests')
+        # keys are the client's, so they only identify an attempt at one method and URL
+        key = '%s %s %s' % (request.method, request.path, key)
+        fingerprint = hashlib.sha1(request.get_data()).hexdigest()
+
+        entry = self.store.get(key)
+        if entry is None and not self.store.add(key, (fingerprint, None)):
+            # another thread or process has just started on the same key
+            entry = self.store.get(key)
+        if entry is not None:
+            return self.replay(entry, fingerprint)
+
+        try:
+            response = make_response(view(*args, **kwargs))
+        except Exception:
+            self.store.delete(key)
+            raise
+        if response.status_code >= 500:
+            # the attempt failed on our side; let the client retry it for real
+            self.store.delete(key)
+        else:
+            self.store.set(key, (fingerprint, (response.get_data(), response.status_code, response.mimetype)))
+        return response
+
+    def replay(self, entry, fingerprint):
+        stored_fingerprint, stored = entry
+        if stored_fingerprint != fingerprint:
+            self._count('conflicts')
+            message = {'error': 'Invalid request: this %s was used with a different request body' % HEADER}
+            return json_response(message, status.HTTP_400_BAD_REQUEST)
+        if stored is None:
+            self._count('conflicts')
+            message = {'error': 'A request with this %s is still being processed' % HEADER}
+            return json_response(message, status.HTTP_409_CONFLICT)
+
+        self._count('replays')
+        body, code, mimetype = stored
+        response = Response(body, status=code, mimetype=mimetype)
+        response.headers[REPLAYED_HEADER] = 'true'
+        return response
+
+    def stats(self):
+        """ Returns the store's size and counters, and the share of keyed requests that were replays """
+        stats = self.store.stats()
+        with self._lock:
+            stats.update(requests=self.requests, replays=self.replays, conflicts=self.conflicts,
+                         hit_rate=round(float(self.replays) / self.requests, 4) if self.requests else 0.0)
+        return stats
+
+
+def idempotent(view):
+    """
+    Lets clients retry the view safely: requests sent with an Idempotency-Key header are
+    only served once, and retries with the same key and body get the first response.
+    Requests without the header are served as usual.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get(HEADER)
+        if key is None:
+            return view(*args, **kwargs)
+        if not key or len(key) > MAX_KEY_LENGTH:
+            raise DataValidationError('Invalid request: %s must be 1 to %d characters' % (HEADER, MAX_KEY_LENGTH))
+        return current_app.extensions['idempotency'].dispatch(view, key, args, kwargs)
+    return wrapper
+
+
+def init_app(app):
+    """ Gives the application the store named by IDEMPOTENCY_STORE """
+    store = import_string(app.config['IDEMPOTENCY_STORE'])(app)
+    app.extensions['idempotency'] = Idempotency(store)
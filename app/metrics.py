@@ -0,0 +1,394 @@
+import bisect, glob, json, os, tempfile, threading, time
+from threading import Lock
+from flask import Response, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Upper bounds of the histogram buckets; every histogram also has a +Inf bucket
+SECONDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+ROWS = (0, 1, 10, 100, 1000, 10000)
+STATEMENTS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+REQUEST_SECONDS = 'payments_http_request_duration_seconds'
+IN_FLIGHT = 'payments_http_requests_in_flight'
+DB_SECONDS = 'payments_db_duration_seconds'
+DB_STATEMENTS = 'payments_db_statements'
+DB_ROWS = 'payments_db_rows_fetched'
+REPEATED = 'payments_db_repeated_statement_requests_total'
+ROWS_SERIALIZED = 'payments_rows_serialized'
+
+# name -> (type, help, buckets of a histogram)
+METRICS = {
+    REQUEST_SECONDS: ('histogram', 'Seconds taken to serve a request', SECONDS),
+    IN_FLIGHT: ('gauge', 'Requests being served', None),
+    DB_SECONDS: ('histogram', 'Seconds a request spent running database queries', SECONDS),
+    DB_STATEMENTS: ('histogram', 'Statements a request sent to the database', STATEMENTS),
+    DB_ROWS: ('histogram', 'Rows a request read from the database', ROWS),
+    REPEATED: ('counter', 'Requests that ran one statement more than SQL_REPEAT_THRESHOLD times', None),
+    ROWS_SERIALIZED: ('histogram', 'Payments serialized by a request', ROWS),
+    'payments_cache_entries': ('gauge', 'Payment responses held in the cache', None),
+    'payments_cache_hits_total': ('counter', 'Payment cache lookups answered from the cache', None),
+    'payments_cache_misses_total': ('counter', 'Payment cache lookups that went to the database', None),
+    'payments_cache_evictions_total': ('counter', 'Payment responses evicted to make room', None),
+    'payments_idempotency_keys': ('gauge', 'Idempotency keys held in the store', None),
+    'payments_idempotency_requests_total': ('counter', 'Requests sent with an Idempotency-Key', None),
+    'payments_idempotency_replays_total': ('counter', 'Requests answered with a stored response', None),
+    'payments_idempotency_conflicts_total': ('counter', 'Requests whose key was in use or reused with another body', None),
+    'payments_db_pool_checked_out': ('gauge', 'Database connections in use', None),
+    'payments_db_pool_checkouts_total': ('counter', 'Database connections handed out', None),
+    'payments_db_pool_timeouts_total': ('counter', 'Waits for a database connection that timed out', None),
+    'payments_db_pool_wait_seconds_total': ('counter', 'Seconds spent waiting for database connections', None),
+}
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+######################################################################
+# Recording
+######################################################################
+
+def labels(**values):
+    """ Renders label values the way they appear in the exposition format, e.g. method="GET",route="/payments" """
+    return ','.join('%s="%s"' % (name, str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"'))
+                    for name, value in sorted(values.items()))
+
+# labels of requests, remembered: there are only so many routes, methods and statuses
+_series = {}
+METHODS = frozenset(('GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'))
+
+def request_labels(route, method=None, code=None):
+    """ labels() of a request; any method a client makes up is labelled 'other' """
+    key = (route, method, code)
+    series = _series.get(key)
+    if series is None:
+        values = {'route': route}
+        if method is not None:
+            values['method'] = method if method in METHODS else 'other'
+        if code is not None:
+            values['status'] = code
+        series = _series[key] = labels(**values)
+    return series
+
+class Registry(object):
+    """
+    The metrics of one process: histograms, counters and gauges, each a dict of label
+    string -> value.  A histogram's value is a list of its observations per bucket
+    (not cumulative, the +Inf bucket last) followed by their sum.
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def _observe(self, name, series, value):
+        # callers hold the lock
+        bounds = METRICS[name][2]
+        values = self.histograms.setdefault(name, {}).get(series)
+        if values is None:
+            values = self.histograms[name][series] = [0] * (len(bounds) + 2)
+        values[bisect.bisect_left(bounds, value)] += 1
+        values[-1] += value
+
+    def request_started(self, route):
+        series = request_labels(route)
+        with self._lock:
+            gauge = self.gauges.setdefault(IN_FLIGHT, {})
+            gauge[series] = gauge.get(series, 0) + 1
+
+    def request_finished(self, current, seconds, repeated=False):
+        """
+        Records everything about a request under one acquisition of the lock.
+
+        :param current: <RequestStats> what the request did
+        :param seconds: <float> how long it took
+        :param repeated: <bool> whether it ran a statement too many times
+        """
+        route, method = current.route, current.method
+        series = request_labels(route, method)
+        with self._lock:
+            self.gauges[IN_FLIGHT][request_labels(route)] -= 1
+            self._observe(REQUEST_SECONDS, request_labels(route, method, current.status), seconds)
+            self._observe(DB_SECONDS, series, current.db_seconds)
+            self._observe(DB_STATEMENTS, series, current.statements)
+            self._observe(DB_ROWS, series, current.rows_fetched)
+            self._observe(ROWS_SERIALIZED, series, current.rows)
+            if repeated:
+                counter = self.counters.setdefault(REPEATED, {})
+                counter[series] = counter.get(series, 0) + 1
+
+    def snapshot(self):
+        """ Returns a copy of every metric, as a dict that can be encoded as JSON """
+        with self._lock:
+            return {'histograms': dict((name, dict((series, list(values)) for series, values in metrics.items()))
+                                       for name, metrics in self.histograms.items()),
+                    'counters': dict((name, dict(metrics)) for name, metrics in self.counters.items()),
+                    'gauges': dict((name, dict(metrics)) for name, metrics in self.gauges.items())}
+
+
+class RequestStats(threading.local):
+    """ What the request being served on this thread has done so far """
+    def __init__(self):
+        self.reset(None, None)
+        self.started = None  # not serving a request
+
+    def reset(self, route, method):
+        """ Starts accounting for a new request """
+        self.route = route
+        self.method = method
+        self.status = 500
+        self.db_seconds = 0.0
+        self.statements = 0
+        self.rows_fetched = 0
+        # statement text -> times run; the text has placeholders rather than values, so
+        # the same query for another payment has the same shape
+        self.shapes = {}
+        self.rows = 0
+        self.started = time.time()
+
+    def most_repeated(self):
+        """ Returns (times, statement) of the statement this request ran most often """
+        if not self.shapes:
+            return 0, None
+        statement = max(self.shapes, key=self.shapes.get)
+        return self.shapes[statement], statement
+
+_current = RequestStats()
+
+def count_rows(rows=1):
+    """ Counts payments serialized for the current request """
+    _current.rows += rows
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _query_started(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._metrics_started = time.time()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _query_finished(conn, cursor, statement, parameters, context, executemany):
+    current = _current
+    if current.started is None:
+        return  # not serving a request, e.g. a CLI command or the metrics flusher
+    if context is not None:
+        current.db_seconds += time.time() - context._metrics_started
+    current.statements += 1
+    current.shapes[statement] = current.shapes.get(statement, 0) + 1
+    # a statement that returns rows has a description; server-side cursors count -1 until read
+    if cursor.description is not None and cursor.rowcount > 0:
+        current.rows_fetched += cursor.rowcount
+
+######################################################################
+# Exporting
+######################################################################
+
+def merge(snapshots):
+    """ Adds up the snapshots of several processes """
+    merged = {'histograms': {}, 'counters': {}, 'gauges': {}}
+    for snapshot in snapshots:
+        for name, metrics in snapshot.get('histograms', {}).items():
+            into = merged['histograms'].setdefault(name, {})
+            for series, values in metrics.items():
+                into[series] = [a + b for a, b in zip(into[series], values)] if series in into else list(values)
+        for kind in ('counters', 'gauges'):
+            for name, metrics in snapshot.get(kind, {}).items():
+                into = merged[kind].setdefault(name, {})
+                for series, value in metrics.items():
+                    into[series] = into.get(series, 0) + value
+    return merged
+
+def sample(name, series, value):
+    """ One line of the exposition format """
+    return '%s{%s} %s' % (name, series, value) if series else '%s %s' % (name, value)
+
+def render(snapshot):
+    """ Writes a snapshot in the Prometheus text exposition format """
+    lines = []
+    for kind in ('histograms', 'counters', 'gauges'):
+        for name in sorted(snapshot[kind]):
+            kind_name, help, bounds = METRICS[name]
+            lines += ['# HELP %s %s' % (name, help), '# TYPE %s %s' % (name, kind_name)]
+            for series, value in sorted(snapshot[kind][name].items()):
+                if kind != 'histograms':
+                    lines.append(sample(name, series, value))
+                    continue
+                prefix = series + ',' if series else ''
+                count = 0
+                for bound, observed in zip(bounds + ('+Inf',), value):
+                    count += observed
+                    lines.append('%s_bucket{%sle="%s"} %d' % (name, prefix, bound, count))
+                lines.append(sample(name + '_sum', series, value[-1]))
+                lines.append(sample(name + '_count', series, count))
+    return '\n'.join(lines) + '\n'
+
+
+class Metrics(object):
+    """
+    Measures every request of an application and serves the results at /metrics.
+
+    Under gunicorn each worker process has its own Registry.  When a directory is
+    set, every worker writes a snapshot of its registry there each flush interval
+    (from a thread of its own, not while serving a request), and /metrics adds up
+    the snapshots of all the workers.  A worker that exits is folded into an
+    archive, so its counters are kept and its gauges dropped.
+    """
+    def __init__(self, app):
+        """
+        :param app: <Flask> the application, whose METRICS_DIR, METRICS_FLUSH_INTERVAL and
+                    SQL_REPEAT_THRESHOLD are used
+        """
+        self.app = app
+        self.repeat_threshold = app.config['SQL_REPEAT_THRESHOLD']
+        self.registry = Registry()
+        self.directory = app.config['METRICS_DIR'] or None
+        self.interval = app.config['METRICS_FLUSH_INTERVAL']
+        self._flusher = None
+        self._flusher_lock = Lock()
+
+    def collect(self):
+        """ Returns a snapshot of the registry plus the counters of the caches and the connection pool """
+        snapshot = self.registry.snapshot()
+        with self.app.app_context():
+            for kind, name, value in collect_stats(self.app):
+                snapshot[kind].setdefault(name, {})[''] = value
+        return snapshot
+
+    def _path(self, name):
+        return os.path.join(self.directory, '%s.json' % name)
+
+    def _write(self, name, snapshot):
+        # write then rename, so readers never see half a file
+        handle, path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(handle, 'w') as snapshot_file:
+            json.dump(snapshot, snapshot_file)
+        os.rename(path, self._path(name))
+
+    def _read(self, path):
+        try:
+            with open(path) as snapshot_file:
+                return json.load(snapshot_file)
+        except (IOError, ValueError):
+            return None
+
+    def flush(self):
+        """ Writes this process's snapshot to the directory """
+        if self.directory is not None:
+            self._write(os.getpid(), self.collect())
+
+    def start_flusher(self):
+        """ Starts the thread that flushes this process's metrics, once per process """
+        if self.directory is None or self._flusher == os.getpid():
+            return
+        with self._flusher_lock:
+            if self._flusher == os.getpid():
+                return
+            self._flusher = os.getpid()
+            thread = threading.Thread(target=self._flush_forever, name='metrics-flusher')
+            thread.daemon = True
+            thread.start()
+
+    def _flush_forever(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def export(self):
+        """ Returns the metrics of every process, added up, in the exposition format """
+        if self.directory is None:
+            return render(self.collect())
+        self.flush()
+        snapshots = [self._read(path) for path in glob.glob(os.path.join(self.directory, '*.json'))]
+        return render(merge([snapshot for snapshot in snapshots if snapshot]))
+
+    def archive(self, pid):
+        """ Folds the last snapshot of an exited process into the archive, without its gauges """
+        if self.directory is None:
+            return
+        path = self._path(pid)
+        snapshot = self._read(path)
+        if snapshot:
+            snapshot['gauges'] = {}
+            self._write('archive', merge([self._read(self._path('archive')) or {}, snapshot]))
+        if os.path.exists(path):
+            os.remove(path)
+
+    def reset(self):
+        """ Removes the snapshots left in the directory by an earlier run """
+        if self.directory is not None:
+            for path in glob.glob(os.path.join(self.directory, '*.json')):
+                os.remove(path)
+
+    def before_request(self):
+        self.start_flusher()
+        current = _current
+        # one look through the request proxy rather than one per attribute
+        current_request = request._get_current_object()
+        rule = current_request.url_rule
+        current.reset(rule.rule if rule is not None else 'unmatched', current_request.method)
+        self.registry.request_started(current.route)
+
+    def after_request(self, response):
+        current = _current
+        current.status = response.status_code
+        if self.app.debug:
+            # what the request has done so far; a streamed body is read after this
+            response.headers['X-DB-Statements'] = str(current.statements)
+            response.headers['X-DB-Time'] = '%.3fms' % (1000 * current.db_seconds)
+            response.headers['X-DB-Rows-Fetched'] = str(current.rows_fetched)
+            times, statement = current.most_repeated()
+            if times > self.repeat_threshold:
+                response.headers['X-DB-Repeated-Statement'] = str(times)
+        return response
+
+    def teardown_request(self, exception):
+        # runs once the whole response, streamed ones included, has been produced
+        current = _current
+        if current.started is None:
+            return
+        seconds = time.time() - current.started
+        current.started = None
+        times, statement = current.most_repeated()
+        repeated = times > self.repeat_threshold
+        if repeated:
+            # usually a relationship loaded once per row (N+1) rather than with its parents
+            self.app.logger.warning('%s %s ran the same statement %d times: %s',
+                                    current.method, current.route, times, ' '.join(statement.split()))
+        self.registry.request_finished(current, seconds, repeated)
+
+
+def collect_stats(app):
+    """ Returns (kind, name, value) of the payment cache, the idempotency store and the connection pool """
+    from app.db import app_db
+    from app.db.pool import pool_stats
+    from app.payments import payment_service
+
+    cache = payment_service.cache.stats()
+    stats = [('gauges', 'payments_cache_entries', cache['size']),
+             ('counters', 'payments_cache_hits_total', cache['hits']),
+             ('counters', 'payments_cache_misses_total', cache['misses']),
+             ('counters', 'payments_cache_evictions_total', cache['evictions'])]
+    if 'idempotency' in app.extensions:
+        idempotency = app.extensions['idempotency'].stats()
+        stats += [('gauges', 'payments_idempotency_keys', idempotency['size']),
+                  ('counters', 'payments_idempotency_requests_total', idempotency['requests']),
+                  ('counters', 'payments_idempotency_replays_total', idempotency['replays']),
+                  ('counters', 'payments_idempotency_conflicts_total', idempotency['conflicts'])]
+    if app.config.get('SQLALCHEMY_DATABASE_URI'):
+        pool = pool_stats(app_db.engine)
+        if pool is not None:
+            stats += [('gauges', 'payments_db_pool_checked_out', pool['checked_out']),
+                      ('counters', 'payments_db_pool_checkouts_total', pool['checkouts']),
+                      ('counters', 'payments_db_pool_timeouts_total', pool['timeouts']),
+                      ('counters', 'payments_db_pool_wait_seconds_total', pool['wait_seconds_total'])]
+    return stats
+
+
+def init_app(app):
+    """ Measures the application's requests and adds the /metrics endpoint """
+    metrics = Metrics(app)
+    app.extensions['metrics'] = metrics
+    app.before_request(metrics.before_request)
+    app.after_request(metrics.after_request)
+    app.teardown_request(metrics.teardown_request)
+
+    def export():
+        return Response(metrics.export(), content_type=CONTENT_TYPE)
+    app.add_url_rule('/metrics', 'metrics', export)
@@ -1,69 +1,150 @@
-from flask import jsonify, request, make_response, url_for
+import base64, binascii, hashlib
+from itertools import islice
+from datetime import datetime
+from flask import Blueprint, current_app, json, request, url_for, Response, stream_with_context
 from flask_api import status
-from flasgger.utils import swag_from
-from app import app
-from app.db.interface import PaymentService,PaymentNotFoundError
+from app.apidocs import swag_from
+from app.encoding import RawJSON, dumps, json_response
+from app.idempotency import idempotent
+from app.db import app_db
+from app.db.interface import PaymentService,PaymentNotFoundError,PaymentVersionMismatchError
+from app.db.pool import pool_stats
 
 from app.error_handlers import DataValidationError
 
-# Instantiate persistence service to be used in CRUD methods
+# The routes, registered with the application by create_app
+api = Blueprint('api', __name__)
+
+# Instantiate persistence service to be used in CRUD methods (configured by create_app)
 payment_service = PaymentService()
 
 # Error bodies
 NOT_FOUND_ERROR_BODY = {'error': 'Payment with id {} could not be found'}
 GENERAL_NOT_FOUND_ERROR = {'error': 'Requested resource(s) could not be found'}
+BATCH_ITEM_ERROR = 'Could not be processed due to an internal error; it may be retried'
+
+# Query parameters used for paging rather than for filtering payments
+PAGINATION_ARGS = ('limit', 'after')
+
+# Content type of streamed list responses: one JSON encoded payment per line
+NDJSON_MIMETYPE = 'application/x-ndjson'
 
 ######################################################################
 # GET INDEX
 ######################################################################
-@app.route('/')
+@api.route('/')
 def index():
-    return jsonify(name='Payments REST API Service',
-                   version='1.0',
-                   docs=request.base_url + 'apidocs/index.html',
-                   site=request.base_url + 'payments'), status.HTTP_200_OK
+    return json_response(dict(name='Payments REST API Service',
+                              version='1.0',
+                              docs=request.base_url + 'apidocs/index.html',
+                              site=request.base_url + 'payments'))
 
 ######################################################################
 # LIST ALL PAYMENTS
 ######################################################################
-@app.route('/payments', methods=['GET'])
+@api.route('/payments', methods=['GET'])
 @swag_from('documentation/list_payments.yaml')
 def list_payments():
     request_args = request.args
+    # a bad limit or cursor is the client's fault, so let the DataValidationError handler answer 400
+    limit, after = get_page_args(request_args)
 
-    try:
-        if 'ids' in request_args:
-            # just retrieve a list of payments where each payment corresponds to one of the ids
-            ids = request_args.getlist('ids', type=int)
-            results = payment_service.get_payments(payment_ids=ids)
-
-        elif request_args:
-            # if there is anything else in the request args, query by those parameters;
-            # flask puts the request_args into a proprietary data structure called ImmutableMultiDict
-            # this cast allows us to make a simple dictionary where each query param is a key and the
-            # value is a list that contains the value(s) of that query parameter
-            request_args = dict(request_args)
-            for key in request_args:
-                request_args[key] = request_args[key][0]
-            results = payment_service.get_payments(payment_attributes=request_args)
+    if 'ids' in request_args:
+        # just retrieve a list of payments where each payment corresponds to one of the ids
+        query = {'payment_ids': request_args.getlist('ids', type=int)}
 
-        else:
-            # if no request args are present, simply return all payments
-            results = payment_service.get_payments()
+    elif [key for key in request_args if key not in PAGINATION_ARGS]:
+        # if there is anything else in the request args, query by those parameters;
+        # flask puts the request_args into a proprietary data structure called ImmutableMultiDict
+        # this cast allows us to make a simple dictionary where each query param is a key and the
+        # value is a list that contains the value(s) of that query parameter
+        request_args = dict(request_args)
+        for key in PAGINATION_ARGS:
+            request_args.pop(key, None)
+        for key in request_args:
+            request_args[key] = request_args[key][0]
+        query = {'payment_attributes': request_args}
+
+    else:
+        # if no request args are present, simply return all payments (one page at a time)
+        query = {}
 
-        return make_response(jsonify(results), status.HTTP_200_OK)
+    if wants_ndjson():
+        return stream_payments(query, after)
+
+    try:
+        if request.if_none_match:
+            # the page's ids and versions are enough to answer If-None-Match without loading it
+            versions = payment_service.get_payment_versions(limit=limit + 1, after=after, **query)
+            etag = page_etag(versions, limit)
+            if versions and request.if_none_match.contains_weak(etag):
+                return not_modified(etag)
+
+        # ask for one payment more than the page holds to find out whether there is a next page
+        results, versions = payment_service.get_payments(limit=limit + 1, after=after, with_versions=True, **query)
+        response = page_response(results, limit)
+        response.set_etag(page_etag(versions, limit))
+        return response
 
     except Exception:
         # we will want to make more specific exception handling later in order to differentiate
         # the case in which it's a 404 and the case where it's a 400 - we'll assume for now that
         # the client makes good requests for resources that may or may not exist
-        return make_response(jsonify(GENERAL_NOT_FOUND_ERROR), status.HTTP_404_NOT_FOUND)
+        return json_response(GENERAL_NOT_FOUND_ERROR, status.HTTP_404_NOT_FOUND)
+
+def stream_payments(query, after):
+    """
+    Streams every payment matching the query as newline delimited JSON.
+
+    Pages do not apply here: the payments are read from a server-side cursor and
+    each one is encoded and sent as soon as it is read, so exports of any size
+    start right away and never hold more than one batch of rows in memory.
+    """
+    try:
+        payments = payment_service.stream_payments(after=after,
+                                                   batch_size=current_app.config['STREAM_BATCH_SIZE'],
+                                                   **query)
+        # read the first payment before answering so a failing query still gets a 404
+        first = next(payments)
+    except Exception:
+        return json_response(GENERAL_NOT_FOUND_ERROR, status.HTTP_404_NOT_FOUND)
+
+    def generate():
+        yield dumps(first) + '\n'
+        for payment in payments:
+            yield dumps(payment) + '\n'
+
+    return Response(stream_with_context(generate()), status=status.HTTP_200_OK,
+                    mimetype=NDJSON_MIMETYPE)
+
+######################################################################
+# LIST PAYMENTS WITH EXPIRING CARDS
+######################################################################
+@api.route('/payments/expiring', methods=['GET'])
+@swag_from('documentation/list_expiring_payments.yaml')
+def list_expiring_payments():
+    before = get_date_arg(request.args, 'before')
+    limit, after = get_page_args(request.args)
+
+    # ask for one payment more than the page holds to find out whether there is a next page
+    results = payment_service.get_expiring_payments(before, limit=limit + 1, after=after)
+    return page_response(results, limit)
+
+def get_date_arg(request_args, name):
+    """ Reads a required YYYY-MM-DD query parameter """
+    if name not in request_args:
+        raise DataValidationError('Invalid request: %s is required (YYYY-MM-DD)' % name)
+    try:
+        return datetime.strptime(request_args[name], '%Y-%m-%d').date()
+    except ValueError:
+        raise DataValidationError('Invalid request: %s must be a date (YYYY-MM-DD)' % name)
 
 ######################################################################
 # CREATE PAYMENT
 ######################################################################
-@app.route('/payments', methods=['POST'])
+@api.route('/payments', methods=['POST'])
 @swag_from('documentation/create_payment.yaml')
+@idempotent
 def create_payment():
     data = request.get_json(silent=True)
     try:
@@ -73,13 +154,84 @@ def create_payment():
     except DataValidationError as e:
         message = {"error" : e.message}
         rc = status.HTTP_400_BAD_REQUEST
-    return make_response(jsonify(message), rc)
+    return json_response(message, rc)
+
+######################################################################
+# CREATE PAYMENTS IN BULK
+######################################################################
+@api.route('/payments/batch', methods=['POST'])
+@swag_from('documentation/create_payments_batch.yaml')
+def create_payments_batch():
+    chunk_size = current_app.config['BATCH_CHUNK_SIZE']
+    max_size = current_app.config['BATCH_MAX_SIZE']
+    if request.mimetype == NDJSON_MIMETYPE:
+        return stream_payments_batch(chunk_size, max_size)
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, list):
+        raise DataValidationError('Invalid request: body of request must be a JSON array of payments')
+    if len(data) > max_size:
+        raise DataValidationError('Invalid request: a batch may hold at most %d payments' % max_size)
+
+    results = [created_result(index, result)
+               for index, result in enumerate(payment_service.add_payments(data, chunk_size=chunk_size))]
+    created = len([result for result in results if 'created' in result])
+    message = {'created': created, 'failed': len(results) - created, 'results': results}
+    return json_response(message, status.HTTP_200_OK)
+
+def stream_payments_batch(chunk_size, max_size):
+    """
+    Creates the payments of an NDJSON body, one per line, and streams back one line of
+    NDJSON per payment holding its result (the results of a JSON array batch).
+
+    The body is read, validated and written a chunk at a time, and the results of each
+    chunk are sent once it is committed, so neither the upload nor the results are ever
+    held in memory as a whole.  Only the first max_size lines are read: when there are
+    more, the last result is a 400 for the first line left out, and none of the rest
+    are created.
+    """
+    lines = (line for line in request.stream if line.strip())
+    data = (parse_ndjson_line(line) for line in islice(lines, max_size))
+
+    def generate():
+        for index, result in enumerate(payment_service.iter_add_payments(data, chunk_size=chunk_size)):
+            yield dumps(created_result(index, result)) + '\n'
+        if next(lines, None) is not None:
+            yield dumps({'index': max_size, 'status': status.HTTP_400_BAD_REQUEST,
+                         'error': 'Invalid request: a batch may hold at most %d payments' % max_size}) + '\n'
+
+    return Response(stream_with_context(generate()), status=status.HTTP_200_OK,
+                    mimetype=NDJSON_MIMETYPE)
+
+def created_result(index, result):
+    """ The result of one item of a payments batch: the created payment, or why it was not created """
+    if isinstance(result, Exception):
+        return failed_result(index, result)
+    return {'index': index, 'status': status.HTTP_201_CREATED, 'created': result}
+
+def failed_result(index, error):
+    """
+    The result of an item of a batch that failed: the reason when the item was not
+    valid, and otherwise a generic error, the details of which are only logged.
+    """
+    if isinstance(error, DataValidationError):
+        return {'index': index, 'status': status.HTTP_400_BAD_REQUEST, 'error': error.message}
+    current_app.logger.error('%s %s item %d failed: %s', request.method, request.path, index, error.message)
+    return {'index': index, 'status': status.HTTP_500_INTERNAL_SERVER_ERROR, 'error': BATCH_ITEM_ERROR}
+
+def parse_ndjson_line(line):
+    """ Decodes one line of an NDJSON body; a line that is not JSON becomes None and fails validation """
+    try:
+        return json.loads(line)
+    except ValueError:
+        return None
 
 ######################################################################
 # SET DEFAULT PAYMENT (ACTION)
 ######################################################################
-@app.route('/payments/<int:user_id>/set-default', methods=['PATCH'])
+@api.route('/payments/<int:user_id>/set-default', methods=['PATCH'])
 @swag_from('documentation/set_default.yaml')
+@idempotent
 def set_default(user_id):
     try:
         if not request.data:
@@ -87,14 +239,14 @@ def set_default(user_id):
         if not request.is_json:
             raise DataValidationError('Invalid request: request not json')
         data = request.get_json()
-        if data['payment_id']:
-            resp = payment_service.perform_payment_action(user_id,payment_attributes=data)
-            if resp == True:
-                message = { 'success' : 'Payment with id: %s set as default for user with user_id: %s.' % (data['payment_id'], str(user_id)) }
-                rc = status.HTTP_200_OK
-            else:
-                message = { 'error' : 'No Payment with id: %s was found for user with user_id: %s.' % (data['payment_id'], str(user_id)) }
-                rc = status.HTTP_404_NOT_FOUND
+        payment_id = data['payment_id']
+        resp = payment_service.perform_payment_action(user_id,payment_attributes=data)
+        if resp == True:
+            message = { 'success' : 'Payment with id: %s set as default for user with user_id: %s.' % (payment_id, str(user_id)) }
+            rc = status.HTTP_200_OK
+        else:
+            message = { 'error' : 'No Payment with id: %s was found for user with user_id: %s.' % (payment_id, str(user_id)) }
+            rc = status.HTTP_404_NOT_FOUND
     except DataValidationError as e:
         message = {'error' : e.message}
         rc = status.HTTP_400_BAD_REQUEST
@@ -102,80 +254,99 @@ def set_default(user_id):
         message = {'error' : 'Invalid request: body of request does not have the payment_id'}
         rc = status.HTTP_400_BAD_REQUEST
 
-    return make_response(jsonify(message), rc)
+    return json_response(message, rc)
 
 ######################################################################
 # RETRIEVE A PAYMENT
 ######################################################################
-@app.route('/payments/<int:id>', methods=['GET'])
+@api.route('/payments/<int:id>', methods=['GET'])
 @swag_from('documentation/retrieve_payment.yaml')
 def get_payments(id):
     try:
-        result = payment_service.get_payments(payment_ids=[id])
-        rc = status.HTTP_200_OK
+        if request.if_none_match:
+            # decide on the version alone before anything is read or serialized
+            version = payment_service.get_payment_version(id)
+            if version is not None and request.if_none_match.contains_weak(payment_etag(id, version)):
+                return not_modified(payment_etag(id, version))
+
+        # the encoded body comes from the service's cache when the payment was read recently
+        body, version = payment_service.get_payment_response(id)
     except Exception:
         message = 'Payment with id {} could not be found'.format(id)
         result = {'error': message }
-        rc = status.HTTP_404_NOT_FOUND
+        return json_response(result, status.HTTP_404_NOT_FOUND)
 
-
-    return make_response(jsonify(result), rc)
+    response = json_response(RawJSON(body))
+    response.set_etag(payment_etag(id, version))
+    return response
 
 ######################################################################
 # UPDATE AN EXISTING PAYMENT
 ######################################################################
-@app.route('/payments/<int:id>', methods=['PUT'])
+@api.route('/payments/<int:id>', methods=['PUT'])
 @swag_from('documentation/update_payment_put.yaml')
 def update_payments(id):
     try:
         if not request.is_json:
             raise DataValidationError('Invalid payment: Content Type is not json')
         data = request.get_json(silent=True)
-        message = payment_service.update_payment(id,payment_replacement=data)
+        message = payment_service.update_payment(id,payment_replacement=data,
+                                                 expected_version=if_match_version(id))
         rc = status.HTTP_200_OK
     except PaymentNotFoundError as e:
         message = e.message
         rc = status.HTTP_404_NOT_FOUND
+    except PaymentVersionMismatchError as e:
+        message = e.message
+        rc = status.HTTP_412_PRECONDITION_FAILED
     except DataValidationError as e:
         message = e.message
         rc = status.HTTP_400_BAD_REQUEST
-    return make_response(jsonify(message), rc)
+    return json_response(message, rc)
 
 ######################################################################
 # UPDATE AN EXISTING PAYMENT PARTIALLY
 ######################################################################
-@app.route('/payments/<int:id>', methods=['PATCH'])
+@api.route('/payments/<int:id>', methods=['PATCH'])
 @swag_from('documentation/update_payment_patch.yaml')
 def update_partial_payments(id):
     try:
         if not request.is_json:
             raise DataValidationError('Invalid payment: Content Type is not json')
         data = request.get_json(silent=True)
-        message = payment_service.update_payment(id,payment_attributes=data)
+        message = payment_service.update_payment(id,payment_attributes=data,
+                                                 expected_version=if_match_version(id))
         rc = status.HTTP_200_OK
     except PaymentNotFoundError as e:
         message = e.message
         rc = status.HTTP_404_NOT_FOUND
+    except PaymentVersionMismatchError as e:
+        message = e.message
+        rc = status.HTTP_412_PRECONDITION_FAILED
     except DataValidationError as e:
         message = e.message
         rc = status.HTTP_400_BAD_REQUEST
-    return make_response(jsonify(message), rc)
+    return json_response(message, rc)
 
 
 ######################################################################
 # DELETE A PAYMENT
 ######################################################################
-@app.route('/payments/<int:id>', methods=['DELETE'])
+@api.route('/payments/<int:id>', methods=['DELETE'])
 @swag_from('documentation/delete_payments.yaml')
 def delete_payments(id):
-    payment_service.remove_payment(payment_id=id)
+    try:
+        payment_service.remove_payment(payment_id=id)
+    except PaymentVersionMismatchError as e:
+        return json_response(e.message, status.HTTP_409_CONFLICT)
     return '', status.HTTP_204_NO_CONTENT
 
 ######################################################################
 # CHARGE PAYMENT (ACTION)
 ######################################################################
-@app.route('/payments/<int:user_id>/charge', methods=['PATCH'])
+@api.route('/payments/<int:user_id>/charge', methods=['PATCH'])
 @swag_from('documentation/charge_payment.yaml')
+@idempotent
 def charge_payment(user_id):
     try:
         if not request.data:
@@ -183,18 +354,181 @@ def charge_payment(user_id):
         if not request.is_json:
             raise DataValidationError('Invalid request: request not json')
         data = request.get_json()
-        if data['amount']:
-            if(data['amount'] < 0):
-                raise DataValidationError('Invalid request: Order amount is negative.')
-            else:
-                resp = payment_service.perform_payment_action(user_id,payment_attributes=data)
-                if resp == True:
-                    message = {'success' : 'Default payment method for user_id: %s has been charged $%.2f' % (str(user_id), data['amount'])}
-                    rc = status.HTTP_200_OK
+        if(data['amount'] < 0):
+            raise DataValidationError('Invalid request: Order amount is negative.')
+        # anything else the service cannot charge (zero, not a number) is a DataValidationError too
+        payment_service.perform_payment_action(user_id,payment_attributes=data)
+        message = {'success' : 'Default payment method for user_id: %s has been charged $%.2f' % (str(user_id), data['amount'])}
+        rc = status.HTTP_200_OK
     except DataValidationError as e:
         message = {'error' : e.message}
         rc = status.HTTP_400_BAD_REQUEST
     except KeyError as e:
         message = {'error' : 'Invalid request: body of request does not have the amount to be charged'}
         rc = status.HTTP_400_BAD_REQUEST
-    return make_response(jsonify(message), rc)
+    return json_response(message, rc)
+
+######################################################################
+# CHARGE PAYMENTS IN BULK
+######################################################################
+@api.route('/charges/batch', methods=['POST'])
+@swag_from('documentation/charge_payments_batch.yaml')
+def charge_payments_batch():
+    data = request.get_json(silent=True)
+    if not isinstance(data, list):
+        raise DataValidationError('Invalid request: body of request must be a JSON array of charges')
+    if len(data) > current_app.config['BATCH_MAX_SIZE']:
+        raise DataValidationError('Invalid request: a batch may hold at most %d charges' % current_app.config['BATCH_MAX_SIZE'])
+
+    results = []
+    for index, result in enumerate(payment_service.charge_payments(data, chunk_size=current_app.config['BATCH_CHUNK_SIZE'])):
+        if isinstance(result, Exception):
+            results.append(failed_result(index, result))
+        else:
+            charge = data[index]
+            results.append({'index': index, 'status': status.HTTP_200_OK,
+                            'success': 'Default payment method for user_id: %s has been charged $%.2f' % (str(charge['user_id']), charge['amount'])})
+
+    charged = len([result for result in results if 'success' in result])
+    message = {'charged': charged, 'failed': len(results) - charged, 'results': results}
+    return json_response(message, status.HTTP_200_OK)
+
+
+######################################################################
+# USER SPEND SUMMARIES
+######################################################################
+@api.route('/users/summary', methods=['GET'])
+@swag_from('documentation/list_user_summaries.yaml')
+def list_user_summaries():
+    limit, after = get_page_args(request.args)
+
+    # ask for one user more than the page holds to find out whether there is a next page
+    results = payment_service.get_user_summaries(limit=limit + 1, after=after)
+    return page_response(results, limit, key='user_id')
+
+@api.route('/users/<int:user_id>/summary', methods=['GET'])
+@swag_from('documentation/user_summary.yaml')
+def get_user_summary(user_id):
+    try:
+        result = payment_service.get_user_summary(user_id)
+    except PaymentNotFoundError:
+        message = 'Payments not found for the user_id: {}'.format(user_id)
+        return json_response({'error': message}, status.HTTP_404_NOT_FOUND)
+    return json_response(result, status.HTTP_200_OK)
+
+######################################################################
+# DIAGNOSTICS
+######################################################################
+@api.route('/diagnostics', methods=['GET'])
+def diagnostics():
+    return json_response(dict(payment_cache=payment_service.cache.stats(),
+                              idempotency=current_app.extensions['idempotency'].stats(),
+                              db_pool=pool_stats(app_db.engine)))
+
+######################################################################
+# CONDITIONAL REQUEST HELPERS
+######################################################################
+def payment_etag(payment_id, version):
+    """ The ETag of a single payment: it changes whenever the payment's version does """
+    return '{}-{}'.format(payment_id, version)
+
+def page_etag(versions, limit):
+    """
+    The ETag of a page of payments, made from the (id, version) pairs of the payments on
+    the page and from whether there is a next page (which the response links to).
+    versions may hold one pair more than the page, for the first payment of the next
+    page; that payment's id and version do not count.
+    """
+    pairs = ','.join('%d-%d' % row for row in versions[:limit])
+    if len(versions) > limit:
+        pairs += ',next'
+    return hashlib.sha1(pairs).hexdigest()
+
+def not_modified(etag):
+    response = Response(status=status.HTTP_304_NOT_MODIFIED)
+    response.set_etag(etag)
+    return response
+
+def if_match_version(payment_id):
+    """
+    Reads the version a PUT or PATCH is conditional on from its If-Match header.
+
+    Returns None when the update is unconditional (no header, or *).  An ETag that
+    does not belong to this payment gives version 0, which never matches, because
+    versions start at 1.
+    """
+    if_match = request.if_match
+    if not if_match or if_match.star_tag:
+        return None
+    prefix = '{}-'.format(payment_id)
+    # a compressed response carries its ETag as weak; the version in it is the same
+    for etag in if_match.as_set(include_weak=True):
+        if etag.startswith(prefix) and etag[len(prefix):].isdigit():
+            return int(etag[len(prefix):])
+    return 0
+
+######################################################################
+# PAGINATION HELPERS
+######################################################################
+def wants_ndjson():
+    """ Checks whether the client prefers a streamed newline delimited JSON response """
+    best = request.accept_mimetypes.best_match(['application/json', NDJSON_MIMETYPE])
+    return best == NDJSON_MIMETYPE
+
+def get_page_args(request_args):
+    """
+    Reads the limit and after query parameters of a list request.
+
+    The limit defaults to DEFAULT_PAGE_SIZE and is capped at MAX_PAGE_SIZE.
+    The after parameter is an opaque cursor handed out with the previous page.
+    """
+    limit = current_app.config['DEFAULT_PAGE_SIZE']
+    if 'limit' in request_args:
+        try:
+            limit = int(request_args['limit'])
+        except ValueError:
+            raise DataValidationError('Invalid request: limit must be an integer')
+        if limit < 1:
+            raise DataValidationError('Invalid request: limit must be a positive integer')
+    limit = min(limit, current_app.config['MAX_PAGE_SIZE'])
+
+    after = None
+    if 'after' in request_args:
+        after = decode_cursor(request_args['after'])
+    return limit, after
+
+def page_response(results, limit, key='payment_id'):
+    """
+    Answers with one page of payments.  results holds up to limit + 1 payments; the
+    extra one only tells that there is a next page, which is then linked in the headers.
+
+    :param key: <str> the field of a result that pages are ordered by and the cursor is made of
+    """
+    next_cursor = None
+    if len(results) > limit:
+        results = results[:limit]
+        next_cursor = encode_cursor(results[-1][key])
+
+    response = json_response(results, status.HTTP_200_OK)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+        response.headers['Link'] = '<{}>; rel="next"'.format(next_page_url(next_cursor, limit))
+    return response
+
+def encode_cursor(last_id):
+    """ Turns the last id of a page into an opaque cursor for the next page """
+    return base64.urlsafe_b64encode(str(last_id)).rstrip('=')
+
+def decode_cursor(cursor):
+    """ Recovers the last id of the previous page from a cursor made by encode_cursor """
+    try:
+        return int(base64.urlsafe_b64decode(str(cursor) + '=' * (-len(cursor) % 4)))
+    except (TypeError, ValueError, binascii.Error):
+        raise DataValidationError('Invalid request: pagination cursor is malformed')
+
+def next_page_url(cursor, limit):
+    """ Builds the URL of the next page, keeping the filters of the current request """
+    args = request.args.to_dict(flat=False)
+    args['after'] = cursor
+    args['limit'] = limit
+    return url_for(request.endpoint, _external=True, **args)
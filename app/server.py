@@ -0,0 +1,86 @@
+import shutil, tempfile
+from gunicorn.app.base import BaseApplication
+from app.db import app_db
+
+
+class ProductionServer(BaseApplication):
+    """
+    Serves the app with gunicorn: several worker processes, each handling requests
+    on a few threads, recycled after a number of requests and stopped gracefully.
+    """
+    def __init__(self, application, options):
+        """
+        :param application: <Flask> the WSGI application to serve
+        :param options: <dict> gunicorn settings, see server_options
+        """
+        self.application = application
+        self.options = options
+        BaseApplication.__init__(self)
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+
+def server_options(config, port):
+    """
+    Builds the gunicorn settings from the WEB_* settings in config.py.
+
+    The app is loaded once in the master and the workers are forked from it.  The
+    master closes its database connections before every fork, so each worker opens
+    its own connections instead of sharing the master's sockets.  Workers share their
+    metrics through files, which the master archives when a worker exits.
+
+    :param config: <dict> the app's configuration
+    :param port: <int> the port to listen on
+    """
+    threads = config['WEB_THREADS']
+    return {'bind': '0.0.0.0:%d' % port,
+            'workers': config['WEB_WORKERS'],
+            'threads': threads,
+            'worker_class': 'gthread' if threads > 1 else 'sync',
+            'max_requests': config['WEB_MAX_REQUESTS'],
+            'max_requests_jitter': config['WEB_MAX_REQUESTS_JITTER'],
+            'timeout': config['WEB_TIMEOUT'],
+            'graceful_timeout': config['WEB_GRACEFUL_TIMEOUT'],
+            'preload_app': True,
+            'on_starting': share_metrics,
+            'pre_fork': close_connections,
+            'worker_exit': flush_metrics,
+            'child_exit': archive_metrics,
+            'on_exit': remove_metrics}
+
+
+def close_connections(server, worker):
+    """ gunicorn pre_fork hook: empties the master's connection pool before a worker is forked """
+    with server.app.application.app_context():
+        app_db.engine.dispose()
+
+
+def share_metrics(server):
+    """ gunicorn on_starting hook: gives the workers a directory to leave their metrics in """
+    metrics = server.app.application.extensions['metrics']
+    if metrics.directory is None:
+        metrics.directory = tempfile.mkdtemp(prefix='payments-metrics-')
+    metrics.reset()
+
+
+def flush_metrics(server, worker):
+    """ gunicorn worker_exit hook, run by the worker: writes out its last metrics """
+    server.app.application.extensions['metrics'].flush()
+
+
+def archive_metrics(server, worker):
+    """ gunicorn child_exit hook, run by the master: keeps an exited worker's counters """
+    server.app.application.extensions['metrics'].archive(worker.pid)
+
+
+def remove_metrics(server):
+    """ gunicorn on_exit hook: removes the metrics directory made by share_metrics """
+    application = server.app.application
+    directory = application.extensions['metrics'].directory
+    if directory and directory != application.config['METRICS_DIR']:
+        shutil.rmtree(directory, ignore_errors=True)
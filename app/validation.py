@@ -0,0 +1,311 @@
+import re, time
+from operator import itemgetter
+from calendar import monthrange
+from datetime import date
+from app.error_handlers import DataValidationError
+
+######################################################################
+# Schema
+######################################################################
+
+BAD_DATA = 'body of request contained bad or no data'
+
+class PaymentValidationError(DataValidationError):
+    """ A DataValidationError that carries every problem found, not just the first """
+    def __init__(self, errors):
+        DataValidationError.__init__(self, 'Invalid payment: ' + '; '.join(errors))
+        self.errors = errors
+
+class Field(object):
+    """
+    One required key of a schema.
+
+    :param name: <str> the key
+    :param pattern: <str> a regular expression the value must match (strict validation only)
+    :param choices: <tuple> the values allowed (strict validation only)
+    :param check: <callable> takes the value, returns an error message or None (strict validation only)
+    :param schema: <Schema|Switch> what the value, itself an object, must follow
+    """
+    def __init__(self, name, pattern=None, choices=None, check=None, schema=None):
+        self.name = name
+        self.pattern = re.compile(pattern) if pattern else None
+        self.choices = frozenset(choices) if choices else None
+        self.check = check
+        self.schema = schema
+
+    def validator(self, strict):
+        """
+        Returns a function that takes the field's value, the object holding it and the
+        list of errors, and appends the problems with the value; or None when being
+        present is all that is asked of the field.
+        """
+        checks = []
+        invalid = 'invalid ' + self.name
+        if strict and self.pattern is not None:
+            match = self.pattern.match
+            def check_pattern(value, data, errors):
+                if not (isinstance(value, basestring) and match(value)):
+                    errors.append(invalid)
+            checks.append(check_pattern)
+        if strict and self.choices is not None:
+            choices = self.choices
+            def check_choices(value, data, errors):
+                try:
+                    allowed = value in choices
+                except TypeError:
+                    allowed = False  # an unhashable value
+                if not allowed:
+                    errors.append(invalid)
+            checks.append(check_choices)
+        if strict and self.check is not None:
+            custom = self.check
+            def check_custom(value, data, errors):
+                error = custom(value)
+                if error:
+                    errors.append(error)
+            checks.append(check_custom)
+        if self.schema is not None:
+            checks.append(self.schema.validator(strict))
+
+        if len(checks) < 2:
+            return checks[0] if checks else None
+        def validate(value, data, errors):
+            for check in checks:
+                check(value, data, errors)
+        return validate
+
+    def test(self, strict):
+        """
+        Works like validator, but returns a predicate that takes the field's value and the
+        object holding it and only tells whether the value is valid; or None when being
+        present is all that is asked of the field.  A missing key inside the value raises
+        KeyError or TypeError.
+        """
+        tests = []
+        if strict and self.pattern is not None:
+            match = self.pattern.match
+            tests.append(lambda value, data: isinstance(value, basestring) and match(value) is not None)
+        if strict and self.choices is not None:
+            choices = self.choices
+            tests.append(lambda value, data: value in choices)
+        if strict and self.check is not None:
+            custom = self.check
+            tests.append(lambda value, data: not custom(value))
+        if self.schema is not None:
+            tests.append(self.schema.test(strict))
+
+        if len(tests) < 2:
+            return tests[0] if tests else None
+        def test(value, data):
+            for test in tests:
+                if not test(value, data):
+                    return False
+            return True
+        return test
+
+class Switch(object):
+    """
+    Picks the Schema of a nested object by the value of a key of the enclosing object.
+
+    :param key: <str> the key of the enclosing object to switch on
+    :param cases: <dict> value of that key -> Schema
+    :param default: <Schema> the Schema for any other value
+    """
+    def __init__(self, key, cases, default):
+        self.key = key
+        self.cases = cases
+        self.default = default
+
+    def validator(self, strict):
+        """ Works like Schema.validator, with the schema picked by the enclosing object """
+        key = self.key
+        cases = dict((case, schema.validator(strict)) for case, schema in self.cases.items())
+        default = self.default.validator(strict)
+        def validate(value, data, errors):
+            try:
+                case = cases.get(data.get(key), default)
+            except TypeError:
+                case = default  # an unhashable value
+            case(value, data, errors)
+        return validate
+
+    def test(self, strict):
+        """ Works like Schema.test, with the schema picked by the enclosing object """
+        key = self.key
+        cases = dict((case, schema.test(strict)) for case, schema in self.cases.items())
+        default = self.default.test(strict)
+        def test(value, data):
+            return cases.get(data[key], default)(value, data)
+        return test
+
+class Schema(object):
+    """
+    A declarative description of a JSON object made of required Fields.
+
+    Every schema builds two validators when it is created: the structural one only
+    checks that each field is present (what deserialize needs), the strict one also
+    checks formats, choices and custom checks (what a full replacement of a payment
+    needs).  Both return every error they find.
+
+    A validator is a plain closure: it looks up every required key, then runs the
+    checks of the fields that need more than being present, each a closure over the
+    field's precompiled regex, choices or nested validator.  Nothing is worked out
+    per field at run time.
+    """
+    def __init__(self, *fields):
+        self.fields = fields
+        # indexed by strict: (structural, strict)
+        self._validators = (self.validator(False), self.validator(True))
+        self._tests = (self.test(False), self.test(True))
+
+    def validator(self, strict):
+        """
+        Returns a function that takes an object, the object holding it (unused here) and
+        the list of errors, and appends the problems with the object.
+        """
+        required = tuple((field.name, 'missing ' + field.name) for field in self.fields)
+        checks = tuple((field.name, check) for field, check in
+                       ((field, field.validator(strict)) for field in self.fields) if check is not None)
+        def validate(data, parent, errors):
+            if not isinstance(data, dict):
+                errors.append(BAD_DATA)
+                return
+            missing = [error for name, error in required if name not in data]
+            if missing:
+                errors += missing
+            for name, check in checks:
+                if name in data:
+                    check(data[name], data, errors)
+        return validate
+
+    def test(self, strict):
+        """
+        Returns a predicate that takes an object and the object holding it and tells
+        whether the object is valid.  It reads every required key at once with one
+        itemgetter, so a missing key raises KeyError (or TypeError, for an object that is
+        not a dict) instead of being looked for one field at a time.
+        """
+        names = [field.name for field in self.fields]
+        get = itemgetter(*names)
+        if len(names) == 1:
+            get = lambda data, get=get: (get(data),)
+        tests = tuple((index, test) for index, test in
+                      enumerate(field.test(strict) for field in self.fields) if test is not None)
+        def test(data, parent):
+            if not isinstance(data, dict):
+                return False
+            values = get(data)
+            for index, test in tests:
+                if not test(values[index], data):
+                    return False
+            return True
+        return test
+
+    def errors(self, data, strict=False):
+        """
+        Returns the list of problems with data; empty when it is valid.  Valid data, the
+        usual case, only goes through the predicate of test; the list is only built when
+        that fails.
+        """
+        try:
+            if self._tests[strict](data, None):
+                return []
+        except (KeyError, TypeError):
+            pass
+        errors = []
+        self._validators[strict](data, None, errors)
+        return errors
+
+    def check(self, data, strict=False):
+        """ Raises a PaymentValidationError listing every problem with data """
+        errors = self.errors(data, strict)
+        if errors:
+            raise PaymentValidationError(errors)
+
+######################################################################
+# Payment schema
+######################################################################
+
+CARD_TYPES = ('credit', 'debit')
+PAYMENT_TYPES = CARD_TYPES + ('paypal',)
+
+EXPIRES_PATTERN = r'^(0[1-9]|1[0-2])/([0-9]{4})$'
+EXPIRES = re.compile(EXPIRES_PATTERN)
+
+# (first second of next month, first day of this month); see current_month
+_month = (0, None)
+
+def current_month():
+    """
+    Returns the first day of the current month.  The date is only worked out again once
+    the month is over, since building a date costs far more than the rest of a validation.
+    """
+    global _month
+    now = time.time()
+    if now >= _month[0]:
+        today = date.fromtimestamp(now)
+        first_of_next = date(today.year + today.month // 12, today.month % 12 + 1, 1)
+        _month = (time.mktime(first_of_next.timetuple()), today.replace(day=1))
+    return _month[1]
+
+def card_expiry_date(expires):
+    """
+    Returns the last day a card with an MM/YYYY expiry can be charged, or None if
+    expires is not a valid MM/YYYY month.  Stored as Detail.expires_at.
+    """
+    match = isinstance(expires, basestring) and EXPIRES.match(expires)
+    if not match:
+        return None
+    month, year = int(match.group(1)), int(match.group(2))
+    try:
+        return date(year, month, monthrange(year, month)[1])
+    except ValueError:
+        return None  # year 0000
+
+def card_not_expired(expires):
+    """ Cards are good through the last day of their MM/YYYY expiry month """
+    expires_at = card_expiry_date(expires)
+    if expires_at is not None and expires_at < current_month():
+        return 'card is expired'
+    return None
+
+USER_NAME = Field('user_name', pattern=r"^[A-Za-z\-' ]{0,50}$")
+
+CARD_DETAILS = Schema(
+    USER_NAME,
+    Field('card_type', pattern=r'^[A-Za-z ]{0,10}$'),
+    Field('card_number', pattern=r'^[0-9]{16}$'),
+    Field('expires', pattern=EXPIRES_PATTERN, check=card_not_expired),
+)
+
+PAYPAL_DETAILS = Schema(
+    USER_NAME,
+    Field('user_email', pattern=r'^[\W\w]+@[\W\w]+\.[A-Za-z]{2,3}$'),
+)
+
+PAYMENT = Schema(
+    Field('user_id'),
+    Field('nickname'),
+    Field('payment_type', choices=PAYMENT_TYPES),
+    # cards and paypal accounts are described by different details
+    Field('details', schema=Switch('payment_type', dict.fromkeys(CARD_TYPES, CARD_DETAILS), PAYPAL_DETAILS)),
+)
+
+def payment_errors(data):
+    """
+    Works like PAYMENT.errors(data), the structural check of every new payment, with the
+    keys PAYMENT requires written out in a straight line: a complete payment, what almost
+    every request sends, is accepted in this one frame.  A missing key raises KeyError and
+    data or details that are not objects raise TypeError; only then is the list of
+    problems built by PAYMENT.  Keep it in step with PAYMENT (test_validation checks).
+    """
+    try:
+        details = data['details']
+        data['user_id'], data['nickname']
+        if data['payment_type'] in ('credit', 'debit'):  # CARD_TYPES, as a constant
+            details['user_name'], details['card_type'], details['card_number'], details['expires']
+        else:
+            details['user_name'], details['user_email']
+    except (KeyError, TypeError):
+        return PAYMENT.errors(data)
+    return []
@@ -0,0 +1,96 @@
+"""
+Concurrent charge benchmark
+
+Fires charges at a single user's default payment from several threads at
+once and reports throughput and lost updates for the charge ledger
+(PaymentService.perform_payment_action, one INSERT per charge) next to the
+old in-place charge (one UPDATE of the payment's total per charge, which
+every concurrent charge has to queue behind).
+
+Runs against the database configured in LOCAL_DB; the payments it creates
+are deleted afterwards.
+
+    python -m benchmarks.charge_concurrency --threads 8 --charges 200
+"""
+import argparse, random, threading, time
+
+from app import app
+from app.db import app_db
+from app.db.models import Payment, Detail, Charge, to_minor_units
+from app.db.interface import PaymentService
+
+CARD = {'nickname' : 'bench card', 'payment_type' : 'credit',
+        'details' : {'user_name' : 'Bench Mark', 'card_number' : '1111222233334444',
+                     'expires' : '12/2099', 'card_type' : 'Visa'}}
+
+def ledger_charge(ps, user_id, amount):
+    ps.perform_payment_action(user_id, payment_attributes={'amount': amount})
+
+def row_update_charge(ps, user_id, amount):
+    """ The charge as it was before the ledger: the same checks, but an UPDATE of the payment's total """
+    payment = Payment.__table__
+    detail = Detail.__table__
+    app_db.session.execute(payment.update()
+                           .where(payment.c.user_id == user_id)
+                           .where(payment.c.is_default == True)
+                           .where(payment.c.is_removed == False)
+                           .where(payment.c.detail_id == detail.c.id)
+                           .where(ps._chargeable(payment, detail))
+                           .values(charge_total_minor=payment.c.charge_total_minor + to_minor_units(amount),
+                                   version=payment.c.version + 1))
+    app_db.session.commit()
+
+def run(charge, threads, charges):
+    """ Returns (seconds, charge_history) after threads * charges charges of 1.0 """
+    with app.app_context():
+        user_id = random.randint(10 ** 8, 10 ** 9)
+        payment = Payment()
+        payment.deserialize(dict(CARD, user_id=user_id))
+        payment.is_default = True
+        app_db.session.add(payment)
+        app_db.session.commit()
+        payment_id = payment.id
+        app_db.session.remove()
+
+    start = threading.Event()
+
+    def worker():
+        with app.app_context():
+            ps = PaymentService()
+            start.wait()
+            for _ in range(charges):
+                charge(ps, user_id, 1.0)
+            app_db.session.remove()
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for w in workers:
+        w.start()
+    began = time.time()
+    start.set()
+    for w in workers:
+        w.join()
+    elapsed = time.time() - began
+
+    with app.app_context():
+        payment = app_db.session.query(Payment).get(payment_id)
+        total = payment.charge_history
+        detail = payment.details
+        app_db.session.query(Charge).filter(Charge.payment_id == payment_id).delete()
+        app_db.session.delete(payment)
+        app_db.session.delete(detail)
+        app_db.session.commit()
+        app_db.session.remove()
+    return elapsed, total
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark concurrent charges of one default payment')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--charges', type=int, default=200, help='charges per thread')
+    args = parser.parse_args()
+
+    expected = float(args.threads * args.charges)
+    print('%d threads x %d charges of 1.00 (expected total %.2f)' % (args.threads, args.charges, expected))
+    for name, charge in (('row update', row_update_charge), ('ledger insert', ledger_charge)):
+        elapsed, total = run(charge, args.threads, args.charges)
+        print('%-18s %8.0f charges/s   total %10.2f   lost updates %d'
+              % (name, expected / elapsed, total, int(expected - total)))
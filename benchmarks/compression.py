@@ -0,0 +1,57 @@
+"""
+Response compression benchmark
+
+Reports, for lists of 1 to 10,000 payments encoded as the API sends them,
+the size of the body and, at each zlib level, its gzipped size and the time
+gzip takes, next to the time the body needs on a link of --mbps megabits per
+second.  Compressing pays off where the time it takes is less than the
+transfer time it saves; COMPRESSION_MIN_SIZE and COMPRESSION_LEVEL are
+chosen from this.
+
+Needs no database.
+
+    python -m benchmarks.compression --rounds 20 --mbps 2
+"""
+import argparse, random, timeit, zlib
+
+from app import app
+from app.encoding import dumps
+from benchmarks.encode import CARD
+
+LEVELS = (1, 6, 9)
+
+def payments(count):
+    """ Card payments with varied owners, numbers and totals, so they compress no better than real ones """
+    rand = random.Random(count)
+    names = [u'%s %s' % (rand.choice([u'Jimmy', u'Ann', u'Maria', u'Wei', u'Olu', u'Sam']),
+                         u''.join(rand.choice(u'abcdefghijklmnopqrstuvwxyz') for _ in range(8)).title())
+             for _ in range(max(1, count // 3))]
+    return [dict(CARD, payment_id=payment_id, user_id=rand.randint(1, 10 ** 6),
+                 nickname=u'card %d' % rand.randint(1, 99), charge_history=rand.randint(0, 10 ** 6) / 100.0,
+                 details=dict(CARD['details'], user_name=rand.choice(names),
+                              card_number=u'%016d' % rand.randint(0, 10 ** 16 - 1),
+                              expires=u'%02d/20%02d' % (rand.randint(1, 12), rand.randint(18, 30))))
+            for payment_id in range(count)]
+
+def gzip(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark gzipping lists of payments')
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--mbps', type=float, default=2.0, help='link speed the transfer time is given for')
+    args = parser.parse_args()
+
+    transfer_ms = lambda size: 1000 * size * 8 / (args.mbps * 10 ** 6)
+    with app.app_context():
+        for count in (1, 10, 100, 1000, 10000):
+            data = dumps(payments(count))
+            results = []
+            for level in LEVELS:
+                seconds = timeit.timeit(lambda: gzip(data, level), number=args.rounds) / args.rounds
+                size = len(gzip(data, level))
+                results.append('level %d %8d B %7.2fms (%8.1fms on the wire)' % (
+                    level, size, 1000 * seconds, transfer_ms(size)))
+            print('%6d payments %8d B (%8.1fms on the wire)   %s' % (
+                count, len(data), transfer_ms(len(data)), '   '.join(results)))
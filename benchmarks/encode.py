@@ -0,0 +1,51 @@
+"""
+Response encoding benchmark
+
+Reports payments encoded per second for lists of payments, the bulk of what
+the API sends: jsonify as responses used to be made (pretty printed by the
+json module's pure Python encoder), Flask's json module writing compact JSON,
+and the PaymentEncoder of app/encoding.py (plus the ujson_encoder when ujson
+is installed).
+
+Needs no database.
+
+    python -m benchmarks.encode --rounds 20
+"""
+import argparse, timeit
+from flask import jsonify
+
+from app import app
+from app.encoding import flask_dumps, payment_encoder, ujson_encoder
+
+CARD = {'user_id': 1, 'nickname': u'my credit', 'payment_type': u'credit', 'is_default': False,
+        'charge_history': 10.25,
+        'details': {'user_name': u'Jimmy Jones', 'card_number': u'1111222233334444',
+                    'expires': u'01/2019', 'card_type': u'Mastercard'}}
+PAYPAL = {'user_id': 2, 'nickname': u'my paypal', 'payment_type': u'paypal', 'is_default': True,
+          'charge_history': 0.0,
+          'details': {'user_name': u'John Jameson', 'user_email': u'jj@aol.com', 'is_linked': True}}
+
+def payments(count):
+    return [dict((CARD, PAYPAL)[payment_id % 2], payment_id=payment_id) for payment_id in range(count)]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark encoding lists of payments as JSON')
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+
+    encoders = [('jsonify', lambda body: jsonify(body).get_data()),
+                ('json compact', flask_dumps),
+                ('payment encoder', payment_encoder(app).dumps)]
+    try:
+        encoders.append(('ujson encoder', ujson_encoder(app).dumps))
+    except ImportError:
+        pass
+
+    with app.test_request_context('/payments'):
+        for count in (100, 1000, 10000):
+            body = payments(count)
+            rates = []
+            for name, dumps in encoders:
+                seconds = timeit.timeit(lambda: dumps(body), number=args.rounds) / args.rounds
+                rates.append('%s %9.0f/s' % (name, count / seconds))
+            print('%6d payments   %s' % (count, '   '.join(rates)))
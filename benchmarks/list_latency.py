@@ -0,0 +1,95 @@
+"""
+List latency benchmark
+
+Reports how long it takes to load and serialize lists of 10 to 10,000
+payments, and how many SQL statements that runs, three ways:
+
+    lazy    Payments loaded into the session, each one's details read with a
+            query of its own when it is serialized (as lists once were)
+    joined  Payments loaded into the session with their details joined in
+            (Payment.details is mapped lazy='joined')
+    rows    PaymentService.get_payments: plain rows of one Core select, turned
+            into responses by Payment.serialize_row without loading any Payment
+
+Runs against the database configured in LOCAL_DB; the payments it creates
+are deleted afterwards.  The lazy lists take minutes at 10,000 rows; leave
+them out with --skip-lazy.
+
+    python -m benchmarks.list_latency --rounds 5 --sizes 10 100 1000 10000
+"""
+import argparse, random, time
+from sqlalchemy import event, orm
+
+from app import app
+from app.db import app_db
+from app.db.models import Payment, Detail
+from app.db.interface import PaymentService
+
+CARD = {'nickname' : 'bench card', 'payment_type' : 'credit',
+        'details' : {'user_name' : 'Bench Mark', 'card_number' : '1111222233334444',
+                     'expires' : '12/2099', 'card_type' : 'Visa'}}
+
+def first_page(query, size):
+    """ The first page of a query of Payments, ordered like PaymentService._paginate_rows """
+    return query.order_by(Payment.id).limit(size).all()
+
+def lazy(ps, user_id, size):
+    query = ps._live_payments().options(orm.lazyload(Payment.details)).filter_by(user_id=user_id)
+    return [payment.serialize() for payment in first_page(query, size)]
+
+def joined(ps, user_id, size):
+    query = ps._live_payments().filter_by(user_id=user_id)
+    return [payment.serialize() for payment in first_page(query, size)]
+
+def rows(ps, user_id, size):
+    return ps.get_payments(payment_attributes={'user_id': user_id}, limit=size)
+
+def run(list_payments, user_id, size, rounds):
+    """ Returns (best seconds, statements) of listing size payments of the user """
+    ps = PaymentService()
+    statements = []
+    count = lambda conn, cursor, statement, parameters, context, executemany: statements.append(statement)
+    best = None
+    for _ in range(rounds):
+        # every round starts with nothing loaded, like a new request
+        app_db.session.remove()
+        del statements[:]
+        event.listen(app_db.engine, 'after_cursor_execute', count)
+        began = time.time()
+        list_payments(ps, user_id, size)
+        elapsed = time.time() - began
+        event.remove(app_db.engine, 'after_cursor_execute', count)
+        best = elapsed if best is None else min(best, elapsed)
+    return best, len(statements)
+
+def cleanup(user_id):
+    payment = Payment.__table__
+    detail = Detail.__table__
+    detail_ids = [row[0] for row in app_db.session.execute(
+        payment.delete().where(payment.c.user_id == user_id).returning(payment.c.detail_id))]
+    app_db.session.execute(detail.delete().where(detail.c.id.in_(detail_ids)))
+    app_db.session.commit()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark listing payments with their details')
+    parser.add_argument('--rounds', type=int, default=5, help='lists timed per size; the best is reported')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000])
+    parser.add_argument('--skip-lazy', action='store_true', help='only time the joined and row lists')
+    args = parser.parse_args()
+
+    ways = [('lazy', lazy), ('joined', joined), ('rows', rows)]
+    if args.skip_lazy:
+        ways = ways[1:]
+    with app.app_context():
+        user_id = random.randint(10 ** 8, 10 ** 9)
+        PaymentService().add_payments(dict(CARD, user_id=user_id) for _ in range(max(args.sizes)))
+        try:
+            for size in args.sizes:
+                results = []
+                for name, way in ways:
+                    seconds, statements = run(way, user_id, size, args.rounds)
+                    results.append('%s %9.1fms (%5d statements)' % (name, 1000 * seconds, statements))
+                print('%6d payments   %s' % (size, '   '.join(results)))
+        finally:
+            cleanup(user_id)
+            app_db.session.remove()
@@ -0,0 +1,59 @@
+"""
+Start-up benchmark
+
+Starts fresh Python processes and reports how long each takes to build the
+app (cold start) and to answer its first request (what a new gunicorn worker
+pays before it is useful), for the application factory as it is ("lazy":
+building the app touches no database) next to the way start-up used to work
+("eager": every process ran create_all and a commit on import, reflecting
+every table over a new connection).
+
+Runs against the database configured in LOCAL_DB, whose schema must already
+exist (FLASK_APP=run.py flask init-db).
+
+    python -m benchmarks.startup --runs 10
+"""
+import argparse, json, os, subprocess, sys, time
+
+# run in each child process; prints its timings, in seconds, as JSON
+CHILD = '''
+import json, time
+started = time.time()
+from app import app
+from app.db import app_db
+if %(eager)r:
+    with app.app_context():
+        app_db.create_all()
+        app_db.session.commit()
+built = time.time()
+# reads the payment table either way; an empty one answers 404
+response = app.test_client().get('/payments?limit=1')
+assert response.status_code in (200, 404), response.status_code
+print(json.dumps({'build': built - started, 'first_request': time.time() - built}))
+'''
+
+def spawn(eager):
+    """ Returns (seconds until the process has exited, its own timings) """
+    began = time.time()
+    output = subprocess.check_output([sys.executable, '-c', CHILD % {'eager': eager}],
+                                     cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    elapsed = time.time() - began
+    return elapsed, json.loads(output.strip().splitlines()[-1])
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark process start-up')
+    parser.add_argument('--runs', type=int, default=10, help='processes started per variant')
+    args = parser.parse_args()
+
+    print('median of %d processes, milliseconds' % args.runs)
+    print('%-8s %12s %15s %15s' % ('', 'build app', 'first request', 'whole process'))
+    for name, eager in (('eager', True), ('lazy', False)):
+        runs = [spawn(eager) for _ in range(args.runs)]
+        print('%-8s %12.1f %15.1f %15.1f'
+              % (name, 1000 * median([timings['build'] for _, timings in runs]),
+                 1000 * median([timings['first_request'] for _, timings in runs]),
+                 1000 * median([elapsed for elapsed, _ in runs])))
@@ -0,0 +1,87 @@
+"""
+Validation benchmark
+
+Reports validations per second for the payment schema in
+app/validation.py next to the checks it replaced: PaymentService.is_valid
+(re.match with string patterns, several datetime.now() calls) and the
+KeyError/TypeError walk of Payment.deserialize.  The old checks are kept here,
+as they were, only to be measured against.
+
+Needs no database.
+
+    python -m benchmarks.validation --rounds 20000
+"""
+import argparse, re, timeit
+from datetime import datetime
+
+from app.validation import PAYMENT, payment_errors
+
+CREDIT = {'nickname' : 'my credit', 'user_id' : 1, 'payment_type' : 'credit',
+          'details' : {'user_name' : 'Jimmy Jones', 'card_number' : '1111222233334444',
+                       'expires' : '12/2099', 'card_type' : 'Mastercard'}}
+PAYPAL = {'nickname' : 'my paypal', 'user_id' : 1, 'payment_type' : 'paypal',
+          'details' : {'user_name' : 'John Jameson', 'user_email' : 'jj@aol.com'}}
+MISSING = {'user_id' : 1, 'payment_type' : 'credit', 'details' : {'user_name' : 'Jimmy Jones'}}
+
+def legacy_is_valid(new_payment):
+    valid = False
+    payment_type = new_payment['payment_type']
+    user_name = new_payment['details']['user_name']
+    if bool(re.match("^[A-Za-z\-' ]{0,50}$", user_name)):
+        if payment_type == 'credit' or payment_type == 'debit':
+            card_number = new_payment['details']['card_number']
+            card_type = new_payment['details']['card_type']
+            expires = new_payment['details']['expires']
+            if bool(re.match('^[0-9]{16}$', card_number)):
+                if bool(re.match("^[A-Za-z ]{0,10}$", card_type)):
+                    if bool(re.match('^[0-9]{2}/[0-9]{4}$', expires)):
+                        month = int(expires[:2])
+                        year = int(expires[3:])
+                        if year > datetime.now().year:
+                            valid = True
+                        elif year == datetime.now().year and month >= datetime.now().month:
+                            valid = True
+        elif payment_type == 'paypal':
+            user_email = new_payment['details']['user_email']
+            if bool(re.match('^[\W\w]+@[\W\w]+\.[A-Za-z]{2,3}$', user_email)):
+                valid = True
+    return valid
+
+def legacy_deserialize_errors(data):
+    try:
+        data['user_id'], data['nickname']
+        details = data['details']
+        if data['payment_type'] in ('credit', 'debit'):
+            details['user_name'], details['card_type'], details['card_number'], details['expires']
+        else:
+            details['user_name'], details['user_email']
+    except KeyError as e:
+        return ['missing ' + e.args[0]]
+    except TypeError:
+        return ['body of request contained bad or no data']
+    return []
+
+def rate(function, payloads, rounds, repeat=5):
+    """ Returns validations per second of function over the payloads, best of repeat runs """
+    seconds = min(timeit.repeat(lambda: [function(payload) for payload in payloads],
+                                number=rounds, repeat=repeat))
+    return rounds * len(payloads) / seconds
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark payment validation')
+    parser.add_argument('--rounds', type=int, default=20000)
+    args = parser.parse_args()
+
+    cases = (
+        ('strict (PUT)', [CREDIT, PAYPAL],
+         legacy_is_valid, lambda payment: PAYMENT.errors(payment, strict=True)),
+        ('structural (POST)', [CREDIT, PAYPAL],
+         legacy_deserialize_errors, payment_errors),
+        # the schema lists every problem where the old walk stopped at the first
+        ('missing (POST)', [MISSING],
+         legacy_deserialize_errors, payment_errors),
+    )
+    for name, payloads, legacy, schema in cases:
+        before = rate(legacy, payloads, args.rounds)
+        after = rate(schema, payloads, args.rounds)
+        print('%-18s legacy %9.0f/s   schema %9.0f/s   x%.2f' % (name, before, after, after / before))
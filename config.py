@@ -1,4 +1,4 @@
-import os, sys, json
+import os, json, multiprocessing
 
 if 'VCAP_SERVICES' in os.environ:
     VCAP_SERVICES = os.environ['VCAP_SERVICES']
@@ -13,11 +13,86 @@ elif 'LOCAL_DB' in os.environ:
     SQLALCHEMY_DATABASE_URI = os.environ['LOCAL_DB']
     print 'Connecting to local postgres db...'
 else:
-    print "Missing database config. Exiting..."
-    sys.exit(1)
+    # the app can still be built, e.g. for `flask --help`; using the database fails instead
+    print 'Missing database config: set LOCAL_DB or VCAP_SERVICES'
+    SQLALCHEMY_DATABASE_URI = None
+
+# Database connection pool, per process: connections kept open, extra ones opened under
+# load, seconds to wait for a free connection and seconds after which one is replaced
+SQLALCHEMY_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
+SQLALCHEMY_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '10'))
+SQLALCHEMY_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))
+SQLALCHEMY_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1800'))
+# Test connections with SELECT 1 when they are checked out, so the ones broken by a
+# failover are replaced before a request uses them
+SQLALCHEMY_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'True') == 'True'
+# Milliseconds a statement may run before Postgres cancels it; 0 for no limit
+SQLALCHEMY_STATEMENT_TIMEOUT = int(os.getenv('DB_STATEMENT_TIMEOUT', '0'))
 
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# Page sizes for GET /payments; clients may ask for less than MAX_PAGE_SIZE but never more
+DEFAULT_PAGE_SIZE = int(os.getenv('DEFAULT_PAGE_SIZE', '100'))
+MAX_PAGE_SIZE = int(os.getenv('MAX_PAGE_SIZE', '1000'))
+# Rows fetched per round trip when streaming GET /payments as application/x-ndjson
+STREAM_BATCH_SIZE = int(os.getenv('STREAM_BATCH_SIZE', '500'))
+
+# POST /payments/batch and /charges/batch: items written per transaction, and the most a JSON array may hold
+BATCH_CHUNK_SIZE = int(os.getenv('BATCH_CHUNK_SIZE', '500'))
+BATCH_MAX_SIZE = int(os.getenv('BATCH_MAX_SIZE', '10000'))
+
+# GET /payments/<id> responses kept in memory per process: most entries held, and seconds
+# before an entry expires (bounds how stale a write made by another process can look)
+PAYMENT_CACHE_SIZE = int(os.getenv('PAYMENT_CACHE_SIZE', '1024'))
+PAYMENT_CACHE_TTL = float(os.getenv('PAYMENT_CACHE_TTL', '30'))
+
+# POST /payments, charges and set-default sent with an Idempotency-Key header: the store of
+# first responses (a dotted path to a function taking the app and returning the store; the
+# default keeps them in each process), the most keys it holds and seconds a key is kept
+IDEMPOTENCY_STORE = os.getenv('IDEMPOTENCY_STORE', 'app.idempotency.memory_store')
+IDEMPOTENCY_MAX_KEYS = int(os.getenv('IDEMPOTENCY_MAX_KEYS', '10000'))
+IDEMPOTENCY_TTL = float(os.getenv('IDEMPOTENCY_TTL', '86400'))
+
+# Encodes JSON response bodies: a dotted path to a function taking the app and returning the
+# encoder; app.encoding.ujson_encoder falls back on ujson when it is installed, and
+# app.encoding.flask_encoder only uses Flask's json module, without the fast path for payments
+RESPONSE_ENCODER = os.getenv('RESPONSE_ENCODER', 'app.encoding.payment_encoder')
+
+# gzip/deflate for clients that accept it: JSON and text bodies of at least COMPRESSION_MIN_SIZE
+# bytes (streamed ones whatever their size) at zlib level COMPRESSION_LEVEL, 1 (fastest) to 9
+# (smallest); turn it off when a proxy in front compresses responses instead
+COMPRESSION_ENABLED = os.getenv('COMPRESSION_ENABLED', 'True') == 'True'
+COMPRESSION_MIN_SIZE = int(os.getenv('COMPRESSION_MIN_SIZE', '1024'))
+COMPRESSION_LEVEL = int(os.getenv('COMPRESSION_LEVEL', '6'))
+
+# Seconds a charge stays in the ledger before `flask compact-charges` folds it into its
+# payment's running total; must be longer than any charge transaction takes
+CHARGE_COMPACTION_GRACE = float(os.getenv('CHARGE_COMPACTION_GRACE', '60'))
+
+# Production server (SERVER_MODE=production python run.py): worker processes (one per core by
+# default), threads per worker (keep it within DB_POOL_SIZE + DB_MAX_OVERFLOW), requests a worker
+# serves before it is replaced (plus up to the jitter, so workers are not all replaced at once),
+# seconds a request may take, and seconds workers get to finish their requests on shutdown
+WEB_WORKERS = int(os.getenv('WEB_WORKERS', str(multiprocessing.cpu_count())))
+WEB_THREADS = int(os.getenv('WEB_THREADS', '4'))
+WEB_MAX_REQUESTS = int(os.getenv('WEB_MAX_REQUESTS', '1000'))
+WEB_MAX_REQUESTS_JITTER = int(os.getenv('WEB_MAX_REQUESTS_JITTER', '100'))
+WEB_TIMEOUT = int(os.getenv('WEB_TIMEOUT', '30'))
+WEB_GRACEFUL_TIMEOUT = int(os.getenv('WEB_GRACEFUL_TIMEOUT', '30'))
+
+# API docs (/apidocs and the spec at /v1/spec); turn them off in API-only deployments to
+# leave flasgger and the YAML it parses out of every worker
+SWAGGER_ENABLED = os.getenv('SWAGGER_ENABLED', 'True') == 'True'
+
+# /metrics: the directory where worker processes leave their metrics for each other (a
+# temporary one is made when run.py starts gunicorn without it), and seconds between writes
+METRICS_DIR = os.getenv('METRICS_DIR', '')
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '1'))
+
+# Requests that run one statement (same SQL, any parameters) more than this many times are
+# logged and counted in /metrics; in debug mode responses carry X-DB-* headers too
+SQL_REPEAT_THRESHOLD = int(os.getenv('SQL_REPEAT_THRESHOLD', '10'))
+
 SWAGGER = {
     "swagger_version": "2.0",
     "specs":
@@ -0,0 +1,53 @@
+"""initial schema
+
+Revision ID: 0752fa986026
+Revises: 
+Create Date: 2026-10-18 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0752fa986026'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # databases that predate migrations already have these tables (made by
+    # create_all), so only create what is missing and let them be stamped
+    tables = sa.inspect(op.get_bind()).get_table_names()
+
+    if 'detail' not in tables:
+        op.create_table('detail',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('user_name', sa.String(length=50), nullable=True),
+            sa.Column('expires', sa.String(length=7), nullable=True),
+            sa.Column('card_type', sa.String(length=10), nullable=True),
+            sa.Column('card_number', sa.String(length=16), nullable=True),
+            sa.Column('user_email', sa.String(length=50), nullable=True),
+            sa.Column('is_linked', sa.Boolean(), nullable=True),
+            sa.PrimaryKeyConstraint('id')
+        )
+
+    if 'payment' not in tables:
+        op.create_table('payment',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('nickname', sa.String(length=20), nullable=True),
+            sa.Column('user_id', sa.Integer(), nullable=True),
+            sa.Column('payment_type', sa.String(length=10), nullable=True),
+            sa.Column('is_default', sa.Boolean(), nullable=True),
+            sa.Column('is_removed', sa.Boolean(), nullable=True),
+            sa.Column('charge_history', sa.Float(), nullable=True),
+            sa.Column('detail_id', sa.Integer(), nullable=True),
+            sa.ForeignKeyConstraint(['detail_id'], ['detail.id'], ),
+            sa.PrimaryKeyConstraint('id')
+        )
+
+
+def downgrade():
+    op.drop_table('payment')
+    op.drop_table('detail')
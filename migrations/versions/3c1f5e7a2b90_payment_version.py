@@ -0,0 +1,27 @@
+"""payment version
+
+Revision ID: 3c1f5e7a2b90
+Revises: 8ebd7e030f7e
+Create Date: 2026-10-18 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c1f5e7a2b90'
+down_revision = '8ebd7e030f7e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    existing = [column['name'] for column in sa.inspect(op.get_bind()).get_columns('payment')]
+    if 'version' not in existing:
+        # a constant default fills the existing rows without rewriting the table
+        op.add_column('payment', sa.Column('version', sa.Integer(), nullable=False, server_default='1'))
+
+
+def downgrade():
+    op.drop_column('payment', 'version')
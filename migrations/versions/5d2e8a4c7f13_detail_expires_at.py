@@ -0,0 +1,52 @@
+"""detail expires_at
+
+Revision ID: 5d2e8a4c7f13
+Revises: 3c1f5e7a2b90
+Create Date: 2026-10-18 15:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d2e8a4c7f13'
+down_revision = '3c1f5e7a2b90'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    bind = op.get_bind()
+    existing = [column['name'] for column in sa.inspect(bind).get_columns('detail')]
+    if 'expires_at' not in existing:
+        op.add_column('detail', sa.Column('expires_at', sa.Date(), nullable=True))
+
+    # the last day of the MM/YYYY month; expiries that are not valid months stay NULL,
+    # like app.validation.card_expiry_date leaves them
+    op.execute("""
+        UPDATE detail
+        SET expires_at = (to_date(expires, 'MM/YYYY') + interval '1 month' - interval '1 day')::date
+        WHERE expires_at IS NULL AND expires ~ '^(0[1-9]|1[0-2])/[0-9]{4}$'
+          AND expires NOT LIKE '%/0000'
+    """)
+
+    options = {'postgresql_where': sa.text('expires_at IS NOT NULL')}
+    if bind.dialect.name == 'postgresql':
+        # commit the backfill, then build the index without blocking writes
+        op.execute('COMMIT')
+        options['postgresql_concurrently'] = True
+
+    existing = [index['name'] for index in sa.inspect(bind).get_indexes('detail')]
+    if 'ix_detail_expires_at' not in existing:
+        op.create_index('ix_detail_expires_at', 'detail', ['expires_at'], **options)
+
+
+def downgrade():
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        op.execute('COMMIT')
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS ix_detail_expires_at')
+    else:
+        op.drop_index('ix_detail_expires_at', table_name='detail')
+    op.drop_column('detail', 'expires_at')
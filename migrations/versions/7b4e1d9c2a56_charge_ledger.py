@@ -0,0 +1,103 @@
+"""charge ledger
+
+Revision ID: 7b4e1d9c2a56
+Revises: 5d2e8a4c7f13
+Create Date: 2026-10-18 17:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7b4e1d9c2a56'
+down_revision = '5d2e8a4c7f13'
+branch_labels = None
+depends_on = None
+
+
+# Records a charge made by the previous release, which adds it to payment.charge_history,
+# as the ledger entry this release would have made.  Dropped, with charge_history, by a
+# migration of a later release, once no instance of the previous release is left.
+LEGACY_CHARGE_FUNCTION = """
+    CREATE OR REPLACE FUNCTION record_legacy_charge() RETURNS trigger AS $$
+    BEGIN
+        INSERT INTO charge (payment_id, amount_minor)
+        VALUES (NEW.id, round((coalesce(NEW.charge_history, 0) - coalesce(OLD.charge_history, 0)) * 100));
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+"""
+LEGACY_CHARGE_TRIGGER = """
+    CREATE TRIGGER payment_legacy_charge AFTER UPDATE OF charge_history ON payment
+    FOR EACH ROW WHEN (NEW.charge_history IS DISTINCT FROM OLD.charge_history)
+    EXECUTE PROCEDURE record_legacy_charge()
+"""
+
+
+def upgrade():
+    bind = op.get_bind()
+    if 'charge' not in sa.inspect(bind).get_table_names():
+        op.create_table('charge',
+            sa.Column('id', sa.BigInteger(), nullable=False),
+            sa.Column('payment_id', sa.Integer(), nullable=False),
+            sa.Column('amount_minor', sa.BigInteger(), nullable=False),
+            sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+            sa.ForeignKeyConstraint(['payment_id'], ['payment.id'], ),
+            sa.PrimaryKeyConstraint('id')
+        )
+
+    existing = [column['name'] for column in sa.inspect(bind).get_columns('payment')]
+    if 'charge_total_minor' not in existing:
+        op.add_column('payment', sa.Column('charge_total_minor', sa.BigInteger(), server_default='0', nullable=False))
+    if 'charge_count' not in existing:
+        op.add_column('payment', sa.Column('charge_count', sa.Integer(), server_default='0', nullable=False))
+    if 'charges_compacted_at' not in existing:
+        op.add_column('payment', sa.Column('charges_compacted_at', sa.DateTime(timezone=True),
+                                           server_default=sa.text("'epoch'"), nullable=False))
+    if 'charge_history' in existing:
+        # instances of the previous release keep reading and adding to charge_history while a
+        # rolling deploy replaces them, so the column stays; payments made by this release get
+        # 0 rather than NULL, which the previous release could not add to
+        op.execute('UPDATE payment SET charge_history = 0 WHERE charge_history IS NULL')
+        op.alter_column('payment', 'charge_history', server_default='0')
+        if bind.dialect.name == 'postgresql':
+            # and what they add to it is recorded in the ledger, where this release reads totals
+            op.execute(LEGACY_CHARGE_FUNCTION)
+            op.execute('DROP TRIGGER IF EXISTS payment_legacy_charge ON payment')
+            op.execute(LEGACY_CHARGE_TRIGGER)
+        # the float totals become the starting rollup; the charges behind them were never recorded
+        op.execute('UPDATE payment SET charge_total_minor = round(coalesce(charge_history, 0) * 100)')
+
+    options = {}
+    if bind.dialect.name == 'postgresql':
+        # commit the table and the backfill, then build the indexes without blocking writes
+        op.execute('COMMIT')
+        options['postgresql_concurrently'] = True
+
+    existing = [index['name'] for index in sa.inspect(bind).get_indexes('charge')]
+    if 'ix_charge_payment_created' not in existing:
+        op.create_index('ix_charge_payment_created', 'charge', ['payment_id', 'created_at'], **options)
+    if 'ix_charge_created_at' not in existing:
+        op.create_index('ix_charge_created_at', 'charge', ['created_at'], postgresql_using='brin', **options)
+
+
+def downgrade():
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        op.execute('DROP TRIGGER IF EXISTS payment_legacy_charge ON payment')
+        op.execute('DROP FUNCTION IF EXISTS record_legacy_charge()')
+    # charge_history is normally still there (see upgrade); bring it up to date with the ledger
+    existing = [column['name'] for column in sa.inspect(bind).get_columns('payment')]
+    if 'charge_history' not in existing:
+        op.add_column('payment', sa.Column('charge_history', sa.Float(), nullable=True))
+    op.execute("""
+        UPDATE payment
+        SET charge_history = (charge_total_minor + coalesce((
+            SELECT sum(amount_minor) FROM charge
+            WHERE charge.payment_id = payment.id AND charge.created_at > payment.charges_compacted_at), 0)) / 100.0
+    """)
+    op.drop_column('payment', 'charges_compacted_at')
+    op.drop_column('payment', 'charge_count')
+    op.drop_column('payment', 'charge_total_minor')
+    op.drop_table('charge')
@@ -0,0 +1,50 @@
+"""one default payment per user
+
+Revision ID: 8ebd7e030f7e
+Revises: a9dc9cb09e61
+Create Date: 2026-10-18 11:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8ebd7e030f7e'
+down_revision = 'a9dc9cb09e61'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # racing set-default requests could leave a user with several defaults;
+    # keep the newest one so the unique index can be built
+    op.execute("""
+        UPDATE payment SET is_default = false
+        WHERE is_default = true AND is_removed = false AND EXISTS (
+            SELECT 1 FROM payment newer
+            WHERE newer.user_id = payment.user_id AND newer.id > payment.id
+              AND newer.is_default = true AND newer.is_removed = false)
+    """)
+
+    bind = op.get_bind()
+    options = {'unique': True,
+               'postgresql_where': sa.text('is_default = true AND is_removed = false')}
+    if bind.dialect.name == 'postgresql':
+        # commit the clean up, then build the index without blocking writes
+        # (CREATE INDEX CONCURRENTLY cannot run inside a transaction block)
+        op.execute('COMMIT')
+        options['postgresql_concurrently'] = True
+
+    existing = [index['name'] for index in sa.inspect(bind).get_indexes('payment')]
+    if 'ux_payment_user_default' not in existing:
+        op.create_index('ux_payment_user_default', 'payment', ['user_id'], **options)
+
+
+def downgrade():
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        op.execute('COMMIT')
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS ux_payment_user_default')
+    else:
+        op.drop_index('ux_payment_user_default', table_name='payment')
@@ -0,0 +1,56 @@
+"""payment access path indexes
+
+Revision ID: a9dc9cb09e61
+Revises: 0752fa986026
+Create Date: 2026-10-18 09:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a9dc9cb09e61'
+down_revision = '0752fa986026'
+branch_labels = None
+depends_on = None
+
+
+LIVE = sa.text('is_removed = false')
+
+INDEXES = [
+    ('ix_payment_live_id', ['id'], {'postgresql_where': LIVE}),
+    ('ix_payment_live_user_id', ['user_id'], {'postgresql_where': LIVE}),
+    ('ix_payment_user_removed_default', ['user_id', 'is_removed', 'is_default'], {}),
+    ('ix_payment_live_nickname', ['nickname', 'id'], {'postgresql_where': LIVE}),
+    ('ix_payment_live_payment_type', ['payment_type', 'id'], {'postgresql_where': LIVE}),
+    ('ix_payment_detail_id', ['detail_id'], {}),
+]
+
+
+def upgrade():
+    bind = op.get_bind()
+    online = bind.dialect.name == 'postgresql'
+    if online:
+        # CREATE INDEX CONCURRENTLY does not lock out writes, but it cannot
+        # run inside a transaction block, so end the migration's transaction
+        op.execute('COMMIT')
+
+    existing = [index['name'] for index in sa.inspect(bind).get_indexes('payment')]
+    for name, columns, options in INDEXES:
+        if name in existing:
+            continue
+        if online:
+            options = dict(options, postgresql_concurrently=True)
+        op.create_index(name, 'payment', columns, **options)
+
+
+def downgrade():
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        op.execute('COMMIT')
+        for name, columns, options in reversed(INDEXES):
+            op.execute('DROP INDEX CONCURRENTLY IF EXISTS %s' % name)
+    else:
+        for name, columns, options in reversed(INDEXES):
+            op.drop_index(name, table_name='payment')
@@ -5,4 +5,9 @@ if __name__ == '__main__':
     print 'Starting payments app'
     debug = (os.getenv('DEBUG', 'False') == 'True')
     port = os.getenv('PORT', '5000')
-    app.run(host='0.0.0.0', port=int(port), debug=debug)
+    # development: Flask's single process server; production: gunicorn workers on every core
+    if os.getenv('SERVER_MODE', 'development') == 'production':
+        from app.server import ProductionServer, server_options
+        ProductionServer(app, server_options(app.config, int(port))).run()
+    else:
+        app.run(host='0.0.0.0', port=int(port), debug=debug)
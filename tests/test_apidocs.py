@@ -0,0 +1,67 @@
+# Test cases can be run with either of the following:
+# python -m unittest discover
+# nosetests -v --rednose --nologcapture
+
+import os, subprocess, sys
+import unittest, mock
+from flask import json
+from flask_api import status
+from flasgger import base as flasgger_base
+
+from app import create_app, payments
+
+class TestApiDocs(unittest.TestCase):
+
+    def setUp(self):
+        # a new app builds its spec again
+        self.app = create_app().test_client()
+
+    def test_routes_are_documented(self):
+        self.assertEqual(payments.list_payments.swag_type, 'yaml')
+        self.assertTrue(os.path.isfile(payments.list_payments.swag_path))
+        spec = json.loads(self.app.get('/v1/spec').data)
+        self.assertEqual(spec['info']['title'], 'DevOps Payments API')
+        self.assertIn('get', spec['paths']['/payments'])
+        self.assertIn('post', spec['paths']['/payments'])
+        self.assertIn('/payments/{id}', spec['paths'])
+        self.assertEqual(self.app.get('/apidocs/index.html').status_code, status.HTTP_200_OK)
+
+    def test_spec_is_built_once(self):
+        with mock.patch.object(flasgger_base, '_parse_docstring', wraps=flasgger_base._parse_docstring) as parse:
+            first = self.app.get('/v1/spec')
+            parsed = parse.call_count
+            second = self.app.get('/v1/spec')
+        self.assertTrue(parsed > 0)
+        self.assertEqual(parse.call_count, parsed)
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        self.assertEqual(first.mimetype, 'application/json')
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(first.headers['ETag'], second.headers['ETag'])
+
+    def test_spec_not_modified(self):
+        etag = self.app.get('/v1/spec').headers['ETag']
+        response = self.app.get('/v1/spec', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertEqual(response.data, b'')
+
+    def test_docs_can_be_turned_off(self):
+        with mock.patch('config.SWAGGER_ENABLED', False):
+            client = create_app().test_client()
+        self.assertEqual(client.get('/v1/spec').status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(client.get('/apidocs/index.html').status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(client.get('/').status_code, status.HTTP_200_OK)
+
+    def test_flasgger_is_not_imported_when_off(self):
+        environment = dict(os.environ, SWAGGER_ENABLED='False')
+        output = subprocess.check_output(
+            [sys.executable, '-c', "import sys; from app import app; print('flasgger' in sys.modules)"],
+            env=environment)
+        self.assertEqual(output.strip().splitlines()[-1], b'False')
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+# Test cases can be run with either of the following:
+# python -m unittest discover
+# nosetests -v --rednose --nologcapture
+
+import unittest
+from app.cache import LRUCache
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class TestLRUCache(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = LRUCache(max_size=2, ttl=10, clock=self.clock)
+
+    def test_get_and_set(self):
+        self.assertEqual(self.cache.get(1), None)
+        self.assertTrue(self.cache.set(1, 'one'))
+        self.assertEqual(self.cache.get(1), 'one')
+        self.assertEqual(self.cache.stats(), {'size': 1, 'max_size': 2, 'ttl': 10,
+                                              'hits': 1, 'misses': 1, 'evictions': 0})
+
+    def test_least_recently_used_is_evicted(self):
+        self.cache.set(1, 'one')
+        self.cache.set(2, 'two')
+        self.cache.get(1)
+        self.cache.set(3, 'three')
+        self.assertEqual(self.cache.get(2), None)
+        self.assertEqual(self.cache.get(1), 'one')
+        self.assertEqual(self.cache.get(3), 'three')
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_entries_expire(self):
+        self.cache.set(1, 'one')
+        self.clock.now = 9.9
+        self.assertEqual(self.cache.get(1), 'one')
+        self.clock.now = 10
+        self.assertEqual(self.cache.get(1), None)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_invalidate(self):
+        self.cache.set(1, 'one')
+        self.cache.set(2, 'two')
+        self.cache.invalidate(1, 3)
+        self.assertEqual(self.cache.get(1), None)
+        self.assertEqual(self.cache.get(2), 'two')
+
+    def test_add(self):
+        self.assertTrue(self.cache.add(1, 'one'))
+        self.assertFalse(self.cache.add(1, 'uno'))
+        self.assertEqual(self.cache.get(1), 'one')
+        # an expired entry no longer holds its key
+        self.clock.now = 10
+        self.assertTrue(self.cache.add(1, 'uno'))
+        self.assertEqual(self.cache.get(1), 'uno')
+
+    def test_stale_load_is_not_stored(self):
+        # a value loaded before a write invalidated it must not be cached after the write
+        token = self.cache.token()
+        self.cache.invalidate(1)
+        self.assertFalse(self.cache.set(1, 'stale', token))
+        self.assertEqual(self.cache.get(1), None)
+        self.assertTrue(self.cache.set(1, 'fresh', self.cache.token()))
+
+    def test_disabled(self):
+        cache = LRUCache(max_size=0)
+        self.assertFalse(cache.set(1, 'one'))
+        self.assertEqual(cache.get(1), None)
+
+    def test_clear(self):
+        self.cache.set(1, 'one')
+        self.cache.get(1)
+        self.cache.clear()
+        self.assertEqual(self.cache.stats(), {'size': 0, 'max_size': 2, 'ttl': 10,
+                                              'hits': 0, 'misses': 0, 'evictions': 0})
@@ -0,0 +1,91 @@
+# Test cases can be run with either of the following:
+# python -m unittest discover
+# nosetests -v --rednose --nologcapture
+
+import os
+import unittest, mock
+import flask_migrate
+from click.testing import CliRunner
+from flask.cli import ScriptInfo
+from sqlalchemy import inspect
+
+from app import app, create_app
+from app.db import app_db
+from app.commands import init_db, compact_charges
+from app.payments import payment_service
+
+class TestCreateApp(unittest.TestCase):
+
+    def test_app_builds_without_a_database(self):
+        with mock.patch('config.SQLALCHEMY_DATABASE_URI', None):
+            application = create_app()
+        self.assertIn('api.get_payments', application.view_functions)
+        self.assertIn('init-db', application.cli.commands)
+        with application.app_context():
+            self.assertRaises(RuntimeError, lambda: app_db.engine)
+
+class TestCommands(unittest.TestCase):
+
+    def setUp(self):
+        if not app.config['TESTING']: #then use local test db
+            app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('LOCAL_DB')
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+        app_db.drop_all()
+        app_db.engine.execute('DROP TABLE IF EXISTS alembic_version')
+
+    def tearDown(self):
+        app_db.session.remove()
+        app_db.drop_all()
+        app_db.engine.execute('DROP TABLE IF EXISTS alembic_version')
+        app_db.engine.execute('DROP FUNCTION IF EXISTS record_legacy_charge() CASCADE')
+
+    def invoke(self, command):
+        return CliRunner().invoke(command, obj=ScriptInfo(create_app=lambda info: app))
+
+    def test_init_db_creates_the_schema_once(self):
+        result = self.invoke(init_db)
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('Created the database schema', result.output)
+        tables = inspect(app_db.engine).get_table_names()
+        self.assertTrue(set(['payment', 'detail', 'charge', 'alembic_version']) <= set(tables))
+        head = app_db.engine.execute('SELECT version_num FROM alembic_version').scalar()
+        self.assertIsNotNone(head)
+
+        # a second run finds the schema and only migrates it, which is a no-op at head
+        result = self.invoke(init_db)
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('Migrated the database to the latest version', result.output)
+        self.assertEqual(app_db.engine.execute('SELECT version_num FROM alembic_version').scalar(), head)
+
+    def test_charges_of_the_previous_release_reach_the_ledger(self):
+        engine = app_db.engine
+        flask_migrate.upgrade(revision='5d2e8a4c7f13')
+        engine.execute("INSERT INTO detail (user_name, is_linked) VALUES ('John Jameson', true)")
+        engine.execute("INSERT INTO payment (nickname, user_id, payment_type, is_default, is_removed, "
+                       "charge_history, detail_id, version) VALUES ('my paypal', 1, 'paypal', true, false, 12.5, 1, 1)")
+        self.assertEqual(self.invoke(init_db).exit_code, 0)
+
+        # the previous release charges by adding to charge_history, and reads it back
+        engine.execute('UPDATE payment SET charge_history = charge_history + 2.25 WHERE id = 1')
+        self.assertEqual(payment_service.get_payments(payment_ids=[1])[0]['charge_history'], 14.75)
+        self.assertEqual(engine.execute('SELECT count(*) FROM charge').scalar(), 1)
+
+        # payments made by this release can be charged the old way too
+        payment_service.add_payment(dict(nickname='card', user_id=2, payment_type='paypal',
+                                         details={'user_name': 'Jo', 'user_email': 'jo@aol.com'}))
+        self.assertEqual(engine.execute('SELECT charge_history FROM payment WHERE id = 2').scalar(), 0)
+
+    def test_compact_charges(self):
+        app_db.create_all()
+        result = self.invoke(compact_charges)
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('Compacted the charges of 0 payments', result.output)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
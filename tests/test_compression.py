@@ -0,0 +1,105 @@
+# Test cases can be run with either of the following:
+# python -m unittest discover
+# nosetests -v --rednose --nologcapture
+
+import unittest, json, mock, zlib
+from flask_api import status
+from app import create_app
+from app.db.interface import PaymentService
+
+CREDIT = {'payment_id': 1, 'user_id': 1, 'nickname': u'my credit', 'payment_type': u'credit',
+          'is_default': False, 'charge_history': 10.25,
+          'details': {'user_name': u'Jimmy Jones', 'card_number': u'1111222233334444',
+                      'expires': u'01/2019', 'card_type': u'Mastercard'}}
+PAYMENTS = [dict(CREDIT, payment_id=payment_id) for payment_id in range(1, 51)]
+VERSIONS = [(payment['payment_id'], 1) for payment in PAYMENTS]
+
+def gunzip(data):
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+class TestCompression(unittest.TestCase):
+
+    def setUp(self):
+        self.flask_app = create_app()
+        self.app = self.flask_app.test_client()
+
+    def list_payments(self, **headers):
+        with mock.patch.object(PaymentService, 'get_payment_versions', return_value=VERSIONS), \
+                mock.patch.object(PaymentService, 'get_payments', return_value=(PAYMENTS, VERSIONS)):
+            return self.app.get('/payments', headers=headers)
+
+    def test_large_lists_are_compressed(self):
+        plain = self.list_payments()
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertIn('Accept-Encoding', plain.headers['Vary'])
+
+        gzipped = self.list_payments(**{'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(gzipped.status_code, status.HTTP_200_OK)
+        self.assertEqual(gzipped.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', gzipped.headers['Vary'])
+        self.assertEqual(gunzip(gzipped.data), plain.data)
+        self.assertEqual(int(gzipped.headers['Content-Length']), len(gzipped.data))
+        self.assertLess(len(gzipped.data), len(plain.data) / 5)
+        # the same payments, other bytes: the ETag is weak
+        self.assertEqual(gzipped.get_etag(), (plain.get_etag()[0], True))
+
+        deflated = self.list_payments(**{'Accept-Encoding': 'gzip;q=0.5, deflate'})
+        self.assertEqual(deflated.headers['Content-Encoding'], 'deflate')
+        self.assertEqual(zlib.decompress(deflated.data), plain.data)
+
+        for accept_encoding in ('identity', 'gzip;q=0, br'):
+            response = self.list_payments(**{'Accept-Encoding': accept_encoding})
+            self.assertNotIn('Content-Encoding', response.headers)
+            self.assertEqual(response.data, plain.data)
+
+    def test_weak_etag_revalidates(self):
+        etag = self.list_payments(**{'Accept-Encoding': 'gzip'}).headers['ETag']
+        response = self.list_payments(**{'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertNotIn('Content-Encoding', response.headers)
+
+    @mock.patch.object(PaymentService, 'get_payment_response', return_value=(json.dumps([CREDIT]), 4))
+    def test_small_responses_are_not_compressed(self, mock_ps_get):
+        with mock.patch('zlib.compressobj') as compressobj:
+            response = self.app.get('/payments/1', headers={'Accept-Encoding': 'gzip'})
+        compressobj.assert_not_called()
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(json.loads(response.data), [CREDIT])
+        self.assertEqual(response.get_etag(), ('1-4', False))
+
+    @mock.patch.object(PaymentService, 'update_payment', return_value=CREDIT)
+    def test_weak_etag_in_if_match(self, mock_ps_update):
+        self.app.patch('/payments/1', data=json.dumps({'nickname': 'x'}), content_type='application/json',
+                       headers={'If-Match': 'W/"1-4"'})
+        mock_ps_update.assert_called_with(1, payment_attributes={'nickname': 'x'}, expected_version=4)
+
+    def test_streams_are_compressed(self):
+        with mock.patch.object(PaymentService, 'stream_payments', return_value=iter(PAYMENTS)), \
+                mock.patch('app.compression.STREAM_FLUSH_SIZE', 1000):
+            response = self.app.get('/payments', headers={'Accept': 'application/x-ndjson',
+                                                          'Accept-Encoding': 'gzip'})
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            self.assertNotIn('Content-Length', response.headers)
+            chunks = list(response.response)
+        # flushed along the way, so the client can read whole payments as each part arrives
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        parts = [part for part in (decompressor.decompress(chunk) for chunk in chunks) if part]
+        self.assertGreater(len(parts), 2)
+        self.assertTrue(all(part.endswith('\n') for part in parts))
+        lines = ''.join(parts).splitlines()
+        self.assertEqual([json.loads(line) for line in lines], PAYMENTS)
+
+    def test_compression_can_be_turned_off(self):
+        with mock.patch('config.COMPRESSION_ENABLED', False):
+            self.app = create_app().test_client()
+        response = self.list_payments(**{'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertNotIn('Vary', response.headers)
+        self.assertEqual(json.loads(response.data), json.loads(json.dumps(PAYMENTS)))
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
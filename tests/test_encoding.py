@@ -0,0 +1,95 @@
+# Test cases can be run with either of the following:
+# python -m unittest discover
+# nosetests -v --rednose --nologcapture
+
+import sys, unittest, mock
+from datetime import date
+from flask import json
+from flask_api import status
+from app import create_app
+from app import encoding
+from app.db.interface import PaymentService
+from app.encoding import RawJSON, Encoder, PaymentEncoder, flask_dumps
+
+CREDIT = {'payment_id': 1, 'user_id': 1, 'nickname': u'my credit', 'payment_type': u'credit',
+          'is_default': False, 'charge_history': 10.25,
+          'details': {'user_name': u'Jimmy Jones', 'card_number': u'1111222233334444',
+                      'expires': u'01/2019', 'card_type': u'Mastercard'}}
+PAYPAL = {'payment_id': 2L, 'user_id': 1, 'nickname': None, 'payment_type': 'paypal',
+          'is_default': True, 'charge_history': 0.1 + 0.2,
+          'details': {'user_name': u'J\xfcrgen "JJ" Jameson', 'user_email': 'jj@aol.com', 'is_linked': True}}
+
+class TestPaymentEncoder(unittest.TestCase):
+
+    def setUp(self):
+        self.flask_app = create_app()
+        context = self.flask_app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+        self.fallback = mock.Mock(side_effect=flask_dumps)
+        self.encoder = PaymentEncoder(self.fallback)
+
+    def test_payments_are_encoded_like_the_json_module(self):
+        for body in (CREDIT, PAYPAL, [CREDIT, PAYPAL]):
+            self.assertEqual(self.encoder.dumps(body), flask_dumps(body))
+        self.fallback.assert_not_called()
+
+    def test_raw_json_passes_through(self):
+        raw = RawJSON(flask_dumps(CREDIT))
+        self.assertIs(self.encoder.dumps(raw), raw)
+        self.assertEqual(self.encoder.dumps([raw, PAYPAL]), flask_dumps([CREDIT, PAYPAL]))
+        self.assertIs(Encoder(flask_dumps).dumps(raw), raw)
+        self.fallback.assert_not_called()
+
+    def test_other_bodies_fall_back(self):
+        odd = dict(CREDIT, charge_history=date(2020, 1, 1))
+        for body in ({'error': 'Not found'}, [], [CREDIT, {'error': 'Not found'}], dict(CREDIT, extra=1),
+                     dict(CREDIT, details={'user_name': u'Jimmy Jones'}), odd, dict(CREDIT, charge_history=float('nan'))):
+            self.fallback.reset_mock()
+            self.assertEqual(self.encoder.dumps(body), flask_dumps(body))
+            self.fallback.assert_called_once()
+
+    def test_ujson_fallback(self):
+        ujson = mock.Mock()
+        ujson.dumps.return_value = '{"error":"Not found"}'
+        with mock.patch.dict(sys.modules, {'ujson': ujson}):
+            encoder = encoding.ujson_encoder(self.flask_app)
+        self.assertEqual(encoder.dumps({'error': 'Not found'}), '{"error":"Not found"}')
+        self.assertEqual(encoder.dumps([CREDIT]), flask_dumps([CREDIT]))
+        ujson.dumps.assert_called_once()
+
+class TestResponses(unittest.TestCase):
+
+    def setUp(self):
+        self.flask_app = create_app()
+        self.app = self.flask_app.test_client()
+
+    @mock.patch.object(PaymentService, 'get_payments', return_value=([CREDIT, PAYPAL], [(1, 1), (2, 1)]))
+    def test_list_response(self, mock_ps_get):
+        resp = self.app.get('/payments')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, 'application/json')
+        with self.flask_app.app_context():
+            self.assertEqual(resp.data, flask_dumps([CREDIT, PAYPAL]))
+
+    @mock.patch.object(PaymentService, 'get_payments', return_value=([CREDIT, PAYPAL], [(1, 1), (2, 1)]))
+    def test_response_encoder_setting(self, mock_ps_get):
+        self.flask_app.config['RESPONSE_ENCODER'] = 'app.encoding.flask_encoder'
+        encoding.init_app(self.flask_app)
+        self.assertNotIsInstance(self.flask_app.extensions['encoding'], PaymentEncoder)
+        resp = self.app.get('/payments')
+        self.assertEqual(json.loads(resp.data), json.loads(json.dumps([CREDIT, PAYPAL])))
+
+    def test_error_response(self):
+        resp = self.app.get('/no-such-route')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(resp.mimetype, 'application/json')
+        self.assertNotIn('\n', resp.data)
+        self.assertEqual(json.loads(resp.data)['error'], 'Not Found')
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
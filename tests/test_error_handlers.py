@@ -3,7 +3,7 @@
 # nosetests -v --rednose --nologcapture
 
 import unittest, json
-from app import payments
+from app import app, payments
 from app.db import app_db
 from app.error_handlers import DataValidationError
 from app.db.interface import PaymentService
@@ -28,7 +28,7 @@ class TestErrorHandlers(unittest.TestCase):
     '''
 
     def setUp(self):
-        self.app = payments.app.test_client()
+        self.app = app.test_client()
         
     def test_crud_put_not_allowed_for_create(self):
         data = json.dumps(PAYPAL)
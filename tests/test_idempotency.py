@@ -0,0 +1,127 @@
+# Test cases can be run with either of the following:
+# python -m unittest discover
+# nosetests -v --rednose --nologcapture
+
+import unittest, json, mock
+from flask_api import status
+from app import create_app
+from app.db.interface import PaymentService
+from app.idempotency import MemoryStore
+
+PAYPAL = {'nickname' : 'my paypal', 'user_id' : 1, 'payment_type' : 'paypal',
+          'details' : {'user_name' : 'John Jameson', 'user_email' : 'jj@aol.com'}}
+PAYPAL_RETURN = dict(PAYPAL, is_default=False, charge_history=0.0, payment_id=3)
+
+class TestIdempotency(unittest.TestCase):
+
+    def setUp(self):
+        # a new app starts with an empty store and counters
+        self.flask_app = create_app()
+        self.app = self.flask_app.test_client()
+        self.idempotency = self.flask_app.extensions['idempotency']
+
+    def post(self, data, key='attempt-1'):
+        return self.app.post('/payments', data=json.dumps(data), content_type='application/json',
+                             headers={'Idempotency-Key': key})
+
+    def charge(self, amount, key='attempt-1'):
+        return self.app.patch('/payments/1/charge', data=json.dumps({'amount': amount}),
+                              content_type='application/json', headers={'Idempotency-Key': key})
+
+    @mock.patch.object(PaymentService, 'add_payment', return_value=PAYPAL_RETURN)
+    def test_retried_create_is_replayed(self, mock_ps_add):
+        first = self.post(PAYPAL)
+        retry = self.post(PAYPAL)
+        mock_ps_add.assert_called_once_with(PAYPAL)
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertEqual((retry.status_code, retry.data), (first.status_code, first.data))
+        self.assertEqual(retry.mimetype, 'application/json')
+        self.assertNotIn('Idempotent-Replayed', first.headers)
+        self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+
+        # a new key is a new attempt
+        self.post(PAYPAL, key='attempt-2')
+        self.assertEqual(mock_ps_add.call_count, 2)
+
+    @mock.patch.object(PaymentService, 'perform_payment_action', return_value=True)
+    def test_retried_charge_is_replayed(self, mock_ps_action):
+        self.assertEqual(self.charge(20.0).status_code, status.HTTP_200_OK)
+        self.assertEqual(self.charge(20.0).status_code, status.HTTP_200_OK)
+        mock_ps_action.assert_called_once_with(1, payment_attributes={'amount': 20.0})
+
+        # the same key on another action or user is another attempt
+        self.app.patch('/payments/2/charge', data=json.dumps({'amount': 20.0}),
+                       content_type='application/json', headers={'Idempotency-Key': 'attempt-1'})
+        self.assertEqual(mock_ps_action.call_count, 2)
+
+    @mock.patch.object(PaymentService, 'perform_payment_action', return_value=True)
+    def test_requests_without_a_key_are_not_stored(self, mock_ps_action):
+        for _ in range(2):
+            self.app.patch('/payments/1/set-default', data=json.dumps({'payment_id': 3}),
+                           content_type='application/json')
+        self.assertEqual(mock_ps_action.call_count, 2)
+        self.assertEqual(self.idempotency.stats()['size'], 0)
+
+    @mock.patch.object(PaymentService, 'perform_payment_action', return_value=True)
+    def test_key_reused_with_another_body(self, mock_ps_action):
+        self.charge(20.0)
+        resp = self.charge(30.0)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('different request body', json.loads(resp.data)['error'])
+        # encoded like every other response, without pretty printing
+        self.assertNotIn('\n', resp.data)
+        mock_ps_action.assert_called_once_with(1, payment_attributes={'amount': 20.0})
+
+    @mock.patch.object(PaymentService, 'perform_payment_action', return_value=True)
+    def test_key_in_progress(self, mock_ps_action):
+        # another worker has started on the key but not finished
+        self.charge(20.0, key='first')
+        self.idempotency.store.set('PATCH /payments/1/charge busy',
+                                   (self.idempotency.store.get('PATCH /payments/1/charge first')[0], None))
+        resp = self.charge(20.0, key='busy')
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        mock_ps_action.assert_called_once_with(1, payment_attributes={'amount': 20.0})
+
+    def test_invalid_key(self):
+        resp = self.charge(20.0, key='x' * 256)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('Idempotency-Key', json.loads(resp.data)['message'])
+
+    @mock.patch.object(PaymentService, 'add_payment')
+    def test_server_errors_are_not_stored(self, mock_ps_add):
+        mock_ps_add.side_effect = [Exception('connection reset'), PAYPAL_RETURN]
+        self.flask_app.config['PROPAGATE_EXCEPTIONS'] = False
+        self.flask_app.log_exception = mock.Mock()
+        self.assertEqual(self.post(PAYPAL).status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        self.assertEqual(self.post(PAYPAL).status_code, status.HTTP_201_CREATED)
+        self.assertEqual(mock_ps_add.call_count, 2)
+
+    @mock.patch.object(PaymentService, 'perform_payment_action', return_value=True)
+    def test_stats(self, mock_ps_action):
+        for key in ('a', 'a', 'a', 'b'):
+            self.charge(20.0, key=key)
+        stats = json.loads(self.app.get('/diagnostics').data)['idempotency']
+        self.assertEqual((stats['requests'], stats['replays'], stats['conflicts']), (4, 2, 0))
+        self.assertEqual(stats['hit_rate'], 0.5)
+        self.assertEqual(stats['size'], 2)
+        self.assertEqual(stats['max_size'], self.flask_app.config['IDEMPOTENCY_MAX_KEYS'])
+
+class TestMemoryStore(unittest.TestCase):
+
+    def test_add_only_once(self):
+        store = MemoryStore(max_size=2, ttl=60)
+        self.assertTrue(store.add('key', 'first'))
+        self.assertFalse(store.add('key', 'second'))
+        self.assertEqual(store.get('key'), 'first')
+        store.set('key', 'done')
+        self.assertEqual(store.get('key'), 'done')
+        store.delete('key')
+        self.assertEqual(store.get('key'), None)
+        self.assertTrue(store.add('key', 'again'))
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
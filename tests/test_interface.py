@@ -2,14 +2,17 @@
 # python -m unittest discover
 # nosetests -v --rednose --nologcapture
 
-import unittest, mock, copy
+import unittest, mock, copy, json, threading
+from datetime import date
 import os
+from sqlalchemy import exc, event, orm
 
-from app import payments
+from app import app, payments
 from app.db import app_db
-from app.db.models import Payment, Detail
-from app.db.interface import PaymentService, PaymentServiceQueryError, PaymentNotFoundError
+from app.db.models import Payment, Detail, Charge
+from app.db.interface import PaymentService, PaymentServiceQueryError, PaymentNotFoundError, PaymentVersionMismatchError
 from app.error_handlers import DataValidationError
+from app.validation import card_expiry_date
 
 CC_DETAIL = {'user_name' : 'Jimmy Jones', 'card_number' : '1111222233334444',
              'expires' : '01/2019', 'card_type' : 'Mastercard'}
@@ -63,9 +66,13 @@ BAD_QUERY_ATTRIBUTES = {
 class TestInterface(unittest.TestCase):
 
     def setUp(self):
-        payments.app.debug = True
-        if not payments.app.config['TESTING']: #then use local test db
-            payments.app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('LOCAL_DB')
+        app.debug = True
+        if not app.config['TESTING']: #then use local test db
+            app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('LOCAL_DB')
+        # the database is bound to the app, so work inside one of its contexts
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
         app_db.create_all()  # make our sqlalchemy tables
 
 
@@ -76,114 +83,104 @@ class TestInterface(unittest.TestCase):
         app_db.session.commit()
 
         self.ps = PaymentService()
-        self.app = payments.app.test_client()
+        payments.payment_service.cache.clear()
+        self.app = app.test_client()
 
 
     def tearDown(self):
         app_db.session.remove()
         app_db.drop_all()
 
-    @mock.patch('app.db.models.Payment')
+    @mock.patch.object(Payment, 'serialize_row')
     @mock.patch.object(app_db, 'session')
-    def test_interface_get_missing_mock(self, mock_db, mock_P):
+    def test_interface_get_missing_mock(self, mock_db, mock_serialize):
         id = [99]
 
-        mock_db.query(Payment).filter.return_value.all.return_value = []
+        mock_db.execute.return_value.fetchall.return_value = []
         with self.assertRaises(PaymentNotFoundError):
             result = self.ps.get_payments(payment_ids=id)
-        mock_db.query(Payment).filter.assert_called_once()
-        mock_P.serialize.assert_not_called()
+        mock_db.execute.assert_called_once()
+        mock_serialize.assert_not_called()
 
-    @mock.patch.object(PaymentService, '_remove_soft_deletes')
-    @mock.patch('app.db.models.Payment')
+    @mock.patch.object(Payment, 'serialize_row')
     @mock.patch.object(app_db, 'session')
-    def test_interface_get_one_mock(self, mock_db, mock_P, mock_remove):
+    def test_interface_get_one_mock(self, mock_db, mock_serialize):
         id = [1]
 
-        mock_P.serialize.return_value = CC_RETURN
-        mock_db.query(Payment).filter.return_value.all.return_value = [mock_P]
-        mock_remove.return_value = [mock_P]
+        mock_serialize.return_value = CC_RETURN
+        mock_db.execute.return_value.fetchall.return_value = [mock.Mock()]
         result = self.ps.get_payments(payment_ids=id)
-        mock_db.query(Payment).filter.assert_called_once()
-        #mock_db.query(Payment).filter.all.assert_called_once()
-        mock_P.serialize.assert_called_once()
-        mock_remove.assert_called_once()
+        mock_db.execute.assert_called_once()
+        self.assertIn('payment.id IN', str(mock_db.execute.call_args[0][0]))
+        mock_serialize.assert_called_once_with(mock_db.execute.return_value.fetchall.return_value[0])
         self.assertEqual(len(result), 1)
         self.assertEqual(result, [CC_RETURN])
 
-    @mock.patch.object(PaymentService, '_remove_soft_deletes')
-    @mock.patch('app.db.models.Payment')
+    @mock.patch.object(Payment, 'serialize_row')
     @mock.patch.object(app_db, 'session')
-    def test_interface_get_multiple_mock(self, mock_db, mock_P, mock_remove):
+    def test_interface_get_multiple_mock(self, mock_db, mock_serialize):
         ids = [1,2,3]
 
-        mock_P.serialize.side_effect = [CC_RETURN, DC_RETURN, PP_RETURN]
-        mock_db.query(Payment).filter.return_value.all.return_value = [mock_P, mock_P, mock_P]
-        mock_remove.return_value = [mock_P, mock_P, mock_P]
-        result = self.ps.get_payments(payment_ids=[ids])
-        mock_db.query(Payment).filter.assert_called_once()
-        mock_remove.assert_called_once()
-        mock_P.serialize.assert_called()
+        mock_serialize.side_effect = [CC_RETURN, DC_RETURN, PP_RETURN]
+        mock_db.execute.return_value.fetchall.return_value = [mock.Mock(), mock.Mock(), mock.Mock()]
+        result = self.ps.get_payments(payment_ids=ids)
+        mock_db.execute.assert_called_once()
+        mock_serialize.assert_called()
         self.assertEqual(len(result), 3)
         self.assertEqual(result[0], CC_RETURN)
 
-    @mock.patch.object(PaymentService, '_remove_soft_deletes')
-    @mock.patch('app.db.models.Payment')
+    @mock.patch.object(Payment, 'serialize_row')
     @mock.patch.object(app_db, 'session')
-    def test_interface_get_bad_multiple_mock(self, mock_db, mock_P, mock_remove):
+    def test_interface_get_bad_multiple_mock(self, mock_db, mock_serialize):
         ids = [1,99, 2]
 
-        mock_P.serialize.side_effect = [CC_RETURN, DC_RETURN]
-        mock_db.query(Payment).filter.return_value.all.return_value = [mock_P, mock_P]
-        mock_remove.return_value = [mock_P, mock_P]
-        result = self.ps.get_payments(payment_ids=[ids])
-        mock_db.query(Payment).filter.assert_called_once()
-        mock_P.serialize.assert_called()
-        mock_remove.assert_called_once()
+        mock_serialize.side_effect = [CC_RETURN, DC_RETURN]
+        mock_db.execute.return_value.fetchall.return_value = [mock.Mock(), mock.Mock()]
+        result = self.ps.get_payments(payment_ids=ids)
+        mock_db.execute.assert_called_once()
+        mock_serialize.assert_called()
         self.assertEqual(len(result), 2)
 
 
-    @mock.patch.object(PaymentService, '_remove_soft_deletes')
-    @mock.patch('app.db.models.Payment')
+    @mock.patch.object(Payment, 'serialize_row')
     @mock.patch.object(app_db, 'session')
-    def test_interface_get_all_mock(self, mock_db, mock_P, mock_remove):
-        mock_P.serialize.side_effect = [CC_RETURN, DC_RETURN]
-        mock_db.query(Payment).all.return_value = [mock_P, mock_P]
-        mock_remove.return_value = [mock_P, mock_P]
+    def test_interface_get_all_mock(self, mock_db, mock_serialize):
+        mock_serialize.side_effect = [CC_RETURN, DC_RETURN]
+        mock_db.execute.return_value.fetchall.return_value = [mock.Mock(), mock.Mock()]
         result = self.ps.get_payments()
-        mock_db.query(Payment).all.assert_called_once()
-        mock_remove.assert_called_once()
-        mock_P.serialize.assert_called()
+        mock_db.execute.assert_called_once()
+        self.assertNotIn('payment.id IN', str(mock_db.execute.call_args[0][0]))
+        mock_serialize.assert_called()
         self.assertEqual(len(result), 2)
         self.assertEqual(result[0], CC_RETURN)
 
-    @mock.patch.object(PaymentService, '_remove_soft_deletes')
-    @mock.patch.object(PaymentService, '_query_payments', return_value=CC_RETURN)
-    @mock.patch('app.db.models.Payment')
-    def test_interface_get_query_nick_mock(self, mock_P, mock_q, mock_remove):
+    @mock.patch.object(Payment, 'serialize_row')
+    @mock.patch.object(app_db, 'session')
+    def test_interface_get_query_nick_mock(self, mock_db, mock_serialize):
         q = {'nickname' : 'my credit'}
 
-        mock_P.serialize.return_value = CC_RETURN
-        mock_q.return_value = [mock_P]
-        mock_remove.return_value = [mock_P]
+        mock_serialize.return_value = CC_RETURN
+        mock_db.execute.return_value.fetchall.return_value = [mock.Mock()]
         result = self.ps.get_payments(payment_attributes=q)
-        mock_q.assert_called_once()
-        mock_remove.assert_called_once()
-        mock_P.serialize.assert_called_once()
+        mock_db.execute.assert_called_once()
+        self.assertIn('payment.nickname =', str(mock_db.execute.call_args[0][0]))
+        mock_serialize.assert_called_once()
         self.assertEqual(len(result), 1)
         self.assertEqual(result[0], CC_RETURN)
 
-    @mock.patch.object(PaymentService, '_remove_soft_deletes')
-    @mock.patch.object(PaymentService, '_query_payments', side_effect=PaymentServiceQueryError)
-    @mock.patch('app.db.models.Payment')
-    def test_interface_bad_query_mock(self, mock_P, mock_q, mock_remove):
+    @mock.patch.object(Payment, 'serialize_row')
+    @mock.patch.object(app_db, 'session')
+    def test_interface_bad_query_mock(self, mock_db, mock_serialize):
         q = {'whatever' : 'man'}
 
         with self.assertRaises(DataValidationError) as e:
             result = self.ps.get_payments(payment_attributes=q)
-        mock_q.assert_called_once()
-        mock_P.serialize.assert_not_called()
-        mock_remove.assert_not_called()
+        mock_db.execute.assert_not_called()
+
+        mock_db.execute.side_effect = exc.DataError('SELECT', {}, Exception('invalid input syntax for integer'))
+        with self.assertRaises(DataValidationError) as e:
+            result = self.ps.get_payments(payment_attributes={'user_id' : 'man'})
+        mock_serialize.assert_not_called()
 
     def test_interface_get_single_payment(self):
         id = [1]
@@ -261,19 +258,69 @@ class TestInterface(unittest.TestCase):
         self.assertEqual(len(result), 1)
         self.assertEqual(result[0], CC_RETURN)
 
-    def test_interface_remove_soft_delete(self):
-        data = (CREDIT, DEBIT, PAYPAL)
-        payments = []
+    def test_interface_live_payments_skip_soft_deletes(self):
+        data = (DEBIT, PAYPAL)
         for d in data:
             p = Payment()
             p.deserialize(d)
             p.is_removed = True
-            payments.append(p)
+            app_db.session.add(p)
+        app_db.session.commit()
+
+        payments = self.ps._live_payments().all()
+        self.assertEqual(len(payments), 1)
+        self.assertEqual(payments[0].serialize(), CC_RETURN)
+
+        payments = self.ps.get_payments(payment_attributes={'user_id' : 1})
+        self.assertEqual([payment['payment_id'] for payment in payments], [1])
+        payments = list(self.ps.stream_payments(payment_attributes={'user_id' : 1}))
+        self.assertEqual([payment['payment_id'] for payment in payments], [1])
+
+    def test_interface_get_page(self):
+        for d in (DEBIT, PAYPAL):
+            p = Payment()
+            p.deserialize(d)
+            app_db.session.add(p)
+        app_db.session.commit()
+
+        result = self.ps.get_payments(limit=2)
+        self.assertEqual(result, [CC_RETURN, DC_RETURN])
+        result = self.ps.get_payments(limit=2, after=2)
+        self.assertEqual(result, [PP_RETURN])
+        with self.assertRaises(PaymentNotFoundError):
+            self.ps.get_payments(limit=2, after=3)
+
+    def test_interface_get_page_with_ids_and_attributes(self):
+        for d in (DEBIT, PAYPAL):
+            p = Payment()
+            p.deserialize(d)
+            app_db.session.add(p)
+        app_db.session.commit()
+
+        result = self.ps.get_payments(payment_ids=[1, 2, 3], limit=1, after=1)
+        self.assertEqual(result, [DC_RETURN])
+        result = self.ps.get_payments(payment_attributes={'user_id' : 1}, limit=1)
+        self.assertEqual(result, [CC_RETURN])
+        result = self.ps.get_payments(payment_attributes={'user_id' : 1}, limit=1, after=1)
+        self.assertEqual(result, [PP_RETURN])
+
+    def test_interface_stream_payments(self):
+        for d in (DEBIT, PAYPAL):
+            p = Payment()
+            p.deserialize(d)
+            app_db.session.add(p)
+        app_db.session.commit()
+
+        result = self.ps.stream_payments(batch_size=2)
+        self.assertEqual(list(result), [CC_RETURN, DC_RETURN, PP_RETURN])
+        result = self.ps.stream_payments(payment_attributes={'user_id' : 1}, after=1)
+        self.assertEqual(list(result), [PP_RETURN])
+        result = self.ps.stream_payments(payment_ids=[2, 3], after=3)
+        self.assertEqual(list(result), [])
 
-        self.assertEqual(len(payments), 3)
-        payments = self.ps._remove_soft_deletes(payments)
-        self.assertEqual(len(payments), 0)
-        self.assertEqual(payments, [])
+    def test_interface_stream_payments_bad_attribute(self):
+        with self.assertRaises(DataValidationError):
+            self.ps.stream_payments(payment_attributes={'whatever' : 'man'})
 
     def test_interface_query_nickname(self):
         q = {'nickname' : 'my credit'}
@@ -332,6 +379,47 @@ class TestInterface(unittest.TestCase):
             self.ps.add_payment(garbage)
         self.assertTrue('bad or no data' in e.exception.message)
 
+    def test_interface_add_payments_batch(self):
+        results = self.ps.add_payments([DEBIT, BAD_DATA, PAYPAL, 'garbage', CREDIT], chunk_size=2)
+        self.assertEqual(len(results), 5)
+        self.assertEqual([r['nickname'] for r in results if isinstance(r, dict)], ['my debit', 'my paypal', 'my credit'])
+        self.assertTrue('missing nickname' in results[1].message)
+        self.assertTrue('bad or no data' in results[3].message)
+
+        # every created payment is in the db under the id it was returned with
+        for result in (results[0], results[2], results[4]):
+            p = app_db.session.query(Payment).get(result['payment_id'])
+            self.assertEqual(p.serialize(), result)
+        self.assertEqual(app_db.session.query(Payment).count(), 4)
+
+    def test_interface_add_payments_batch_from_iterator(self):
+        results = self.ps.add_payments(iter([DEBIT, PAYPAL]), chunk_size=1)
+        self.assertEqual([r['payment_id'] for r in results], [2, 3])
+
+    def test_interface_iter_add_payments(self):
+        # each chunk is committed and its results handed out before the next one is read
+        read = []
+        payloads = (read.append(payload) or payload for payload in [DEBIT, PAYPAL, CREDIT])
+        results = self.ps.iter_add_payments(payloads, chunk_size=2)
+        self.assertEqual(read, [])
+        self.assertEqual(next(results)['payment_id'], 2)
+        self.assertEqual(len(read), 2)
+        self.assertEqual([r['payment_id'] for r in results], [3, 4])
+
+    def test_interface_add_payments_batch_query_error(self):
+        # a chunk that cannot be written fails as a whole; the other chunks are kept
+        with mock.patch.object(PaymentService, '_insert_payments', side_effect=[None, exc.SQLAlchemyError]):
+            results = self.ps.add_payments([DEBIT, PAYPAL, BAD_DATA], chunk_size=2)
+        self.assertEqual(type(results[0]), dict)
+        self.assertEqual(type(results[1]), dict)
+        self.assertTrue(isinstance(results[2], DataValidationError))
+
+        with mock.patch.object(PaymentService, '_insert_payments', side_effect=exc.SQLAlchemyError):
+            results = self.ps.add_payments([DEBIT, BAD_DATA], chunk_size=2)
+        self.assertEqual(type(results[0]), PaymentServiceQueryError)
+        self.assertTrue(isinstance(results[1], DataValidationError))
+        self.assertEqual(app_db.session.query(Payment).count(), 1)
+
     @mock.patch.object(Payment, 'deserialize')
     @mock.patch.object(Payment, 'serialize', return_value=CC_RETURN)
     @mock.patch.object(app_db, 'session')
@@ -365,32 +453,32 @@ class TestInterface(unittest.TestCase):
         self.assertEqual(PP_RETURN, payment)
         self.assertEqual(temp, payment['details'])
 
-    @mock.patch.object(PaymentService, '_remove_soft_deletes')
+    @mock.patch.object(Payment, 'serialize_row')
     @mock.patch.object(app_db, 'session')
-    def test_interface_query_payments(self, mock_db, mock_remove):
-        # this is a long mock - note that the method call chaining matches that of the method call
-        # on self.db in _query_payments
-
-
-        # set the return value of ...filter_by() to a new mock whose all property is a function that
-        # returns [DC_RETURN]; this is done so that when payment_query.all() is called, [DC_RETURN] is returned
-        mock_db.query(Payment).filter_by.return_value = mock.MagicMock(all=lambda: [DC_RETURN])
-        mock_remove.return_value = [DC_RETURN]
-        result = self.ps._query_payments(QUERY_ATTRIBUTES)
-
-        mock_db.query(Payment).filter_by.assert_called_once_with(**QUERY_ATTRIBUTES)
-        mock_remove.assert_called_once()
+    def test_interface_stream_query_mock(self, mock_db, mock_serialize):
+        mock_serialize.return_value = DC_RETURN
+        mock_db.execute.return_value = [mock.Mock()]
+        result = list(self.ps.stream_payments(payment_attributes=QUERY_ATTRIBUTES))
+
+        mock_db.execute.assert_called_once()
+        statement = str(mock_db.execute.call_args[0][0])
+        # removed payments are never listed
+        self.assertIn('payment.is_removed', statement)
+        self.assertIn('payment.user_id =', statement)
+        self.assertIn('payment.nickname =', statement)
         self.assertEqual(result, [DC_RETURN])
 
-
     @mock.patch.object(app_db, 'session')
-    def test_interface_query_payments_error(self, mock_db):
-        mock_db.query(Payment).filter_by.side_effect = PaymentServiceQueryError
+    def test_interface_get_query_error(self, mock_db):
+        # e.g. an attribute compared with a value of the wrong type
+        mock_db.execute.side_effect = exc.DataError('SELECT', {}, 'invalid input syntax for integer')
+        with self.assertRaises(DataValidationError):
+            self.ps.get_payments(payment_attributes=QUERY_ATTRIBUTES)
+        mock_db.execute.assert_called_once()
 
-        with self.assertRaises(PaymentServiceQueryError):
-            result = self.ps._query_payments(QUERY_ATTRIBUTES)
-        # also check that the mocked app_db was called appropriately
-        mock_db.query(Payment).filter_by.assert_called_once_with(**QUERY_ATTRIBUTES)
+        # without attributes to blame, the failure is the database's
+        with self.assertRaises(exc.DataError):
+            self.ps.get_payments(payment_ids=[1])
 
     #Testing delete/remove payments
     @mock.patch.object(app_db, 'session')
@@ -518,279 +606,620 @@ class TestInterface(unittest.TestCase):
         mock_db.commit.assert_not_called()
 
     # set-default action test cases
-    @mock.patch.object(app_db, 'session')
-    @mock.patch.object(PaymentService, '_query_payments')
-    def test_interface_payment_set_default_action_success(self, mock_query, mock_db):
-        user_id = payment_id = 1
-        payment_default_data = {'payment_id' : payment_id}
-        user_data = {'user_id': user_id}
-
-        cc_payment = Payment()
-        cc_payment.deserialize(CC_RETURN)
-        cc_payment.id = 1
-
-        pp_payment = Payment()
-        pp_payment.deserialize(PP_RETURN)
-        pp_payment.id = 3
+    def _default_payment_ids(self, user_id):
+        app_db.session.expire_all()
+        payments = app_db.session.query(Payment).filter_by(user_id=user_id, is_default=True).all()
+        return [payment.id for payment in payments]
 
-        self.assertFalse(cc_payment.is_default)
-        self.assertFalse(pp_payment.is_default)
-
-        mock_query.return_value = [cc_payment, pp_payment]
+    def test_interface_payment_set_default_action_success(self):
+        user_id = payment_id = 1
+        p = Payment()
+        p.deserialize(PAYPAL)
+        app_db.session.add(p)
+        app_db.session.commit()
+        self.assertEqual(self._default_payment_ids(user_id), [])
 
-        result = self.ps.perform_payment_action(user_id,payment_attributes=payment_default_data)
+        result = self.ps.perform_payment_action(user_id,payment_attributes={'payment_id' : payment_id})
         self.assertTrue(result)
+        self.assertEqual(self._default_payment_ids(user_id), [1])
 
-        self.assertTrue(cc_payment.is_default)
-        self.assertFalse(pp_payment.is_default)
+        result = self.ps.perform_payment_action(user_id,payment_attributes={'payment_id' : p.id})
+        self.assertTrue(result)
+        self.assertEqual(self._default_payment_ids(user_id), [p.id])
 
-        mock_query.assert_called_once_with(payment_attributes=user_data)
-        mock_db.commit.assert_called_once()
+        #setting the current default again changes nothing
+        result = self.ps.perform_payment_action(user_id,payment_attributes={'payment_id' : p.id})
+        self.assertTrue(result)
+        self.assertEqual(self._default_payment_ids(user_id), [p.id])
 
-    @mock.patch.object(app_db, 'session')
-    @mock.patch.object(PaymentService, '_query_payments')
-    def test_interface_payment_set_default_action_with_no_payment_found_for_the_user(self, mock_query, mock_db):
+    def test_interface_payment_set_default_action_with_no_payment_found_for_the_user(self):
         user_id = 1
-        payment_default_data = {'payment_id' : 2}
-        user_data = {'user_id': user_id}
-
-        cc_payment = Payment()
-        cc_payment.deserialize(CC_RETURN)
-        cc_payment.id = 1
+        self.assertTrue(self.ps.perform_payment_action(user_id,payment_attributes={'payment_id' : 1}))
 
-        pp_payment = Payment()
-        pp_payment.deserialize(PP_RETURN)
-        pp_payment.id = 3
+        #unknown payment id
+        result = self.ps.perform_payment_action(user_id,payment_attributes={'payment_id' : 2})
+        self.assertFalse(result)
+        self.assertEqual(self._default_payment_ids(user_id), [1])
 
-        self.assertFalse(cc_payment.is_default)
-        self.assertFalse(pp_payment.is_default)
+        #payment of another user
+        p = Payment()
+        p.deserialize(DEBIT)
+        app_db.session.add(p)
+        app_db.session.commit()
+        result = self.ps.perform_payment_action(user_id,payment_attributes={'payment_id' : p.id})
+        self.assertFalse(result)
+        self.assertEqual(self._default_payment_ids(user_id), [1])
+        self.assertEqual(self._default_payment_ids(DEBIT['user_id']), [])
 
-        mock_query.return_value = [cc_payment, pp_payment]
+    def test_interface_payment_set_default_action_with_removed_payment(self):
+        user_id = 1
+        self.assertTrue(self.ps.perform_payment_action(user_id,payment_attributes={'payment_id' : 1}))
+        p = Payment()
+        p.deserialize(PAYPAL)
+        p.is_removed = True
+        app_db.session.add(p)
+        app_db.session.commit()
 
-        result = self.ps.perform_payment_action(user_id,payment_attributes=payment_default_data)
+        result = self.ps.perform_payment_action(user_id,payment_attributes={'payment_id' : p.id})
         self.assertFalse(result)
+        self.assertEqual(self._default_payment_ids(user_id), [1])
 
-        self.assertFalse(cc_payment.is_default)
-        self.assertFalse(pp_payment.is_default)
+    def test_interface_payment_one_default_per_user(self):
+        #the unique partial index rejects a second live default for the same user
+        self.assertTrue(self.ps.perform_payment_action(1,payment_attributes={'payment_id' : 1}))
+        p = Payment()
+        p.deserialize(PAYPAL)
+        p.is_default = True
+        app_db.session.add(p)
+        with self.assertRaises(exc.IntegrityError):
+            app_db.session.commit()
+        app_db.session.rollback()
 
-        mock_query.assert_called_once_with(payment_attributes=user_data)
-        mock_db.commit.assert_not_called()
+        #removed payments do not count
+        p = Payment()
+        p.deserialize(PAYPAL)
+        p.is_default = True
+        p.is_removed = True
+        app_db.session.add(p)
+        app_db.session.commit()
 
     @mock.patch.object(app_db, 'session')
-    @mock.patch.object(PaymentService, '_query_payments', side_effect = PaymentServiceQueryError)
-    def test_interface_payment_set_default_action_with_no_payments_for_user(self, mock_query, mock_db):
+    def test_interface_payment_set_default_action_with_bad_payment_id(self, mock_db):
         user_id = 1
-        payment_default_data = {'payment_id' : 2}
-        user_data = {'user_id': user_id}
+        for payment_id in ('abc', '1', [1], True, 1.5, None):
+            with self.assertRaises(DataValidationError):
+                self.ps.perform_payment_action(user_id,payment_attributes={'payment_id' : payment_id})
+        #rejected before any query
+        mock_db.execute.assert_not_called()
 
-        with self.assertRaises(DataValidationError) as e:
-            result = self.ps.perform_payment_action(user_id,payment_attributes=payment_default_data)
+    @mock.patch.object(app_db, 'session')
+    def test_interface_payment_set_default_action_retries_after_conflict(self, mock_db):
+        user_id = payment_id = 1
+        conflict = exc.IntegrityError('UPDATE', {}, 'duplicate key value violates unique constraint')
+        cleared = mock.MagicMock(fetchall=lambda: [])
+        chosen = mock.MagicMock(fetchall=lambda: [(payment_id,)])
+        locked = mock.MagicMock()
+        mock_db.execute.side_effect = [locked, cleared, conflict, locked, cleared, chosen]
 
-        self.assertTrue('Payments not found' in e.exception.message)
+        result = self.ps.perform_payment_action(user_id,payment_attributes={'payment_id' : payment_id})
+        self.assertTrue(result)
+        self.assertEqual(mock_db.execute.call_count, 6)
+        mock_db.rollback.assert_called_once()
+        mock_db.commit.assert_called_once()
 
-        mock_query.assert_called_once_with(payment_attributes=user_data)
-        mock_db.commit.assert_not_called()
+    def test_interface_payment_set_default_action_concurrently(self):
+        #concurrent set-defaults for one user wait for each other instead of failing
+        user_id = 1
+        p = Payment()
+        p.deserialize(PAYPAL)
+        app_db.session.add(p)
+        app_db.session.commit()
+        payment_ids = [1, p.id]
+        results = []
+
+        def set_defaults(offset):
+            with app.app_context():
+                try:
+                    for attempt in range(15):
+                        payment_id = payment_ids[(offset + attempt) % 2]
+                        results.append(self.ps.perform_payment_action(user_id, payment_attributes={'payment_id': payment_id}))
+                except Exception as e:
+                    results.append(e)
+                finally:
+                    app_db.session.remove()
+
+        threads = [threading.Thread(target=set_defaults, args=(offset,)) for offset in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [True] * 120)
+        self.assertEqual(len(self._default_payment_ids(user_id)), 1)
 
-    #charge action test cases
     @mock.patch.object(app_db, 'session')
-    @mock.patch.object(PaymentService, '_query_payments')
-    def test_interface_payment_charge_action_for_card_success(self, mock_query, mock_db):
-        #This test case also tests is_expired (as the default payment here is a card) interface utility method which returns false
+    def test_interface_payment_set_default_action_with_no_payments_for_user(self, mock_db):
         user_id = 1
-        amount_data = {'amount' : 25.0}
-        user_data = {'user_id': user_id}
+        payment_default_data = {'payment_id' : 2}
+        mock_db.execute.side_effect = exc.OperationalError('UPDATE', {}, 'connection lost')
 
-        cc_payment = Payment()
-        cc_payment.deserialize(CC_RETURN)
-        cc_payment.id = 1
-        cc_payment.is_default = True
+        #a failing database is not the client's fault
+        with self.assertRaises(PaymentServiceQueryError):
+            result = self.ps.perform_payment_action(user_id,payment_attributes=payment_default_data)
 
-        pp_payment = Payment()
-        pp_payment.deserialize(PP_RETURN)
-        pp_payment.id = 3
+        mock_db.commit.assert_not_called()
 
-        self.assertEqual(cc_payment.charge_history,0.0)
-        self.assertEqual(pp_payment.charge_history,0.0)
+    #charge action test cases
+    def _add_default_payment(self, data, **attributes):
+        p = Payment()
+        p.deserialize(data)
+        p.is_default = True
+        for key in attributes:
+            setattr(p, key, attributes[key])
+        app_db.session.add(p)
+        app_db.session.commit()
+        return p.id
 
-        mock_query.return_value = [cc_payment, pp_payment]
+    def test_interface_payment_charge_action_for_card_success(self):
+        #setUp's card expired in 01/2019, so the default is a card that has not expired yet
+        user_id = 1
+        card = copy.deepcopy(CREDIT)
+        card['details']['expires'] = '12/2099'
+        payment_id = self._add_default_payment(card)
 
-        result = self.ps.perform_payment_action(user_id,payment_attributes=amount_data)
+        result = self.ps.perform_payment_action(user_id,payment_attributes={'amount' : 25.0})
+        self.assertTrue(result)
+        result = self.ps.perform_payment_action(user_id,payment_attributes={'amount' : 10.5})
         self.assertTrue(result)
 
-        self.assertEqual(cc_payment.charge_history,25.0)
-        self.assertEqual(pp_payment.charge_history,0.0)
-
-        mock_query.assert_called_once_with(payment_attributes=user_data)
-        mock_db.commit.assert_called_once()
+        app_db.session.expire_all()
+        self.assertEqual(app_db.session.query(Payment).get(payment_id).charge_history, 35.5)
+        self.assertEqual(app_db.session.query(Payment).get(1).charge_history, 0.0)
 
-    @mock.patch.object(app_db, 'session')
-    @mock.patch.object(PaymentService, '_query_payments')
-    def test_interface_payment_charge_action_for_paypal_success(self, mock_query, mock_db):
+    def test_interface_payment_charge_action_for_paypal_success(self):
         user_id = 1
-        amount_data = {'amount' : 25.0}
-        user_data = {'user_id': user_id}
-
-        cc_payment = Payment()
-        cc_payment.deserialize(CC_RETURN)
-        cc_payment.id = 1
+        payment_id = self._add_default_payment(PAYPAL)
 
-        pp_payment = Payment()
-        pp_payment.deserialize(PP_RETURN)
-        pp_payment.id = 3
-        pp_payment.details.is_linked = True
-        pp_payment.is_default = True
-
-        self.assertEqual(cc_payment.charge_history,0.0)
-        self.assertEqual(pp_payment.charge_history,0.0)
-
-        mock_query.return_value = [cc_payment, pp_payment]
-
-        result = self.ps.perform_payment_action(user_id,payment_attributes=amount_data)
+        result = self.ps.perform_payment_action(user_id,payment_attributes={'amount' : 25.0})
         self.assertTrue(result)
 
-        self.assertEqual(cc_payment.charge_history,0.0)
-        self.assertEqual(pp_payment.charge_history,25.0)
+        app_db.session.expire_all()
+        self.assertEqual(app_db.session.query(Payment).get(payment_id).charge_history, 25.0)
+        self.assertEqual(app_db.session.query(Payment).get(1).charge_history, 0.0)
 
-        mock_query.assert_called_once_with(payment_attributes=user_data)
-        mock_db.commit.assert_called_once()
-
-    @mock.patch.object(app_db, 'session')
-    @mock.patch.object(PaymentService, '_query_payments')
-    def test_interface_payment_charge_action_with_no_default_payment(self, mock_query, mock_db):
+    def test_interface_payment_charge_action_with_no_default_payment(self):
         user_id = 1
-        amount_data = {'amount' : 25.0}
-        user_data = {'user_id': user_id}
-
-        cc_payment = Payment()
-        cc_payment.deserialize(CC_RETURN)
-        cc_payment.id = 1
-
-        pp_payment = Payment()
-        pp_payment.deserialize(PP_RETURN)
-        pp_payment.id = 3
+        with self.assertRaises(DataValidationError) as e:
+            result = self.ps.perform_payment_action(user_id,payment_attributes={'amount' : 25.0})
 
-        self.assertEqual(cc_payment.charge_history,0.0)
-        self.assertEqual(pp_payment.charge_history,0.0)
+        self.assertTrue('update the default_payment' in e.exception.message)
+        app_db.session.expire_all()
+        self.assertEqual(app_db.session.query(Payment).get(1).charge_history, 0.0)
 
-        mock_query.return_value = [cc_payment, pp_payment]
+    def test_interface_payment_charge_action_with_removed_default_payment(self):
+        user_id = 1
+        card = copy.deepcopy(CREDIT)
+        card['details']['expires'] = '12/2099'
+        payment_id = self._add_default_payment(card, is_removed=True)
 
         with self.assertRaises(DataValidationError) as e:
-            result = self.ps.perform_payment_action(user_id,payment_attributes=amount_data)
+            result = self.ps.perform_payment_action(user_id,payment_attributes={'amount' : 25.0})
 
         self.assertTrue('update the default_payment' in e.exception.message)
+        app_db.session.expire_all()
+        self.assertEqual(app_db.session.query(Payment).get(payment_id).charge_history, 0.0)
 
-        self.assertEqual(cc_payment.charge_history,0.0)
-        self.assertEqual(pp_payment.charge_history,0.0)
-
-        mock_query.assert_called_once_with(payment_attributes=user_data)
-        mock_db.commit.assert_not_called()
-
-    @mock.patch.object(app_db, 'session')
-    @mock.patch.object(PaymentService, '_query_payments')
-    def test_interface_payment_charge_action_with_default_payment_card_expired(self, mock_query, mock_db):
-        #This test case also tests is_expired interface utility method which returns true
+    def test_interface_payment_charge_action_with_default_payment_card_expired(self):
+        # the card's expires_at is in the past, so it cannot be charged
         user_id = 1
-        amount_data = {'amount' : 25.0}
-        user_data = {'user_id': user_id}
-
-        cc_payment = Payment()
-        cc_payment.deserialize(CC_RETURN)
-        cc_payment.id = 1
-        cc_payment.is_default = True
-        cc_payment.details.expires = '01/2017'
+        payment = app_db.session.query(Payment).get(1)
+        payment.is_default = True
+        payment.details.expires = '01/2017'
+        app_db.session.commit()
 
-        pp_payment = Payment()
-        pp_payment.deserialize(PP_RETURN)
-        pp_payment.id = 3
+        with self.assertRaises(DataValidationError) as e:
+            result = self.ps.perform_payment_action(user_id,payment_attributes={'amount' : 25.0})
 
-        self.assertEqual(cc_payment.charge_history,0.0)
-        self.assertEqual(pp_payment.charge_history,0.0)
+        self.assertTrue('(credit) is expired' in e.exception.message)
+        app_db.session.expire_all()
+        self.assertEqual(app_db.session.query(Payment).get(1).charge_history, 0.0)
 
-        mock_query.return_value = [cc_payment, pp_payment]
+    def test_interface_payment_charge_action_with_default_payment_bad_expiry(self):
+        user_id = 1
+        payment = app_db.session.query(Payment).get(1)
+        payment.is_default = True
+        payment.details.expires = '13/2099'
+        app_db.session.commit()
 
         with self.assertRaises(DataValidationError) as e:
-            result = self.ps.perform_payment_action(user_id,payment_attributes=amount_data)
+            result = self.ps.perform_payment_action(user_id,payment_attributes={'amount' : 25.0})
 
         self.assertTrue('is expired' in e.exception.message)
 
-        self.assertEqual(cc_payment.charge_history,0.0)
-        self.assertEqual(pp_payment.charge_history,0.0)
+    def test_interface_payment_charge_action_with_default_payment_paypal_not_linked(self):
+        user_id = 1
+        payment_id = self._add_default_payment(PAYPAL)
+        app_db.session.query(Payment).get(payment_id).details.is_linked = False
+        app_db.session.commit()
 
-        mock_query.assert_called_once_with(payment_attributes=user_data)
-        mock_db.commit.assert_not_called()
+        with self.assertRaises(DataValidationError) as e:
+            result = self.ps.perform_payment_action(user_id,payment_attributes={'amount' : 25.0})
+
+        self.assertTrue(' not linked' in e.exception.message)
+        app_db.session.expire_all()
+        self.assertEqual(app_db.session.query(Payment).get(payment_id).charge_history, 0.0)
 
     @mock.patch.object(app_db, 'session')
-    @mock.patch.object(PaymentService, '_query_payments')
-    def test_interface_payment_charge_action_with_default_payment_paypal_not_linked(self, mock_query, mock_db):
+    def test_interface_payment_charge_action_with_query_error(self, mock_db):
         user_id = 1
-        amount_data = {'amount' : 25.0}
-        user_data = {'user_id': user_id}
-
-        cc_payment = Payment()
-        cc_payment.deserialize(CC_RETURN)
-        cc_payment.id = 1
+        mock_db.execute.side_effect = exc.OperationalError('UPDATE', {}, 'connection lost')
 
-        pp_payment = Payment()
-        pp_payment.deserialize(PP_RETURN)
-        pp_payment.id = 3
-        pp_payment.is_default = True
-        pp_payment.details.is_linked = False
+        #a failing database is not the client's fault
+        with self.assertRaises(PaymentServiceQueryError):
+            result = self.ps.perform_payment_action(user_id,payment_attributes={'amount' : 25.0})
 
-        self.assertEqual(cc_payment.charge_history,0.0)
-        self.assertEqual(pp_payment.charge_history,0.0)
+        mock_db.rollback.assert_called_once()
+        mock_db.commit.assert_not_called()
 
-        mock_query.return_value = [cc_payment, pp_payment]
+    def test_interface_charge_payments_batch(self):
+        card = copy.deepcopy(CREDIT)
+        card['details']['expires'] = '12/2099'
+        card_id = self._add_default_payment(card)
+        paypal = dict(PAYPAL, user_id=2)
+        paypal_id = self._add_default_payment(paypal)
+        unlinked = dict(PAYPAL, user_id=3)
+        unlinked_id = self._add_default_payment(unlinked)
+        app_db.session.query(Payment).get(unlinked_id).details.is_linked = False
+        app_db.session.commit()
 
+        charges = [{'user_id': 1, 'amount': 10.0}, {'user_id': 2, 'amount': 5.5},
+                   {'user_id': 1, 'amount': 2.5}, {'user_id': 3, 'amount': 1.0},
+                   {'user_id': 4, 'amount': 1.0}, {'user_id': 2, 'amount': -1.0},
+                   {'user_id': 2}, 'garbage']
+        results = self.ps.charge_payments(charges, chunk_size=5)
+
+        self.assertEqual(results[:3], [True, True, True])
+        self.assertTrue(' not linked' in results[3].message)
+        self.assertTrue('update the default_payment' in results[4].message)
+        self.assertTrue('is negative' in results[5].message)
+        self.assertTrue('does not have the amount' in results[6].message)
+        self.assertTrue('bad or no data' in results[7].message)
+
+        app_db.session.expire_all()
+        self.assertEqual(app_db.session.query(Payment).get(card_id).charge_history, 12.5)
+        self.assertEqual(app_db.session.query(Payment).get(paypal_id).charge_history, 5.5)
+        self.assertEqual(app_db.session.query(Payment).get(unlinked_id).charge_history, 0.0)
+        self.assertEqual(app_db.session.query(Payment).get(1).charge_history, 0.0)
+
+    def test_interface_charge_payments_batch_single_statement(self):
+        # the default payments are looked up and charged by the same INSERT ... SELECT,
+        # so nothing can change between finding a default payment and charging it
+        payment_id = self._add_default_payment(PAYPAL)
+        executed = []
+        count = lambda conn, cursor, statement, parameters, context, executemany: executed.append(statement)
+        event.listen(app_db.engine, 'after_cursor_execute', count)
+        try:
+            results = self.ps.charge_payments([{'user_id': 1, 'amount': 1.0}, {'user_id': 1, 'amount': 2.0}])
+        finally:
+            event.remove(app_db.engine, 'after_cursor_execute', count)
+        self.assertEqual(results, [True, True])
+        self.assertEqual(len(executed), 1)
+        self.assertTrue(executed[0].lstrip().startswith('WITH'))
+        self.assertIn('INSERT INTO charge', executed[0])
+
+        # a payment that is no longer the default is not charged
+        app_db.session.query(Payment).get(payment_id).is_default = False
+        app_db.session.commit()
+        results = self.ps.charge_payments([{'user_id': 1, 'amount': 1.0}])
+        self.assertTrue('update the default_payment' in results[0].message)
+        app_db.session.expire_all()
+        self.assertEqual(app_db.session.query(Payment).get(payment_id).charge_history, 3.0)
+
+    def test_interface_charge_payments_batch_query_error(self):
+        self._add_default_payment(PAYPAL)
+        with mock.patch.object(PaymentService, '_charge_default_payments', side_effect=exc.OperationalError('UPDATE', {}, 'connection lost')):
+            results = self.ps.charge_payments([{'user_id': 1, 'amount': 1.0}, {'user_id': 1, 'amount': 0}])
+        self.assertEqual(type(results[0]), PaymentServiceQueryError)
+        self.assertEqual(type(results[1]), DataValidationError)
+
+    def test_interface_charge_bad_amounts(self):
+        self._add_default_payment(PAYPAL)
+        amounts = ['5', None, [], True, float('nan'), float('inf'), 10 ** 20, 10.0 ** 14]
+        for amount in amounts:
+            with self.assertRaises(DataValidationError) as e:
+                self.ps.perform_payment_action(1, payment_attributes={'amount': amount})
+            self.assertTrue('Order amount' in e.exception.message)
+
+        results = self.ps.charge_payments([{'user_id': 1, 'amount': amount} for amount in amounts])
+        self.assertEqual([type(result) for result in results], [DataValidationError] * len(amounts))
+        self.assertEqual(self._ledger(2), [])
+
+    def _ledger(self, payment_id):
+        return [row[0] for row in app_db.session.query(Charge.amount_minor)
+                .filter(Charge.payment_id == payment_id).order_by(Charge.id)]
+
+    def test_interface_charges_are_appended_to_ledger(self):
+        card = copy.deepcopy(CREDIT)
+        card['details']['expires'] = '12/2099'
+        payment_id = self._add_default_payment(card)
+
+        self.ps.perform_payment_action(1, payment_attributes={'amount': 0.1})
+        self.ps.perform_payment_action(1, payment_attributes={'amount': 0.2})
+        self.ps.charge_payments([{'user_id': 1, 'amount': 19.995}, {'user_id': 1, 'amount': 1}])
+
+        self.assertEqual(self._ledger(payment_id), [10, 20, 2000, 100])
+        payment = app_db.session.query(Payment).get(payment_id)
+        self.assertEqual(payment.charge_history, 21.3)
+        self.assertEqual((payment.charge_total_minor, payment.version), (0, 1))
+        self.assertEqual(payment.revision, 5)
+
+    def test_interface_charge_less_than_one_cent(self):
+        card = copy.deepcopy(CREDIT)
+        card['details']['expires'] = '12/2099'
+        payment_id = self._add_default_payment(card)
         with self.assertRaises(DataValidationError) as e:
-            result = self.ps.perform_payment_action(user_id,payment_attributes=amount_data)
+            self.ps.perform_payment_action(1, payment_attributes={'amount': 0.004})
+        self.assertTrue('less than one cent' in e.exception.message)
+        results = self.ps.charge_payments([{'user_id': 1, 'amount': 0.001}])
+        self.assertTrue('less than one cent' in results[0].message)
+        self.assertEqual(self._ledger(payment_id), [])
+
+    def test_interface_compact_charges(self):
+        card = copy.deepcopy(CREDIT)
+        card['details']['expires'] = '12/2099'
+        payment_id = self._add_default_payment(card)
+        self.ps.perform_payment_action(1, payment_attributes={'amount': 5.0})
+        self.ps.charge_payments([{'user_id': 1, 'amount': 2.5}, {'user_id': 1, 'amount': 1.25}])
+        body, version = self.ps.get_payment_response(payment_id)
+
+        # nothing is old enough yet
+        self.assertEqual(self.ps.compact_charges(grace=3600), 0)
+        self.assertEqual(self.ps.compact_charges(grace=0), 1)
+        self.assertEqual(self.ps.compact_charges(grace=0), 0)
+
+        app_db.session.expire_all()
+        payment = app_db.session.query(Payment).get(payment_id)
+        self.assertEqual((payment.charge_total_minor, payment.charge_count), (875, 3))
+        self.assertEqual(payment.charge_history, 8.75)
+        # the ledger is kept, and the total and version the client sees do not change
+        self.assertEqual(self._ledger(payment_id), [500, 250, 125])
+        self.assertEqual(payment.revision, version)
+        self.assertEqual(self.ps.get_payment_response(payment_id), (body, version))
+
+        self.ps.perform_payment_action(1, payment_attributes={'amount': 1.0})
+        self.assertEqual(self._cached_payment(payment_id)['charge_history'], 9.75)
+        self.assertEqual(self.ps.get_payment_version(payment_id), version + 1)
+
+    def _cached_payment(self, payment_id):
+        body, version = self.ps.get_payment_response(payment_id)
+        return json.loads(body)[0]
+
+    def test_interface_get_payment_response_is_cached(self):
+        body, version = self.ps.get_payment_response(1)
+        self.assertEqual(json.loads(body), [CC_RETURN])
+        self.assertEqual(version, 1)
+        with mock.patch.object(PaymentService, '_live_payments') as mock_query:
+            self.assertEqual(self.ps.get_payment_response(1), (body, version))
+            self.assertEqual(self.ps.get_payment_version(1), 1)
+            mock_query.assert_not_called()
+        self.assertEqual(self.ps.cache.stats()['hits'], 2)
+        self.assertEqual(self.ps.cache.stats()['misses'], 1)
+
+    def test_interface_get_expiring_payments(self):
+        # setUp's card expires in 01/2019
+        later = copy.deepcopy(DEBIT)
+        later['details']['expires'] = '06/2030'
+        removed = copy.deepcopy(DEBIT)
+        removed['details']['expires'] = '01/2018'
+        for data in (later, PAYPAL, removed, later):
+            self.ps.add_payment(data)
+        self.ps.remove_payment(4)
+
+        expiring = self.ps.get_expiring_payments(date(2019, 2, 1))
+        self.assertEqual([p['payment_id'] for p in expiring], [1])
+        self.assertEqual(self.ps.get_expiring_payments(date(2019, 1, 31)), [])
+
+        expiring = self.ps.get_expiring_payments(date(2030, 7, 1), limit=1)
+        self.assertEqual([p['payment_id'] for p in expiring], [1])
+        expiring = self.ps.get_expiring_payments(date(2030, 7, 1), after=1)
+        self.assertEqual([p['payment_id'] for p in expiring], [2, 5])
+
+    def test_interface_user_summaries(self):
+        # user 1: the seeded credit card, a default paypal account that is charged twice and a removed card
+        paypal_id = self._add_default_payment(PAYPAL)
+        self.ps.perform_payment_action(1, payment_attributes={'amount': 10.25})
+        self.ps.charge_payments([{'user_id': 1, 'amount': 4.5}])
+        self.ps.add_payment(DEBIT)
+        removed = self.ps.add_payment(dict(CREDIT, nickname='old card'))
+        self.ps.remove_payment(removed['payment_id'])
+        self.ps.compact_charges(grace=0)
+        self.ps.perform_payment_action(1, payment_attributes={'amount': 0.25})
+
+        loaded = []
+        load = lambda target, context: loaded.append(target)
+        event.listen(Payment, 'load', load)
+        try:
+            summaries = self.ps.get_user_summaries()
+            summary = self.ps.get_user_summary(1)
+        finally:
+            event.remove(Payment, 'load', load)
+        self.assertEqual(loaded, [])
+
+        self.assertEqual(summary, {'user_id': 1, 'payments': 2, 'default_payment_id': paypal_id,
+                                   'payments_by_type': {'credit': 1, 'debit': 0, 'paypal': 1},
+                                   'total_charged': 15.0})
+        self.assertEqual(summaries, [summary, {'user_id': 2, 'payments': 1, 'default_payment_id': None,
+                                               'payments_by_type': {'credit': 0, 'debit': 1, 'paypal': 0},
+                                               'total_charged': 0.0}])
+        self.assertEqual(self.ps.get_user_summaries(limit=1), [summary])
+        self.assertEqual([s['user_id'] for s in self.ps.get_user_summaries(after=1)], [2])
+        with self.assertRaises(PaymentNotFoundError):
+            self.ps.get_user_summary(3)
+        # aggregate FILTER clauses need PostgreSQL 9.4
+        self.assertNotIn('FILTER', str(self.ps._user_summaries()))
 
-        self.assertTrue(' not linked' in e.exception.message)
+    def count_statements(self, url, headers=None):
+        """ The number of SQL statements run to serve a GET of url """
+        # the requests share the test's session, so start from an empty identity map
+        app_db.session.remove()
+        executed = []
+        count = lambda conn, cursor, statement, parameters, context, executemany: executed.append(statement)
+        event.listen(app_db.engine, 'after_cursor_execute', count)
+        try:
+            resp = self.app.get(url, headers=headers)
+            resp.get_data()
+        finally:
+            event.remove(app_db.engine, 'after_cursor_execute', count)
+        self.assertEqual(resp.status_code, 200)
+        return len(executed)
+
+    def test_interface_list_statements_do_not_grow_with_rows(self):
+        # every list loads the payments' details in the same query as the payments
+        requests = [('/payments', None), ('/payments?user_id=1', None), ('/payments?limit=5', None),
+                    ('/payments/expiring?before=2031-01-01', None),
+                    ('/payments', {'Accept': 'application/x-ndjson'})]
+        statements = [self.count_statements(url, headers) for url, headers in requests]
+        for _ in range(30):
+            p = Payment()
+            p.deserialize(CREDIT)
+            app_db.session.add(p)
+        app_db.session.commit()
+        self.assertEqual([self.count_statements(url, headers) for url, headers in requests], statements)
+        self.assertEqual(self.count_statements('/payments/2'), 1)
+        # the page and its ETag come from one query; only If-None-Match looks up the versions first
+        self.assertEqual(self.count_statements('/payments'), 1)
+        self.assertEqual(self.count_statements('/payments', {'If-None-Match': '"stale"'}), 2)
+
+    def test_interface_get_payments_with_versions(self):
+        self.ps.update_payment(1, payment_attributes={'nickname': 'renamed'})
+        payments, versions = self.ps.get_payments(payment_attributes={'user_id': 1}, with_versions=True)
+        self.assertEqual(payments, self.ps.get_payments(payment_attributes={'user_id': 1}))
+        self.assertEqual(versions, self.ps.get_payment_versions(payment_attributes={'user_id': 1}))
+        self.assertEqual(versions[0], (1, 2))
+
+    def test_interface_rows_serialize_like_payments(self):
+        # a card, a debit card and a default paypal account with compacted and pending charges
+        self._add_default_payment(PAYPAL)
+        self.ps.perform_payment_action(1, payment_attributes={'amount': 10.25})
+        self.ps.compact_charges(grace=0)
+        self.ps.perform_payment_action(1, payment_attributes={'amount': 0.25})
+        self.ps.add_payment(DEBIT)
+        app_db.session.remove()
 
-        self.assertEqual(cc_payment.charge_history,0.0)
-        self.assertEqual(pp_payment.charge_history,0.0)
+        expected = [json.dumps(payment.serialize(), sort_keys=True)
+                    for payment in self.ps._live_payments().order_by(Payment.id).all()]
+        self.assertEqual(len(expected), 3)
+        self.assertEqual([json.dumps(payment, sort_keys=True) for payment in self.ps.get_payments()], expected)
+        self.assertEqual([json.dumps(payment, sort_keys=True) for payment in self.ps.stream_payments()], expected)
+        self.assertEqual([json.dumps(payment, sort_keys=True) for payment in self.ps.get_expiring_payments(date(2031, 1, 1))],
+                         [expected[0], expected[2]])
+
+    def test_interface_charge_card_expiring_this_month(self):
+        # a card is good through the last day of its expiry month, as stored in expires_at
+        today = date.today()
+        payment = app_db.session.query(Payment).get(1)
+        payment.is_default = True
+        payment.details.expires = '%02d/%d' % (today.month, today.year)
+        payment.details.expires_at = card_expiry_date(payment.details.expires)
+        app_db.session.commit()
+        self.assertEqual(payment.details.expires_at.month, today.month)
 
-        mock_query.assert_called_once_with(payment_attributes=user_data)
-        mock_db.commit.assert_not_called()
+        self.ps.perform_payment_action(1, payment_attributes={'amount': 25.0})
+        app_db.session.expire_all()
+        self.assertEqual(app_db.session.query(Payment).get(1).charge_history, 25.0)
 
-    @mock.patch.object(app_db, 'session')
-    @mock.patch.object(PaymentService, '_query_payments', side_effect = PaymentServiceQueryError)
-    def test_interface_payment_charge_action_with_no_payments_for_user(self, mock_query, mock_db):
-        user_id = 1
-        amount_data = {'amount' : 25.0}
-        user_data = {'user_id': user_id}
+    def test_interface_get_payment_response_missing(self):
+        with self.assertRaises(PaymentNotFoundError):
+            self.ps.get_payment_response(99)
+        self.assertEqual(len(self.ps.cache), 0)
 
-        with self.assertRaises(DataValidationError) as e:
-            result = self.ps.perform_payment_action(user_id,payment_attributes=amount_data)
+    def test_interface_writes_invalidate_cached_payment(self):
+        card = copy.deepcopy(CREDIT)
+        card['details']['expires'] = '12/2099'
+        payment_id = self._add_default_payment(card)
 
-        self.assertTrue('Payments not found' in e.exception.message)
+        self.ps.get_payment_response(payment_id)
+        self.ps.update_payment(payment_id, payment_attributes={'nickname': 'new nickname'})
+        self.assertEqual(self._cached_payment(payment_id)['nickname'], 'new nickname')
 
-        mock_query.assert_called_once_with(payment_attributes=user_data)
-        mock_db.commit.assert_not_called()
+        self.ps.perform_payment_action(1, payment_attributes={'amount': 5.0})
+        self.assertEqual(self._cached_payment(payment_id)['charge_history'], 5.0)
+
+        self.ps.charge_payments([{'user_id': 1, 'amount': 5.0}])
+        self.assertEqual(self._cached_payment(payment_id)['charge_history'], 10.0)
+
+        # setting payment 1 as the default also clears the cached default flag of the old one
+        self.ps.get_payment_response(1)
+        self.ps.perform_payment_action(1, payment_attributes={'payment_id': 1})
+        self.assertFalse(self._cached_payment(payment_id)['is_default'])
+        self.assertTrue(self._cached_payment(1)['is_default'])
+
+        self.ps.remove_payment(payment_id)
+        with self.assertRaises(PaymentNotFoundError):
+            self.ps.get_payment_response(payment_id)
+
+    def test_interface_writes_bump_version(self):
+        card = copy.deepcopy(CREDIT)
+        card['details']['expires'] = '12/2099'
+        payment_id = self._add_default_payment(card)
+        self.assertEqual(self.ps.get_payment_version(payment_id), 1)
+
+        self.ps.update_payment(payment_id, payment_attributes={'nickname': 'new nickname'})
+        self.assertEqual(self.ps.get_payment_version(payment_id), 2)
+        self.ps.perform_payment_action(1, payment_attributes={'amount': 5.0})
+        self.assertEqual(self.ps.get_payment_version(payment_id), 3)
+        self.ps.charge_payments([{'user_id': 1, 'amount': 5.0}])
+        self.assertEqual(self.ps.get_payment_version(payment_id), 4)
+        self.ps.perform_payment_action(1, payment_attributes={'payment_id': 1})
+        self.assertEqual(self.ps.get_payment_version(payment_id), 5)
+        self.assertEqual(self.ps.get_payment_version(1), 2)
+        self.assertEqual(self.ps.get_payment_versions(payment_attributes={'user_id': 1}), [(1, 2), (payment_id, 5)])
+
+        self.ps.remove_payment(payment_id)
+        self.assertEqual(self.ps.get_payment_version(payment_id), None)
+
+    def test_interface_update_with_expected_version(self):
+        result = self.ps.update_payment(1, payment_attributes={'nickname': 'first'}, expected_version=1)
+        self.assertEqual(result['nickname'], 'first')
+        with self.assertRaises(PaymentVersionMismatchError):
+            self.ps.update_payment(1, payment_attributes={'nickname': 'second'}, expected_version=1)
+        app_db.session.expire_all()
+        self.assertEqual(app_db.session.query(Payment).get(1).nickname, 'first')
+
+    def test_interface_update_lost_race_is_version_mismatch(self):
+        # someone else bumps the version after we loaded the payment but before we commit
+        payment = app_db.session.query(Payment).get(1)
+        app_db.session.execute('UPDATE payment SET version = version + 1 WHERE id = 1')
+        with self.assertRaises(PaymentVersionMismatchError):
+            self.ps.update_payment(1, payment_attributes={'nickname': 'lost'})
+
+    def test_interface_remove_after_concurrent_change(self):
+        # another request commits a change after we loaded the payment; the removal still happens
+        payment = app_db.session.query(Payment).get(1)
+        app_db.engine.execute('UPDATE payment SET version = version + 1 WHERE id = 1')
+        self.ps.remove_payment(1)
+        app_db.session.expire_all()
+        self.assertTrue(app_db.session.query(Payment).get(1).is_removed)
+
+    def test_interface_remove_keeps_losing_race(self):
+        with mock.patch.object(app_db.session, 'commit', side_effect=orm.exc.StaleDataError) as mock_commit:
+            with self.assertRaises(PaymentVersionMismatchError):
+                self.ps.remove_payment(1)
+        self.assertEqual(mock_commit.call_count, 3)
+        app_db.session.expire_all()
+        self.assertFalse(app_db.session.query(Payment).get(1).is_removed)
 
     #test case for perform_payment_action in case payment_attributes (or request data) has any other key other than payment_id or amount
     @mock.patch.object(app_db, 'session')
-    @mock.patch.object(PaymentService, '_query_payments')
-    def test_interface_payment_action_with_wrong_actionable_data(self, mock_query, mock_db):
+    def test_interface_payment_action_with_wrong_actionable_data(self, mock_db):
         user_id = 1
         wrong_data = {'history' : 12312}
-        user_data = {'user_id': user_id}
-
-        cc_payment = Payment()
-        cc_payment.deserialize(CC_RETURN)
-        cc_payment.id = 1
-
-        pp_payment = Payment()
-        pp_payment.deserialize(PP_RETURN)
-        pp_payment.id = 3
-
-        mock_query.return_value = [cc_payment, pp_payment]
 
         with self.assertRaises(DataValidationError) as e:
             result = self.ps.perform_payment_action(user_id,payment_attributes=wrong_data)
 
         self.assertTrue('bad or missing data' in e.exception.message)
 
-        mock_query.assert_called_once_with(payment_attributes=user_data)
+        mock_db.execute.assert_not_called()
         mock_db.commit.assert_not_called()
 
     def test_interface_util_is_valid(self):
@@ -919,9 +1348,13 @@ class TestInterfaceFunctional(unittest.TestCase):
     """
 
     def setUp(self):
-        payments.app.debug = True
-        if not payments.app.config['TESTING']: #then use local test db
-            payments.app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('LOCAL_DB')
+        app.debug = True
+        if not app.config['TESTING']: #then use local test db
+            app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('LOCAL_DB')
+        # the database is bound to the app, so work inside one of its contexts
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
         app_db.create_all()  # make our sqlalchemy tables
 
         payments_to_add = (CREDIT, DEBIT, PAYPAL)
@@ -941,14 +1374,16 @@ class TestInterfaceFunctional(unittest.TestCase):
         # No mocking for this test since we want to test the method's ability to *actually* retrieve resources
         # the query attributes should match the CREDIT payment item
 
-        result = self.ps._query_payments(QUERY_ATTRIBUTES)
+        result = self.ps.get_payments(payment_attributes=QUERY_ATTRIBUTES)
         # in this case, PP_RETURN was the third item added, so its id should be 3, not 2
         PP_RETURN['payment_id'] = 3
         # should only be one result, so get the only element of the list
-        assert result[0].serialize() == PP_RETURN
+        assert result == [PP_RETURN]
+        assert list(self.ps.stream_payments(payment_attributes=QUERY_ATTRIBUTES)) == [PP_RETURN]
 
     def test_unsuccessful_query(self):
         # try querying for something that doesn't exist
-        result = self.ps._query_payments(BAD_QUERY_ATTRIBUTES)
-        assert result == []
+        with self.assertRaises(PaymentNotFoundError):
+            self.ps.get_payments(payment_attributes=BAD_QUERY_ATTRIBUTES)
+        assert list(self.ps.stream_payments(payment_attributes=BAD_QUERY_ATTRIBUTES)) == []
 
@@ -0,0 +1,213 @@
+# Test cases can be run with either of the following:
+# python -m unittest discover
+# nosetests -v --rednose --nologcapture
+
+import os, shutil, tempfile
+import unittest, mock
+from flask_api import status
+from sqlalchemy import orm
+from app import app, create_app
+from app.db import app_db
+from app.db.models import Payment
+from app.db.interface import PaymentService
+from app.metrics import Metrics, Registry, RequestStats, merge, render, labels
+
+PAYMENTS = [{'payment_id': 1}, {'payment_id': 2}]
+
+def finished(registry, route, method, status, seconds, db_seconds=0.0, rows=0, statements=0, rows_fetched=0):
+    """ Records a request that did the given work """
+    current = RequestStats()
+    current.reset(route, method)
+    current.status, current.db_seconds, current.rows = status, db_seconds, rows
+    current.statements, current.rows_fetched = statements, rows_fetched
+    registry.request_finished(current, seconds)
+
+def sample(text, line):
+    """ The value of the sample line that starts with line, or None """
+    for sample_line in text.splitlines():
+        if sample_line.startswith(line + ' '):
+            return float(sample_line.rsplit(' ', 1)[1])
+    return None
+
+class TestRegistry(unittest.TestCase):
+
+    def test_render(self):
+        registry = Registry()
+        registry.request_started('/payments')
+        self.assertIn('payments_http_requests_in_flight{route="/payments"} 1', render(registry.snapshot()))
+        finished(registry, '/payments', 'GET', 200, 0.003, 0.001, rows=2)
+        registry.request_started('/payments')
+        finished(registry, '/payments', 'GET', 200, 20.0, 0.002)
+        text = render(registry.snapshot())
+
+        self.assertIn('# TYPE payments_http_request_duration_seconds histogram', text)
+        series = 'payments_http_request_duration_seconds_bucket{method="GET",route="/payments",status="200",le="%s"}'
+        self.assertEqual(sample(text, series % '0.0025'), 0)
+        self.assertEqual(sample(text, series % '0.005'), 1)
+        self.assertEqual(sample(text, series % '10.0'), 1)
+        self.assertEqual(sample(text, series % '+Inf'), 2)
+        self.assertEqual(sample(text, 'payments_http_request_duration_seconds_count{method="GET",route="/payments",status="200"}'), 2)
+        self.assertAlmostEqual(sample(text, 'payments_http_request_duration_seconds_sum{method="GET",route="/payments",status="200"}'), 20.003)
+        self.assertEqual(sample(text, 'payments_rows_serialized_bucket{method="GET",route="/payments",le="0"}'), 1)
+        self.assertEqual(sample(text, 'payments_rows_serialized_sum{method="GET",route="/payments"}'), 2)
+        self.assertEqual(sample(text, 'payments_http_requests_in_flight{route="/payments"}'), 0)
+
+    def test_labels_are_escaped(self):
+        self.assertEqual(labels(route='/a"b\\c', method='GET'), 'method="GET",route="/a\\"b\\\\c"')
+
+    def test_merge(self):
+        first, second = Registry(), Registry()
+        for registry, seconds in ((first, 0.003), (second, 0.2)):
+            registry.request_started('/payments')
+            finished(registry, '/payments', 'GET', 200, seconds, rows=1)
+        second.request_started('/payments')
+        merged = merge([first.snapshot(), second.snapshot()])
+        text = render(merged)
+        self.assertEqual(sample(text, 'payments_http_request_duration_seconds_count{method="GET",route="/payments",status="200"}'), 2)
+        self.assertEqual(sample(text, 'payments_http_requests_in_flight{route="/payments"}'), 1)
+
+class TestRequestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.flask_app = create_app()
+        self.app = self.flask_app.test_client()
+
+    @mock.patch.object(PaymentService, 'get_payments', return_value=(PAYMENTS, [(1, 1), (2, 1)]))
+    def test_requests_are_measured(self, mock_ps_get):
+        self.assertEqual(self.app.get('/payments').status_code, status.HTTP_200_OK)
+        self.assertEqual(self.app.get('/no-such-route').status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.get('/metrics')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        text = resp.data
+        self.assertEqual(sample(text, 'payments_http_request_duration_seconds_count{method="GET",route="/payments",status="200"}'), 1)
+        self.assertEqual(sample(text, 'payments_http_request_duration_seconds_count{method="GET",route="unmatched",status="404"}'), 1)
+        self.assertEqual(sample(text, 'payments_http_requests_in_flight{route="/payments"}'), 0)
+        self.assertEqual(sample(text, 'payments_http_requests_in_flight{route="/metrics"}'), 1)
+        self.assertIsNotNone(sample(text, 'payments_cache_hits_total'))
+        self.assertIsNotNone(sample(text, 'payments_idempotency_requests_total'))
+
+    @mock.patch.object(PaymentService, 'add_payment', side_effect=Exception('connection reset'))
+    def test_errors_are_measured(self, mock_ps_add):
+        self.flask_app.config['PROPAGATE_EXCEPTIONS'] = False
+        self.flask_app.log_exception = mock.Mock()
+        self.app.post('/payments', data='{}', content_type='application/json')
+        text = self.app.get('/metrics').data
+        self.assertEqual(sample(text, 'payments_http_request_duration_seconds_count{method="POST",route="/payments",status="500"}'), 1)
+        self.assertEqual(sample(text, 'payments_http_requests_in_flight{route="/payments"}'), 0)
+
+class TestDatabaseMetrics(unittest.TestCase):
+
+    def setUp(self):
+        if not app.config['TESTING']: #then use local test db
+            app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('LOCAL_DB')
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+        app_db.create_all()
+        # the app is shared with the other test modules, so count from zero
+        app.extensions['metrics'].registry = Registry()
+        self.app = app.test_client()
+
+    def tearDown(self):
+        app_db.session.remove()
+        app_db.drop_all()
+
+    def test_database_time_and_rows(self):
+        self.app.post('/payments', data='{"nickname": "my paypal", "user_id": 1, "payment_type": "paypal", '
+                                        '"details": {"user_name": "John Jameson", "user_email": "jj@aol.com"}}',
+                      content_type='application/json')
+        self.app.get('/payments')
+        text = self.app.get('/metrics').data
+        self.assertEqual(sample(text, 'payments_db_duration_seconds_count{method="GET",route="/payments"}'), 1)
+        self.assertTrue(sample(text, 'payments_db_duration_seconds_sum{method="GET",route="/payments"}') > 0)
+        self.assertEqual(sample(text, 'payments_rows_serialized_sum{method="GET",route="/payments"}'), 1)
+        self.assertEqual(sample(text, 'payments_db_duration_seconds_sum{method="GET",route="/metrics"}'), None)
+
+    def add_payments(self, count):
+        for user_id in range(count):
+            self.app.post('/payments', data='{"nickname": "my paypal", "user_id": %d, "payment_type": "paypal", '
+                                            '"details": {"user_name": "John Jameson", "user_email": "jj@aol.com"}}' % user_id,
+                          content_type='application/json')
+
+    def test_statements_in_debug_headers(self):
+        self.add_payments(2)
+        resp = self.app.get('/payments/1')
+        self.assertNotIn('X-DB-Statements', resp.headers)
+
+        app.debug = True
+        self.addCleanup(setattr, app, 'debug', False)
+        resp = self.app.get('/payments/2')
+        self.assertEqual(resp.headers['X-DB-Statements'], '1')
+        self.assertEqual(resp.headers['X-DB-Rows-Fetched'], '1')
+        self.assertTrue(resp.headers['X-DB-Time'].endswith('ms'))
+        self.assertNotIn('X-DB-Repeated-Statement', resp.headers)
+
+    def test_repeated_statements_are_flagged(self):
+        threshold = app.config['SQL_REPEAT_THRESHOLD']
+        self.add_payments(threshold + 2)
+        app.debug = True
+        self.addCleanup(setattr, app, 'debug', False)
+        # list the payments loading each one's details on its own, one query per payment
+        def lazy_details(service, **kwargs):
+            page = service._live_payments().options(orm.lazyload(Payment.details)).all()
+            return [payment.serialize() for payment in page], [(payment.id, payment.version) for payment in page]
+        with mock.patch.object(PaymentService, 'get_payments', lazy_details), \
+                mock.patch.object(app.logger, 'warning') as mock_warning:
+            resp = self.app.get('/payments')
+        self.assertTrue(int(resp.headers['X-DB-Repeated-Statement']) > threshold)
+        mock_warning.assert_called_once()
+        self.assertIn('FROM detail', mock_warning.call_args[0][-1])
+
+        text = self.app.get('/metrics').data
+        self.assertEqual(sample(text, 'payments_db_repeated_statement_requests_total{method="GET",route="/payments"}'), 1)
+        self.assertTrue(sample(text, 'payments_db_statements_sum{method="GET",route="/payments"}') > threshold)
+        self.assertTrue(sample(text, 'payments_db_rows_fetched_sum{method="GET",route="/payments"}') >= threshold + 2)
+
+class TestSharedMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.flask_app = create_app()
+        self.flask_app.config['METRICS_DIR'] = self.directory
+
+    def worker(self):
+        """ The Metrics of another worker process """
+        metrics = Metrics(self.flask_app)
+        metrics.registry.request_started('/payments')
+        finished(metrics.registry, '/payments', 'GET', 200, 0.01, rows=1)
+        metrics.registry.request_started('/payments')
+        return metrics
+
+    def test_workers_are_added_up(self):
+        with mock.patch('os.getpid', return_value=101):
+            self.worker().flush()
+        with mock.patch('os.getpid', return_value=102):
+            text = self.worker().export()
+        self.assertEqual(sample(text, 'payments_http_request_duration_seconds_count{method="GET",route="/payments",status="200"}'), 2)
+        self.assertEqual(sample(text, 'payments_http_requests_in_flight{route="/payments"}'), 2)
+
+    def test_exited_workers_keep_their_counts(self):
+        with mock.patch('os.getpid', return_value=101):
+            self.worker().flush()
+        with mock.patch('os.getpid', return_value=102):
+            metrics = self.worker()
+            metrics.flush()
+        metrics.archive(101)
+        self.assertEqual(sorted(os.listdir(self.directory)), ['102.json', 'archive.json'])
+        with mock.patch('os.getpid', return_value=102):
+            text = metrics.export()
+        self.assertEqual(sample(text, 'payments_http_request_duration_seconds_count{method="GET",route="/payments",status="200"}'), 2)
+        # the gauges of an exited worker are gone
+        self.assertEqual(sample(text, 'payments_http_requests_in_flight{route="/payments"}'), 1)
+
+        metrics.reset()
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
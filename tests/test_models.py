@@ -5,10 +5,11 @@
 import unittest
 import mock
 import os
+from datetime import date
 
-from app import payments
+from app import app, payments
 from app.db import app_db
-from app.db.models import Payment, Detail
+from app.db.models import Payment, Detail, to_minor_units
 from app.error_handlers import DataValidationError
 
 CC_DETAIL = {'user_name' : 'Jimmy Jones', 'card_number' : '1111222233334444',
@@ -48,9 +49,13 @@ PUT_CREDIT_IP = {'nickname' : 'favcredit', 'user_id' : 1, 'payment_type' : 'cred
 class TestModels(unittest.TestCase):
 
     def setUp(self):
-        payments.app.debug = True
-        if not payments.app.config['TESTING']: #then use local test db
-            payments.app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('LOCAL_DB')
+        app.debug = True
+        if not app.config['TESTING']: #then use local test db
+            app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('LOCAL_DB')
+        # the database is bound to the app, so work inside one of its contexts
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
         app_db.create_all()  # make our sqlalchemy tables
         
         data = CREDIT
@@ -59,7 +64,7 @@ class TestModels(unittest.TestCase):
         payment.deserialize(data)
         app_db.session.add(payment)
         app_db.session.commit()
-        self.app = payments.app.test_client()
+        self.app = app.test_client()
 
     def tearDown(self):
         app_db.session.remove()
@@ -114,6 +119,15 @@ class TestModels(unittest.TestCase):
         self.assertEqual(p.is_removed, False)
         self.assertEqual(p.charge_history, 0.0)
 
+    def test_to_minor_units(self):
+        self.assertEqual(to_minor_units(35.5), 3550)
+        self.assertEqual(to_minor_units(0.1 + 0.2), 30)
+        self.assertEqual(to_minor_units(19.995), 2000)
+        self.assertEqual(to_minor_units(12), 1200)
+        self.assertEqual(to_minor_units(0.004), 0)
+        self.assertEqual(to_minor_units(10 ** 20), 10 ** 22)
+        self.assertEqual(to_minor_units(long(5)), 500)
+
     def test_detail_deserialize_credit(self):
         d = Detail()
         self.assertEqual(d.user_name, None)
@@ -127,6 +141,7 @@ class TestModels(unittest.TestCase):
         self.assertEqual(d.card_type, 'Mastercard')
         self.assertEqual(d.card_number, '1111222233334444')
         self.assertEqual(d.expires, '01/2019')
+        self.assertEqual(d.expires_at, date(2019, 1, 31))
         self.assertEqual(d.is_linked, None)
         self.assertEqual(d.user_email, None)
 
@@ -143,12 +158,13 @@ class TestModels(unittest.TestCase):
         self.assertEqual(d.card_type, None)
         self.assertEqual(d.card_number, None)
         self.assertEqual(d.expires, None)
+        self.assertEqual(d.expires_at, None)
         self.assertEqual(d.is_linked, True)
         self.assertEqual(d.user_email, 'jj@aol.com')
 
     def test_payment_self_url(self):
         payment = Payment.query.get(1)
-        with payments.app.test_request_context():
+        with app.test_request_context():
             addr = payment.self_url()
             self.assertTrue('/payments/1' in addr)
 
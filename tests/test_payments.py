@@ -3,9 +3,11 @@
 # nosetests -v --rednose --nologcapture
 
 import unittest, json, mock
+from datetime import date
 from mock import patch
-from app import payments
-from app.db.interface import PaymentService, PaymentNotFoundError
+from app import app, payments
+from app.db import app_db
+from app.db.interface import PaymentService, PaymentNotFoundError, PaymentVersionMismatchError, PaymentServiceQueryError
 from flask_api import status   # HTTP Status Codes
 from flask import make_response,jsonify
 from app.error_handlers import DataValidationError
@@ -50,6 +52,9 @@ CC_RETURN = dict(CREDIT, is_default=False, charge_history=0.0, payment_id=1)
 
 DC_RETURN = dict(DEBIT, is_default=False, charge_history=0.0, payment_id=2)
 
+PAGE_SIZE = app.config['DEFAULT_PAGE_SIZE']
+MAX_PAGE_SIZE = app.config['MAX_PAGE_SIZE']
+
 SAMPLE_PAYMENT = {
     'id': 0,
     'nickname': 'my credit',
@@ -105,25 +110,109 @@ SAMPLE_PAYMENTS = [
     }
 ]
 
+def page_of(payments):
+    """ What get_payments returns for a list request: the payments and their (id, version) pairs """
+    return payments, [(payment['id'], 1) for payment in payments]
+
 class TestPaymentsCRUD(unittest.TestCase):
     """
     Test cases for CRUD methods contained in payments.py.
     """
     def setUp(self):
         # Important!  Need to use the test_client method in order to test the flask-made routes
-        self.app = payments.app.test_client()
+        self.app = app.test_client()
+        payments.payment_service.cache.clear()
+        # conditional list requests look up the versions of the page before reading it
+        versions = patch.object(PaymentService, 'get_payment_versions', return_value=[])
+        self.mock_versions = versions.start()
+        self.addCleanup(versions.stop)
 
     def test_get_payments_ok(self):
         # return 200 OK and a simple payload for a successful request
         id = 0
-        with patch.object(PaymentService, 'get_payments', return_value=SAMPLE_PAYMENT) as mocked_service:
+        with patch.object(PaymentService, 'get_payment_response', return_value=(json.dumps(SAMPLE_PAYMENT), 1)) as mocked_service:
             response = self.app.get('/payments/{}'.format(id))
 
             # when doing the assertion methods on a mocked object, make *very* sure that the method
             # is one of the actual methods; otherwise the assertion will be meaningless
-            mocked_service.assert_called_once_with(payment_ids=[id])
+            mocked_service.assert_called_once_with(id)
             self.assertEqual(response.status_code, status.HTTP_200_OK)
             self.assertEqual(json.loads(response.data), SAMPLE_PAYMENT)
+            self.assertEqual(response.headers['ETag'], '"0-1"')
+
+    def test_get_payments_cached(self):
+        # a payment read twice is only fetched from the database once
+        id = 0
+        payment = mock.MagicMock(revision=1)
+        payment.serialize.return_value = SAMPLE_PAYMENT
+        with patch.object(PaymentService, '_live_payments') as mocked_query:
+            mocked_query.return_value.filter.return_value.first.return_value = payment
+            first = self.app.get('/payments/{}'.format(id))
+            second = self.app.get('/payments/{}'.format(id))
+
+            mocked_query.assert_called_once()
+            self.assertEqual(second.status_code, status.HTTP_200_OK)
+            self.assertEqual(second.data, first.data)
+
+        response = self.app.get('/diagnostics')
+        stats = json.loads(response.data)['payment_cache']
+        self.assertEqual((stats['hits'], stats['misses'], stats['size']), (1, 1, 1))
+        self.assertTrue(json.loads(response.data)['db_pool']['checkouts'] > 0)
+
+    def test_get_payments_not_modified(self):
+        # a matching If-None-Match is answered from the version alone
+        with patch.object(PaymentService, 'get_payment_version', return_value=3) as mocked_version, \
+             patch.object(PaymentService, 'get_payment_response') as mocked_service:
+            response = self.app.get('/payments/7', headers={'If-None-Match': '"7-3"'})
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+            self.assertEqual(response.headers['ETag'], '"7-3"')
+            mocked_version.assert_called_once_with(7)
+            mocked_service.assert_not_called()
+
+            # weak comparison, so a weakened ETag still matches
+            response = self.app.get('/payments/7', headers={'If-None-Match': 'W/"7-3"'})
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_get_payments_modified(self):
+        with patch.object(PaymentService, 'get_payment_version', return_value=4), \
+             patch.object(PaymentService, 'get_payment_response', return_value=(json.dumps(SAMPLE_PAYMENT), 4)):
+            response = self.app.get('/payments/7', headers={'If-None-Match': '"7-3"'})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.headers['ETag'], '"7-4"')
+
+    def test_list_payments_not_modified(self):
+        page = page_of(SAMPLE_PAYMENTS)
+        self.mock_versions.return_value = page[1]
+        with patch.object(PaymentService, 'get_payments', return_value=page) as mocked_service:
+            # a plain request reads the page and its versions with a single query
+            response = self.app.get('/payments?user_id=1')
+            etag = response.headers['ETag']
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.mock_versions.assert_not_called()
+
+            response = self.app.get('/payments?user_id=1', headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+            mocked_service.assert_called_once()
+            self.mock_versions.assert_called_with(payment_attributes={'user_id': '1'}, limit=PAGE_SIZE + 1, after=None)
+
+            # any new version on the page changes its ETag
+            self.mock_versions.return_value = [(0, 1), (1, 6), (2, 1)]
+            response = self.app.get('/payments?user_id=1', headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(mocked_service.call_count, 2)
+
+    def test_list_payments_etag_of_page(self):
+        # the ETag covers the payments on the page and whether there is a next one,
+        # not the payment read to find that out
+        page = [dict(p, payment_id=p['id']) for p in SAMPLE_PAYMENTS]
+        with patch.object(PaymentService, 'get_payments', return_value=(page, [(0, 1), (1, 1), (2, 1)])):
+            etag = self.app.get('/payments?limit=2').headers['ETag']
+        with patch.object(PaymentService, 'get_payments', return_value=(page, [(0, 1), (1, 1), (2, 9)])):
+            self.assertEqual(self.app.get('/payments?limit=2').headers['ETag'], etag)
+        with patch.object(PaymentService, 'get_payments', return_value=(page[:2], [(0, 1), (1, 1)])):
+            self.assertNotEqual(self.app.get('/payments?limit=2').headers['ETag'], etag)
+        with patch.object(PaymentService, 'get_payments', return_value=(page, [(0, 1), (1, 2), (2, 1)])):
+            self.assertNotEqual(self.app.get('/payments?limit=2').headers['ETag'], etag)
 
     def test_get_payments_not_found(self):
         # something goes wrong with the GET request and the resource cannot be found
@@ -138,12 +227,13 @@ class TestPaymentsCRUD(unittest.TestCase):
 
     def test_list_payments_all(self):
         # ensure that all payments are returned
-        with patch.object(PaymentService, 'get_payments', return_value=SAMPLE_PAYMENTS) as mocked_service:
+        with patch.object(PaymentService, 'get_payments', return_value=page_of(SAMPLE_PAYMENTS)) as mocked_service:
             response = self.app.get('/payments')
 
-            mocked_service.assert_called_once_with()
+            mocked_service.assert_called_once_with(limit=PAGE_SIZE + 1, after=None, with_versions=True)
             self.assertEqual(response.status_code, status.HTTP_200_OK)
             self.assertEqual(json.loads(response.data), SAMPLE_PAYMENTS)
+            self.assertFalse('Link' in response.headers)
 
     def test_list_payments_by_ids(self):
         # return payments that have specific ids
@@ -153,10 +243,10 @@ class TestPaymentsCRUD(unittest.TestCase):
         ids_query_string = 'ids={}&ids={}'.format(ids[0], ids[1])
         payments_to_return = SAMPLE_PAYMENTS[1:3]
 
-        with patch.object(PaymentService, 'get_payments', return_value=payments_to_return) as mocked_service:
+        with patch.object(PaymentService, 'get_payments', return_value=page_of(payments_to_return)) as mocked_service:
             response = self.app.get('/payments?{}'.format(ids_query_string))
 
-            mocked_service.assert_called_once_with(payment_ids=ids)
+            mocked_service.assert_called_once_with(payment_ids=ids, limit=PAGE_SIZE + 1, after=None, with_versions=True)
             self.assertEqual(response.status_code, status.HTTP_200_OK)
             self.assertEqual(json.loads(response.data), payments_to_return)
 
@@ -167,13 +257,87 @@ class TestPaymentsCRUD(unittest.TestCase):
         attribute_params = {'payment_type': 'paypal'}
         paypal_payment = SAMPLE_PAYMENTS[1]
 
-        with patch.object(PaymentService, 'get_payments', return_value=paypal_payment) as mocked_service:
+        with patch.object(PaymentService, 'get_payments', return_value=(paypal_payment, [(2, 1)])) as mocked_service:
             response = self.app.get('/payments?{}={}'.format(specific_attribute, specific_attribute_value))
 
-            mocked_service.assert_called_once_with(payment_attributes=attribute_params)
+            mocked_service.assert_called_once_with(payment_attributes=attribute_params,
+                                                   limit=PAGE_SIZE + 1, after=None, with_versions=True)
             self.assertEqual(response.status_code, status.HTTP_200_OK)
             self.assertEqual(json.loads(response.data), paypal_payment)
 
+    def test_list_payments_next_page(self):
+        # one payment more than the page holds means there is a next page
+        page = [dict(p, payment_id=p['id']) for p in SAMPLE_PAYMENTS]
+        with patch.object(PaymentService, 'get_payments', return_value=page_of(page)) as mocked_service:
+            response = self.app.get('/payments?limit=2')
+
+            mocked_service.assert_called_once_with(limit=3, after=None, with_versions=True)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(json.loads(response.data), page[:2])
+            cursor = response.headers['X-Next-Cursor']
+            self.assertEqual(payments.decode_cursor(cursor), 1)
+            self.assertTrue('after={}'.format(cursor) in response.headers['Link'])
+            self.assertTrue('rel="next"' in response.headers['Link'])
+
+        with patch.object(PaymentService, 'get_payments', return_value=page_of(page[2:])) as mocked_service:
+            response = self.app.get('/payments?limit=2&after={}'.format(cursor))
+
+            mocked_service.assert_called_once_with(limit=3, after=1, with_versions=True)
+            self.assertEqual(json.loads(response.data), page[2:])
+            self.assertFalse('X-Next-Cursor' in response.headers)
+
+    def test_list_payments_by_attribute_next_page(self):
+        # pagination arguments must not be used as filters
+        with patch.object(PaymentService, 'get_payments', return_value=page_of(SAMPLE_PAYMENTS[:2])) as mocked_service:
+            cursor = payments.encode_cursor(5)
+            response = self.app.get('/payments?user_id=1&limit=10&after={}'.format(cursor))
+
+            mocked_service.assert_called_once_with(payment_attributes={'user_id': '1'}, limit=11, after=5, with_versions=True)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_list_payments_limit_is_capped(self):
+        with patch.object(PaymentService, 'get_payments', return_value=page_of(SAMPLE_PAYMENTS)) as mocked_service:
+            response = self.app.get('/payments?limit={}'.format(MAX_PAGE_SIZE * 10))
+
+            mocked_service.assert_called_once_with(limit=MAX_PAGE_SIZE + 1, after=None, with_versions=True)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_list_payments_bad_page_args(self):
+        with patch.object(PaymentService, 'get_payments') as mocked_service:
+            for query_string in ('limit=abc', 'limit=0', 'after=!!!', 'after=YWJj'):
+                response = self.app.get('/payments?{}'.format(query_string))
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            mocked_service.assert_not_called()
+
+    def test_list_payments_ndjson(self):
+        # each payment is sent as its own line of JSON
+        with patch.object(PaymentService, 'stream_payments', return_value=iter(SAMPLE_PAYMENTS)) as mocked_service:
+            response = self.app.get('/payments?user_id=1', headers={'Accept': payments.NDJSON_MIMETYPE})
+
+            mocked_service.assert_called_once_with(payment_attributes={'user_id': '1'}, after=None,
+                                                   batch_size=app.config['STREAM_BATCH_SIZE'])
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.mimetype, payments.NDJSON_MIMETYPE)
+            lines = response.data.splitlines()
+            self.assertEqual([json.loads(line) for line in lines], SAMPLE_PAYMENTS)
+
+    def test_list_payments_ndjson_not_found(self):
+        with patch.object(PaymentService, 'stream_payments', return_value=iter([])) as mocked_service:
+            response = self.app.get('/payments', headers={'Accept': payments.NDJSON_MIMETYPE})
+
+            mocked_service.assert_called_once()
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+            self.assertEqual(json.loads(response.data), payments.GENERAL_NOT_FOUND_ERROR)
+
+    def test_list_payments_json_preferred(self):
+        # clients that accept both get the paged JSON array
+        with patch.object(PaymentService, 'get_payments', return_value=page_of(SAMPLE_PAYMENTS)) as mocked_service:
+            accept = 'application/json, {};q=0.5'.format(payments.NDJSON_MIMETYPE)
+            response = self.app.get('/payments', headers={'Accept': accept})
+
+            mocked_service.assert_called_once_with(limit=PAGE_SIZE + 1, after=None, with_versions=True)
+            self.assertEqual(response.mimetype, 'application/json')
+
     def test_list_payments_not_found(self):
         # attempt to retrieve payments and catch the exception raised; return 404
         with patch.object(PaymentService, 'get_payments', side_effect=Exception) as mocked_service:
@@ -190,12 +354,12 @@ class TestPaymentsCRUD(unittest.TestCase):
         other_param = 'nickname'
         other_param_value = 'amex'
 
-        with patch.object(PaymentService, 'get_payments', return_value=payments_to_return) as mocked_service:
+        with patch.object(PaymentService, 'get_payments', return_value=page_of(payments_to_return)) as mocked_service:
             query_string = '{}&{}={}'.format(ids_query_string, other_param, other_param_value)
             response = self.app.get('/payments?{}'.format(query_string))
 
             # important - we should call the get_payments method with payment_ids, *not* payment_attributes
-            mocked_service.assert_called_once_with(payment_ids=ids)
+            mocked_service.assert_called_once_with(payment_ids=ids, limit=PAGE_SIZE + 1, after=None, with_versions=True)
             self.assertEqual(response.status_code, status.HTTP_200_OK)
             self.assertEqual(json.loads(response.data), payments_to_return)
 
@@ -257,6 +421,139 @@ class TestPaymentsCRUD(unittest.TestCase):
         self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
         self.assertTrue("error" in resp.data)
 
+    @mock.patch.object(PaymentService, 'get_expiring_payments')
+    def test_list_expiring_payments(self, mock_ps_expiring):
+        expiring = [{'payment_id': 1}, {'payment_id': 4}, {'payment_id': 9}]
+        mock_ps_expiring.return_value = expiring
+        response = self.app.get('/payments/expiring?before=2020-01-01&limit=2')
+        mock_ps_expiring.assert_called_once_with(date(2020, 1, 1), limit=3, after=None)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(response.data), expiring[:2])
+        self.assertEqual(response.headers['X-Next-Cursor'], payments.encode_cursor(4))
+        self.assertTrue('before=2020-01-01' in response.headers['Link'])
+
+    @mock.patch.object(PaymentService, 'get_expiring_payments')
+    def test_list_expiring_payments_bad_date(self, mock_ps_expiring):
+        for query in ('', '?before=01/2020', '?before=2020-13-01'):
+            response = self.app.get('/payments/expiring' + query)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        mock_ps_expiring.assert_not_called()
+
+    @mock.patch.object(PaymentService, 'get_user_summaries')
+    def test_list_user_summaries(self, mock_ps_summaries):
+        summaries = [{'user_id': 1}, {'user_id': 2}, {'user_id': 5}]
+        mock_ps_summaries.return_value = summaries
+        response = self.app.get('/users/summary?limit=2&after=' + payments.encode_cursor(0))
+        mock_ps_summaries.assert_called_once_with(limit=3, after=0)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(response.data), summaries[:2])
+        self.assertEqual(response.headers['X-Next-Cursor'], payments.encode_cursor(2))
+
+    @mock.patch.object(PaymentService, 'get_user_summary')
+    def test_get_user_summary(self, mock_ps_summary):
+        summary = {'user_id': 1, 'payments': 1, 'default_payment_id': 1, 'total_charged': 2.5,
+                   'payments_by_type': {'credit': 1, 'debit': 0, 'paypal': 0}}
+        mock_ps_summary.return_value = summary
+        response = self.app.get('/users/1/summary')
+        mock_ps_summary.assert_called_once_with(1)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(response.data), summary)
+
+    @mock.patch.object(PaymentService, 'get_user_summary', side_effect=PaymentNotFoundError)
+    def test_get_user_summary_not_found(self, mock_ps_summary):
+        response = self.app.get('/users/3/summary')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertTrue('user_id: 3' in json.loads(response.data)['error'])
+
+    @mock.patch.object(PaymentService, 'add_payments')
+    def test_crud_create_batch(self, mock_ps_add):
+        mock_ps_add.return_value = [CC_RETURN, DataValidationError('Invalid payment: missing nickname')]
+        resp = self.app.post('/payments/batch', data=json.dumps([CREDIT, BAD_DATA]), content_type='application/json')
+        mock_ps_add.assert_called_once_with([CREDIT, BAD_DATA], chunk_size=app.config['BATCH_CHUNK_SIZE'])
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data), {
+            'created': 1, 'failed': 1,
+            'results': [{'index': 0, 'status': 201, 'created': CC_RETURN},
+                        {'index': 1, 'status': 400, 'error': 'Invalid payment: missing nickname'}]})
+
+    @mock.patch.object(PaymentService, 'iter_add_payments')
+    def test_crud_create_batch_ndjson(self, mock_ps_add):
+        mock_ps_add.side_effect = lambda data, chunk_size: (PaymentServiceQueryError('connection lost') for _ in data)
+        body = '\n'.join([json.dumps(CREDIT), 'not json', json.dumps(DEBIT), ''])
+        with mock.patch.object(app.logger, 'error') as mock_log:
+            resp = self.app.post('/payments/batch', data=body, content_type=payments.NDJSON_MIMETYPE)
+            results = [json.loads(line) for line in resp.data.splitlines()]
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, payments.NDJSON_MIMETYPE)
+        self.assertEqual([(r['index'], r['status']) for r in results], [(0, 500), (1, 500), (2, 500)])
+        # the details of a failure are logged, not sent
+        self.assertEqual(set(r['error'] for r in results), set([payments.BATCH_ITEM_ERROR]))
+        self.assertEqual(mock_log.call_count, 3)
+        self.assertTrue('connection lost' in mock_log.call_args[0][-1])
+
+    @mock.patch.object(PaymentService, 'iter_add_payments')
+    def test_crud_create_batch_parses_ndjson_lines(self, mock_ps_add):
+        mock_ps_add.side_effect = lambda data, chunk_size: iter(data)
+        body = '\n'.join([json.dumps(CREDIT), 'not json', json.dumps(DEBIT)])
+        resp = self.app.post('/payments/batch', data=body, content_type=payments.NDJSON_MIMETYPE)
+        created = [json.loads(line)['created'] for line in resp.data.splitlines()]
+        self.assertEqual(created, [CREDIT, None, DEBIT])
+
+    @mock.patch.object(PaymentService, 'iter_add_payments')
+    def test_crud_create_batch_ndjson_too_large(self, mock_ps_add):
+        read = []
+        mock_ps_add.side_effect = lambda data, chunk_size: (read.append(payment) or payment for payment in data)
+        body = '\n'.join([json.dumps(dict(CREDIT, nickname=str(n))) for n in range(20)])
+        with mock.patch.dict(app.config, BATCH_MAX_SIZE=5):
+            resp = self.app.post('/payments/batch', data=body, content_type=payments.NDJSON_MIMETYPE)
+            results = [json.loads(line) for line in resp.data.splitlines()]
+        self.assertEqual(len(read), 5)
+        self.assertEqual([r['status'] for r in results], [201] * 5 + [400])
+        self.assertEqual(results[-1], {'index': 5, 'status': 400,
+                                       'error': 'Invalid request: a batch may hold at most 5 payments'})
+
+    @mock.patch.object(PaymentService, 'add_payments')
+    def test_crud_create_batch_not_a_list(self, mock_ps_add):
+        resp = self.app.post('/payments/batch', data=json.dumps(CREDIT), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertTrue('error' in resp.data)
+        mock_ps_add.assert_not_called()
+
+    @mock.patch.object(PaymentService, 'add_payments')
+    def test_crud_create_batch_too_large(self, mock_ps_add):
+        data = [CREDIT] * (app.config['BATCH_MAX_SIZE'] + 1)
+        resp = self.app.post('/payments/batch', data=json.dumps(data), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        mock_ps_add.assert_not_called()
+
+    @mock.patch.object(PaymentService, 'charge_payments')
+    def test_charge_batch(self, mock_ps_charge):
+        charges = [{'user_id': 1, 'amount': 20.0}, {'user_id': 2, 'amount': 5.0}, {'user_id': 3, 'amount': 5.0}]
+        mock_ps_charge.return_value = [True, DataValidationError('Invalid request: Default Payment for this user_id: 2 (Paypal) is not linked.'),
+                                       Exception('Could not charge the default payment due to query error')]
+        resp = self.app.post('/charges/batch', data=json.dumps(charges), content_type='application/json')
+        mock_ps_charge.assert_called_once_with(charges, chunk_size=app.config['BATCH_CHUNK_SIZE'])
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        result = json.loads(resp.data)
+        self.assertEqual((result['charged'], result['failed']), (1, 2))
+        self.assertEqual([r['status'] for r in result['results']], [200, 400, 500])
+        self.assertEqual(result['results'][0]['success'], 'Default payment method for user_id: 1 has been charged $20.00')
+
+    def test_charge_batch_bad_amounts(self):
+        charges = [{'user_id': 1, 'amount': 10 ** 20}, {'user_id': 1, 'amount': '5'}]
+        resp = self.app.post('/charges/batch', data=json.dumps(charges), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        result = json.loads(resp.data)
+        self.assertEqual([r['status'] for r in result['results']], [400, 400])
+        self.assertEqual([r['error'] for r in result['results']],
+                         ['Invalid request: Order amount is too large.', 'Invalid request: Order amount must be a number.'])
+
+    @mock.patch.object(PaymentService, 'charge_payments')
+    def test_charge_batch_not_a_list(self, mock_ps_charge):
+        resp = self.app.post('/charges/batch', data=json.dumps({'user_id': 1, 'amount': 20.0}), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        mock_ps_charge.assert_not_called()
+
     #Tests for Deleting
     @mock.patch.object(PaymentService, 'remove_payment')
     def test_delete_payment_with_valid_id(self, mock_ps_delete):
@@ -270,6 +567,13 @@ class TestPaymentsCRUD(unittest.TestCase):
         self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
         self.assertTrue('' in resp.data)
 
+    @mock.patch.object(PaymentService, 'remove_payment',
+                       side_effect=PaymentVersionMismatchError('Invalid payment: Payment kept being changed by other requests'))
+    def test_delete_payment_changed_concurrently(self, mock_ps_delete):
+        resp = self.app.delete('/payments/1')
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        self.assertTrue('changed by other requests' in resp.data)
+
     def test_delete_payment_with_gibberish_id(self):
         resp = self.app.delete('/payments/jghjeshg')
         #will not go to the payment service so no need to mock
@@ -340,6 +644,16 @@ class TestPaymentsCRUD(unittest.TestCase):
         self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
         self.assertTrue('does not have the payment_id' in resp.data)
 
+    @mock.patch.object(PaymentService, '_set_default_payment')
+    def test_set_default_action_with_bad_payment_id(self, mock_set_default):
+        user_id = 1
+        for payment_id in ('abc', [1], True, 1.5, None):
+            data = json.dumps({'payment_id': payment_id})
+            resp = self.app.patch('payments/{}/set-default'.format(user_id),data=data, content_type='application/json')
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertTrue('payment_id must be an integer' in resp.data)
+        mock_set_default.assert_not_called()
+
     #Tests for action - charge
     @mock.patch.object(PaymentService, 'perform_payment_action')
     def test_charge_action_with_no_payments_for_user_id(self, mock_db_action):
@@ -395,6 +709,32 @@ class TestPaymentsCRUD(unittest.TestCase):
         self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
         self.assertTrue('Order amount is negative.' in resp.data)
 
+    def test_charge_action_with_bad_amount(self):
+        for amount in ('5', 10 ** 20):
+            resp = self.app.patch('payments/1/charge', data=json.dumps({'amount': amount}), content_type='application/json')
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertTrue('Order amount' in resp.data)
+
+    @mock.patch.object(app_db, 'session')
+    def test_charge_action_with_zero_or_empty_amount(self, mock_db):
+        for amount, error in ((0, 'Order amount is zero.'), (0.0, 'Order amount is zero.'),
+                              ('', 'Order amount must be a number.')):
+            resp = self.app.patch('payments/1/charge', data=json.dumps({'amount': amount}), content_type='application/json')
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertTrue(error in resp.data)
+        #refused before anything is charged
+        mock_db.execute.assert_not_called()
+
+    @mock.patch.object(PaymentService, 'perform_payment_action',
+                       side_effect=PaymentServiceQueryError('Could not charge the default payment due to query error'))
+    def test_charge_action_with_query_error(self, mock_db_action):
+        # the database failing is a server error, not a bad request
+        with mock.patch.dict(app.config, PROPAGATE_EXCEPTIONS=False):
+            for action, data in (('charge', {'amount': 25.0}), ('set-default', {'payment_id': 1})):
+                resp = self.app.patch('payments/1/{}'.format(action), data=json.dumps(data), content_type='application/json')
+                self.assertEqual(resp.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+                self.assertFalse('not found' in resp.data)
+
     @mock.patch.object(PaymentService, 'perform_payment_action', return_value=True)
     def test_charge_action_success(self, mock_db_action):
         user_id = 1
@@ -454,17 +794,40 @@ class TestPaymentsCRUD(unittest.TestCase):
     def test_crud_update_put(self,mock_ps_update):
         data = json.dumps(PUT_CREDIT)
         resp = self.app.put('/payments/1', data=data, content_type='application/json')
-        mock_ps_update.assert_called_with(1,payment_replacement=PUT_CREDIT)
+        mock_ps_update.assert_called_with(1,payment_replacement=PUT_CREDIT,expected_version=None)
         self.assertEqual( resp.status_code, status.HTTP_200_OK )
         new_json = json.loads(resp.data)
         self.assertEqual (new_json['nickname'], 'favcredit')
 
 # passing correct data to patch
+    @mock.patch.object(PaymentService, 'update_payment', return_value=PATCH_RETURN)
+    def test_crud_update_patch_if_match(self, mock_ps_update):
+        resp = self.app.patch('/payments/1', data=json.dumps(PATCH_CREDIT), content_type='application/json',
+                              headers={'If-Match': '"1-4"'})
+        mock_ps_update.assert_called_with(1,payment_attributes=PATCH_CREDIT,expected_version=4)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+        # an ETag of another payment can never match
+        resp = self.app.patch('/payments/1', data=json.dumps(PATCH_CREDIT), content_type='application/json',
+                              headers={'If-Match': '"2-4"'})
+        mock_ps_update.assert_called_with(1,payment_attributes=PATCH_CREDIT,expected_version=0)
+
+        resp = self.app.patch('/payments/1', data=json.dumps(PATCH_CREDIT), content_type='application/json',
+                              headers={'If-Match': '*'})
+        mock_ps_update.assert_called_with(1,payment_attributes=PATCH_CREDIT,expected_version=None)
+
+    @mock.patch.object(PaymentService, 'update_payment', side_effect=PaymentVersionMismatchError('Invalid payment: Payment has been changed since version 4'))
+    def test_crud_update_put_precondition_failed(self, mock_ps_update):
+        resp = self.app.put('/payments/1', data=json.dumps(PUT_CREDIT), content_type='application/json',
+                            headers={'If-Match': '"1-4"'})
+        mock_ps_update.assert_called_with(1,payment_replacement=PUT_CREDIT,expected_version=4)
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+
     @mock.patch.object(PaymentService, 'update_payment', return_value=PATCH_RETURN)
     def test_crud_update_patch(self,mock_ps_update):
         data = json.dumps(PATCH_CREDIT)
         resp = self.app.patch('/payments/1', data=data, content_type='application/json')
-        mock_ps_update.assert_called_with(1,payment_attributes=PATCH_CREDIT)
+        mock_ps_update.assert_called_with(1,payment_attributes=PATCH_CREDIT,expected_version=None)
         self.assertEqual( resp.status_code, status.HTTP_200_OK )
         new_json = json.loads(resp.data)
         self.assertEqual (new_json['nickname'], 'boringcredit')
@@ -513,7 +876,7 @@ class TestPaymentsCRUD(unittest.TestCase):
     def test_crud_update_id_not_found_patch(self,mock_ps_update):
         credit = json.dumps({'nickname' : 'mycredit'})
         resp = self.app.patch('payments/778',data = credit,content_type='application/json')
-        mock_ps_update.assert_called_with(778,payment_attributes={'nickname' : 'mycredit'})
+        mock_ps_update.assert_called_with(778,payment_attributes={'nickname' : 'mycredit'},expected_version=None)
         self.assertTrue('Invalid payment: Payment ID not found' in resp.data)
         self.assertTrue(resp.status_code, status.HTTP_404_NOT_FOUND)
 # passing a non existing payment id to PUT
@@ -521,6 +884,6 @@ class TestPaymentsCRUD(unittest.TestCase):
     def test_crud_update_id_not_found_put(self,mock_ps_update):
         credit = json.dumps(CC_RETURN)
         resp = self.app.put('payments/778',data = credit,content_type='application/json')
-        mock_ps_update.assert_called_with(778,payment_replacement=CC_RETURN)
+        mock_ps_update.assert_called_with(778,payment_replacement=CC_RETURN,expected_version=None)
         self.assertTrue('Invalid payment: Payment ID not found' in resp.data)
         self.assertTrue(resp.status_code, status.HTTP_404_NOT_FOUND)
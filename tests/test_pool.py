@@ -0,0 +1,84 @@
+# Test cases can be run with either of the following:
+# python -m unittest discover
+# nosetests -v --rednose --nologcapture
+
+import unittest, mock
+from sqlalchemy import exc
+from app.db.pool import InstrumentedQueuePool
+
+class FakeConnection(object):
+    """ A DBAPI connection whose SELECT 1 fails once the database has gone away """
+    def __init__(self, database):
+        self.database = database
+        self.closed = False
+
+    def cursor(self):
+        cursor = mock.MagicMock()
+        if not self.database['up']:
+            cursor.execute.side_effect = Exception('server closed the connection unexpectedly')
+        return cursor
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+class TestInstrumentedQueuePool(unittest.TestCase):
+
+    def setUp(self):
+        self.database = {'up': True}
+        self.connections = []
+
+    def creator(self):
+        connection = FakeConnection(self.database)
+        self.connections.append(connection)
+        return connection
+
+    def test_checkouts_are_counted(self):
+        pool = InstrumentedQueuePool(self.creator, pool_size=2, max_overflow=1)
+        first = pool.connect()
+        second = pool.connect()
+        status = pool.status_dict()
+        self.assertEqual((status['checkouts'], status['checked_out'], status['timeouts']), (2, 2, 0))
+        first.close()
+        second.close()
+        pool.connect().close()
+        status = pool.status_dict()
+        self.assertEqual((status['checkouts'], status['checked_out'], status['checked_in']), (3, 0, 2))
+        self.assertEqual(len(self.connections), 2)
+
+    def test_timeouts_are_counted(self):
+        pool = InstrumentedQueuePool(self.creator, pool_size=1, max_overflow=0, timeout=0.01)
+        held = pool.connect()
+        self.assertRaises(exc.TimeoutError, pool.connect)
+        status = pool.status_dict()
+        self.assertEqual((status['checkouts'], status['timeouts']), (1, 1))
+        self.assertTrue(status['wait_seconds_max'] < 1)
+        held.close()
+
+    def test_pre_ping_replaces_broken_connections(self):
+        pool = InstrumentedQueuePool(self.creator, pool_size=1, pre_ping=True)
+        pool.connect().close()
+        # the database fails over: the pooled connection is dead, new ones work
+        self.connections[0].database = {'up': False}
+        connection = pool.connect()
+        self.assertTrue(self.connections[0].closed)
+        self.assertEqual(len(self.connections), 2)
+        self.assertEqual(pool.status_dict()['disconnects'], 1)
+        connection.close()
+
+    def test_without_pre_ping_broken_connections_are_handed_out(self):
+        pool = InstrumentedQueuePool(self.creator, pool_size=1)
+        pool.connect().close()
+        self.connections[0].database = {'up': False}
+        pool.connect().close()
+        self.assertEqual(len(self.connections), 1)
+        self.assertEqual(pool.status_dict()['disconnects'], 0)
+
+    def test_counters_survive_recreate(self):
+        pool = InstrumentedQueuePool(self.creator, pool_size=1, pre_ping=True)
+        pool.connect().close()
+        pool = pool.recreate()
+        pool.connect().close()
+        self.assertEqual(pool.status_dict()['checkouts'], 2)
@@ -0,0 +1,57 @@
+# Test cases can be run with either of the following:
+# python -m unittest discover
+# nosetests -v --rednose --nologcapture
+
+import os
+import unittest, mock
+from app import app, create_app, payments
+from app.db import app_db
+from app.server import ProductionServer, server_options, close_connections, \
+    share_metrics, flush_metrics, archive_metrics, remove_metrics
+
+CONFIG = {'WEB_WORKERS': 3, 'WEB_THREADS': 4, 'WEB_MAX_REQUESTS': 1000, 'WEB_MAX_REQUESTS_JITTER': 100,
+          'WEB_TIMEOUT': 30, 'WEB_GRACEFUL_TIMEOUT': 20}
+
+class TestProductionServer(unittest.TestCase):
+
+    def test_server_options(self):
+        options = server_options(CONFIG, 5000)
+        self.assertEqual(options['bind'], '0.0.0.0:5000')
+        self.assertEqual((options['workers'], options['threads'], options['worker_class']), (3, 4, 'gthread'))
+        self.assertEqual((options['max_requests'], options['max_requests_jitter']), (1000, 100))
+        self.assertEqual((options['timeout'], options['graceful_timeout']), (30, 20))
+        self.assertTrue(options['preload_app'])
+        self.assertEqual(server_options(dict(CONFIG, WEB_THREADS=1), 5000)['worker_class'], 'sync')
+
+    def test_gunicorn_takes_the_options(self):
+        server = ProductionServer(app, server_options(CONFIG, 5000))
+        self.assertEqual((server.cfg.workers, server.cfg.threads, server.cfg.graceful_timeout), (3, 4, 20))
+        self.assertEqual(server.cfg.max_requests, 1000)
+        self.assertEqual(server.load(), app)
+
+    def test_master_closes_connections_before_fork(self):
+        with app.app_context():
+            engine = app_db.engine
+        with mock.patch.object(engine, 'dispose') as dispose:
+            close_connections(mock.Mock(app=mock.Mock(application=app)), mock.Mock())
+        dispose.assert_called_once_with()
+
+    def test_workers_share_metrics(self):
+        options = server_options(CONFIG, 5000)
+        self.assertEqual((options['on_starting'], options['worker_exit'], options['child_exit'], options['on_exit']),
+                         (share_metrics, flush_metrics, archive_metrics, remove_metrics))
+
+        application = create_app()
+        server = mock.Mock(app=mock.Mock(application=application))
+        metrics = application.extensions['metrics']
+        share_metrics(server)
+        directory = metrics.directory
+        self.assertTrue(os.path.isdir(directory))
+
+        worker = mock.Mock(pid=os.getpid())
+        flush_metrics(server, worker)
+        self.assertEqual(os.listdir(directory), ['%d.json' % os.getpid()])
+        archive_metrics(server, worker)
+        self.assertEqual(os.listdir(directory), ['archive.json'])
+        remove_metrics(server)
+        self.assertFalse(os.path.exists(directory))
@@ -0,0 +1,86 @@
+# Test cases can be run with either of the following:
+# python -m unittest discover
+# nosetests -v --rednose --nologcapture
+
+import unittest, copy
+from datetime import date
+from app.error_handlers import DataValidationError
+from app.validation import PAYMENT, CARD_DETAILS, PaymentValidationError, card_expiry_date, payment_errors
+
+CREDIT = {'nickname' : 'my credit', 'user_id' : 1, 'payment_type' : 'credit',
+          'details' : {'user_name' : 'Jimmy Jones', 'card_number' : '1111222233334444',
+                       'expires' : '12/2099', 'card_type' : 'Mastercard'}}
+
+PAYPAL = {'nickname' : 'my paypal', 'user_id' : 1, 'payment_type' : 'paypal',
+          'details' : {'user_name' : 'John Jameson', 'user_email' : 'jj@aol.com'}}
+
+class TestValidation(unittest.TestCase):
+
+    def test_valid_payments(self):
+        for payment in (CREDIT, PAYPAL):
+            self.assertEqual(PAYMENT.errors(payment), [])
+            self.assertEqual(PAYMENT.errors(payment, strict=True), [])
+
+    def test_all_missing_fields_are_reported(self):
+        data = {'user_id' : 1, 'payment_type' : 'credit', 'details' : {'user_name' : 'Jimmy Jones'}}
+        self.assertEqual(PAYMENT.errors(data),
+                         ['missing nickname', 'missing card_type', 'missing card_number', 'missing expires'])
+
+    def test_bad_data(self):
+        self.assertEqual(PAYMENT.errors('garbage'), ['body of request contained bad or no data'])
+        self.assertEqual(PAYMENT.errors(None), ['body of request contained bad or no data'])
+        data = dict(CREDIT, details='garbage')
+        self.assertEqual(PAYMENT.errors(data), ['body of request contained bad or no data'])
+
+    def test_formats_are_only_checked_when_strict(self):
+        bad = copy.deepcopy(CREDIT)
+        bad['details']['card_number'] = 'abc'
+        bad['details']['user_name'] = 'Jo3n'
+        self.assertEqual(PAYMENT.errors(bad), [])
+        self.assertEqual(PAYMENT.errors(bad, strict=True), ['invalid user_name', 'invalid card_number'])
+
+        bad = dict(PAYPAL, payment_type='cash')
+        self.assertEqual(PAYMENT.errors(bad), [])
+        self.assertEqual(PAYMENT.errors(bad, strict=True), ['invalid payment_type'])
+
+        # an unhashable payment_type is invalid, and its details are checked as paypal's
+        bad = dict(PAYPAL, payment_type=['credit'])
+        self.assertEqual(PAYMENT.errors(bad), [])
+        self.assertEqual(PAYMENT.errors(bad, strict=True), ['invalid payment_type'])
+
+    def test_payment_errors_agree_with_the_schema(self):
+        missing = {'user_id' : 1, 'payment_type' : 'credit', 'details' : {'user_name' : 'Jimmy Jones'}}
+        for data in (CREDIT, PAYPAL, missing, dict(CREDIT, payment_type='debit'),
+                     dict(CREDIT, payment_type='paypal'), dict(PAYPAL, payment_type='cash'),
+                     dict(PAYPAL, payment_type=['credit']), dict(CREDIT, payment_type=['credit']),
+                     dict(CREDIT, details='garbage'), dict(CREDIT, details=None), {'details' : {}},
+                     {}, [], 'garbage', None, 1):
+            self.assertEqual(payment_errors(data), PAYMENT.errors(data))
+
+    def test_expired_card(self):
+        card = dict(CREDIT['details'])
+        today = date.today()
+        card['expires'] = '%02d/%d' % (today.month, today.year)
+        self.assertEqual(CARD_DETAILS.errors(card, strict=True), [])
+        card['expires'] = '01/2010'
+        self.assertEqual(CARD_DETAILS.errors(card, strict=True), ['card is expired'])
+        card['expires'] = '2017/07'
+        self.assertEqual(CARD_DETAILS.errors(card, strict=True), ['invalid expires'])
+        card['expires'] = '13/2099'
+        self.assertEqual(CARD_DETAILS.errors(card, strict=True), ['invalid expires'])
+
+    def test_card_expiry_date(self):
+        self.assertEqual(card_expiry_date('02/2024'), date(2024, 2, 29))
+        self.assertEqual(card_expiry_date('12/2099'), date(2099, 12, 31))
+        self.assertEqual(card_expiry_date('13/2099'), None)
+        self.assertEqual(card_expiry_date('01/0000'), None)
+        self.assertEqual(card_expiry_date('whatever'), None)
+        self.assertEqual(card_expiry_date(None), None)
+
+    def test_check_raises_with_every_error(self):
+        with self.assertRaises(PaymentValidationError) as e:
+            PAYMENT.check({'user_id' : 1})
+        self.assertTrue(isinstance(e.exception, DataValidationError))
+        self.assertEqual(e.exception.errors, ['missing nickname', 'missing payment_type', 'missing details'])
+        self.assertEqual(e.exception.message,
+                         'Invalid payment: missing nickname; missing payment_type; missing details')